@@ -1,8 +1,14 @@
 #agent service main file
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional
+import os
+
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.tokens import issue_token, token_secret
+
+from storage import DuplicateError, open_store
 
 app = FastAPI(title="Agent Service")
 
@@ -15,8 +21,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage
-agents = []
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Storage backend: memory:// (default) or sqlite:///path/to/agents.db
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+store = open_store(STORAGE_URL)
 
 class Agent(BaseModel):
     username: str
@@ -30,31 +45,43 @@ class AgentLogin(BaseModel):
     username: str
     password: str
 
+@app.on_event("startup")
+async def startup_event():
+    # Refuse to start rather than fail on the first login
+    token_secret()
+    await store.open()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await store.close()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Agent Service"}
 
 @app.get("/agents")
 async def get_agents():
-    return agents
+    return await store.list_all()
 
 @app.post("/agents/register")
 async def register_agent(agent: Agent):
-    # Check if username or email already exists
-    if any(a.username == agent.username for a in agents):
-        raise HTTPException(status_code=400, detail="Username already exists")
-    if any(a.email == agent.email for a in agents):
-        raise HTTPException(status_code=400, detail="Email already exists")
-    
-    agents.append(agent)
+    try:
+        await store.create(agent.dict())
+    except DuplicateError as e:
+        raise HTTPException(status_code=400, detail=f"{e.field.capitalize()} already exists")
     return {"message": "Agent registered successfully"}
 
 @app.post("/agents/login")
 async def login_agent(credentials: AgentLogin):
-    agent = next((a for a in agents if a.username == credentials.username and a.password == credentials.password), None)
-    if not agent:
+    agent = await store.find_by_username(credentials.username)
+    if agent is None or agent["password"] != credentials.password:
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    return {"message": "Login successful"}
+    issued = issue_token(agent["username"], "agent")
+    return {
+        "message": "Login successful",
+        "token": issued["token"],
+        "expires_at": issued["claims"]["exp"]
+    }
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,122 @@
+#storage backends for the agent service
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+from buscommon.sqlite import SQLitePool
+
+AGENT_FIELDS = ("username", "email", "password", "full_name", "phone_number", "agency_name")
+
+
+class DuplicateError(Exception):
+    """A unique field (``username`` or ``email``) is already taken"""
+
+    def __init__(self, field: str):
+        super().__init__(f"{field} already exists")
+        self.field = field
+
+
+class AgentStore:
+    """Interface of the agent storage backends; agents are plain dicts keyed by ``AGENT_FIELDS``"""
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def create(self, agent: dict):
+        """Store a new agent, raising DuplicateError if its username or email is taken"""
+        raise NotImplementedError
+
+    async def list_all(self) -> List[dict]:
+        raise NotImplementedError
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        raise NotImplementedError
+
+
+class MemoryAgentStore(AgentStore):
+    """Agents in process memory, in registration order"""
+
+    def __init__(self):
+        self.agents: List[dict] = []
+
+    async def create(self, agent: dict):
+        for field in ("username", "email"):
+            if any(a[field] == agent[field] for a in self.agents):
+                raise DuplicateError(field)
+        self.agents.append(agent)
+
+    async def list_all(self) -> List[dict]:
+        return list(self.agents)
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        return next((a for a in self.agents if a["username"] == username), None)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    agency_name TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS agents_username ON agents (username);
+CREATE UNIQUE INDEX IF NOT EXISTS agents_email ON agents (email);
+"""
+
+_COLUMNS = ", ".join(AGENT_FIELDS)
+_INSERT = f"INSERT INTO agents ({_COLUMNS}) VALUES ({', '.join('?' for _ in AGENT_FIELDS)})"
+_SELECT_ALL = f"SELECT {_COLUMNS} FROM agents ORDER BY id"
+_USERNAME_TAKEN = "SELECT 1 FROM agents WHERE username = ?"
+_SELECT_BY_USERNAME = f"SELECT {_COLUMNS} FROM agents WHERE username = ?"
+
+
+def _row_to_agent(row: Optional[sqlite3.Row]) -> Optional[dict]:
+    return {field: row[field] for field in AGENT_FIELDS} if row else None
+
+
+class SQLiteAgentStore(AgentStore):
+    """Agents in a SQLite database shared by every worker process"""
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: Optional[SQLitePool] = None
+
+    async def open(self):
+        self.pool = SQLitePool(self.path, self.pool_size, SQLITE_SCHEMA)
+
+    async def close(self):
+        self.pool.close()
+
+    async def create(self, agent: dict):
+        def insert(connection):
+            try:
+                connection.execute(_INSERT, [agent[field] for field in AGENT_FIELDS])
+            except sqlite3.IntegrityError:
+                # Report username before email, like the in-memory store
+                taken = connection.execute(_USERNAME_TAKEN, (agent["username"],)).fetchone()
+                raise DuplicateError("username" if taken else "email")
+        await self.pool.run(insert)
+
+    async def list_all(self) -> List[dict]:
+        return await self.pool.run(lambda connection: [
+            _row_to_agent(row) for row in connection.execute(_SELECT_ALL)])
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        return await self.pool.run(lambda connection: _row_to_agent(
+            connection.execute(_SELECT_BY_USERNAME, (username,)).fetchone()))
+
+
+def open_store(url: str) -> AgentStore:
+    """Build the backend named by a storage URL: ``memory://`` or ``sqlite:///path/to.db``"""
+    if url.startswith("sqlite://"):
+        return SQLiteAgentStore(url[len("sqlite://"):], int(os.getenv("SQLITE_POOL_SIZE", "4")))
+    if url.startswith("memory://"):
+        return MemoryAgentStore()
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")
@@ -0,0 +1,235 @@
+#circuit breakers and adaptive timeouts for upstream calls
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+import httpx
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit is open"""
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(f"{upstream} is unavailable, circuit open")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class LatencyWindow:
+    """Recent latencies of one route and the read timeout they call for.
+
+    The timeout is the p99 of the last ``window`` samples times
+    ``multiplier``, kept between ``min_timeout`` and ``max_timeout``. Until
+    ``min_samples`` samples have been seen it is ``max_timeout``. A call
+    that timed out is recorded as a sample of ``max_timeout``, so a route
+    that slows down pushes its own timeout back up instead of timing out
+    for good.
+    """
+
+    def __init__(self, max_timeout: float, min_timeout: float, multiplier: float,
+                 window: int, min_samples: int):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.timeouts = 0
+        self._latencies: deque = deque(maxlen=window)
+        self._new_samples = 0
+        self._timeout = max_timeout
+
+    def record(self, latency: float):
+        self._latencies.append(latency)
+        self._new_samples += 1
+
+    def record_timeout(self):
+        self.timeouts += 1
+        self.record(self.max_timeout)
+        # Back off at once rather than after the next refresh
+        self._new_samples = 10
+
+    def timeout(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.max_timeout
+        # Re-sorting the window on every call is wasteful; refresh every few samples
+        if self._new_samples >= 10:
+            ordered = sorted(self._latencies)
+            p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+            self._timeout = min(self.max_timeout, max(self.min_timeout, p99 * self.multiplier))
+            self._new_samples = 0
+        return self._timeout
+
+    def snapshot(self) -> Dict:
+        return {
+            "timeout": round(self.timeout(), 4),
+            "max_timeout": self.max_timeout,
+            "samples": len(self._latencies),
+            "timeouts": self.timeouts,
+        }
+
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker plus latency-based timeouts for one upstream.
+
+    ``failure_threshold`` consecutive failures (transport errors, timeouts
+    or 5xx responses) open the circuit, and calls then fail at once for
+    ``reset_timeout`` seconds. After that one probe call is let through
+    (half-open): success closes the circuit, failure opens it again.
+
+    Timeouts are learned per route (e.g. ``POST /users/login``), since one
+    upstream can serve cheap lookups next to calls that hash a password:
+    each route has its own LatencyWindow, capped by ``route_timeouts`` or
+    else ``max_timeout``, and floored at ``min_timeout``.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 10.0,
+                 max_timeout: float = 5.0, min_timeout: float = 1.0, timeout_multiplier: float = 3.0,
+                 window: int = 200, min_samples: int = 20, route_timeouts: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.timeout_multiplier = timeout_multiplier
+        self.window = window
+        self.min_samples = min_samples
+        self.route_timeouts = dict(route_timeouts or {})
+        self.clock = clock
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.rejected = 0
+        self.last_failure: Optional[str] = None
+        self.routes: Dict[str, LatencyWindow] = {}
+
+    def route(self, route: str) -> LatencyWindow:
+        window = self.routes.get(route)
+        if window is None:
+            window = self.routes[route] = LatencyWindow(
+                self.route_timeouts.get(route, self.max_timeout), self.min_timeout,
+                self.timeout_multiplier, self.window, self.min_samples,
+            )
+        return window
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead now"""
+        if self.state == OPEN:
+            remaining = self.opened_at + self.reset_timeout - self.clock()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, remaining)
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            if self.probe_in_flight:
+                self.rejected += 1
+                raise CircuitOpenError(self.name, self.reset_timeout)
+            self.probe_in_flight = True
+
+    def record_success(self, latency: float, route: str = "*"):
+        self.route(route).record(latency)
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        self.state = CLOSED
+
+    def record_timeout(self, route: str = "*"):
+        self.route(route).record_timeout()
+        self.record_failure(f"timeout on {route}")
+
+    def record_failure(self, reason: str):
+        self.last_failure = reason
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.trip(reason)
+
+    def trip(self, reason: str):
+        """Open the circuit now, e.g. because a health check reported the upstream down"""
+        self.last_failure = reason
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.probe_in_flight = False
+
+    def timeout(self, route: str = "*") -> float:
+        """Time allowed until the response headers of the next call on ``route``"""
+        return self.route(route).timeout()
+
+    def snapshot(self) -> Dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "rejected": self.rejected,
+            "last_failure": self.last_failure,
+            "routes": {route: window.snapshot() for route, window in sorted(self.routes.items())},
+        }
+
+
+class BreakerTransport(httpx.AsyncBaseTransport):
+    """httpx transport that routes every request of a client through a CircuitBreaker.
+
+    Sitting at the transport level covers plain, streamed and built
+    requests alike. Callers name the route in the ``route`` request
+    extension (the gateway passes its own path template); requests
+    without one share the ``*`` route.
+
+    The adaptive timeout bounds the wait for the response headers only,
+    and latency is measured up to them. Reading the body, chunk by chunk
+    for streamed listings, is bounded by the route's static cap instead,
+    so a large listing is not cut off by a timeout learned from small
+    ones. ``observe``, if given, is called with the status (or "error")
+    and the latency of every call that reached the upstream.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, breaker: CircuitBreaker,
+                 observe: Optional[Callable[[str, float], None]] = None):
+        self.transport = transport
+        self.breaker = breaker
+        self.observe = observe
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.breaker.before_call()
+        route = f"{request.method} {request.extensions.get('route', '*')}"
+        window = self.breaker.route(route)
+        deadline = window.timeout()
+        timeout = dict(request.extensions.get("timeout", {}))
+        timeout["read"] = window.max_timeout
+        request.extensions["timeout"] = timeout
+        started = time.perf_counter()
+        try:
+            response = await asyncio.wait_for(self.transport.handle_async_request(request), deadline)
+        except asyncio.TimeoutError:
+            self._timed_out(route, started)
+            raise httpx.ReadTimeout(f"No response from {self.breaker.name} within {deadline:.3f}s", request=request)
+        except httpx.ReadTimeout:
+            self._timed_out(route, started)
+            raise
+        except httpx.TransportError as e:
+            self.breaker.record_failure(f"{type(e).__name__}: {e}")
+            if self.observe is not None:
+                self.observe("error", time.perf_counter() - started)
+            raise
+        except BaseException:
+            # Cancelled by the caller: neither a success nor a failure of the upstream
+            self.breaker.probe_in_flight = False
+            raise
+        latency = time.perf_counter() - started
+        if response.status_code >= 500:
+            self.breaker.record_failure(f"status {response.status_code}")
+        else:
+            self.breaker.record_success(latency, route)
+        if self.observe is not None:
+            self.observe(str(response.status_code), latency)
+        return response
+
+    def _timed_out(self, route: str, started: float):
+        self.breaker.record_timeout(route)
+        if self.observe is not None:
+            self.observe("error", time.perf_counter() - started)
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -1,9 +1,27 @@
 #api gateway main file
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from datetime import date
+from functools import partial
+from typing import Optional
+import asyncio
 import httpx
+import logging
 import os
 
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.snapshots import etag_matches
+from buscommon.tokens import InvalidToken, TokenVerifier
+
+from circuit_breaker import CircuitOpenError
+from response_cache import ResponseCache
+from single_flight import SingleFlight
+from upstreams import Upstreams
+
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="Bus Booking System API Gateway")
 
 # Configure CORS
@@ -15,6 +33,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
 # Service URLs
 BUS_BOOKING_URL = os.getenv("BUS_BOOKING_URL", "http://bus-booking:8001")
 BUS_SERVICE_URL = os.getenv("BUS_SERVICE_URL", "http://bus-service:8002")
@@ -22,67 +48,322 @@ USER_SERVICE_URL = os.getenv("USER_SERVICE_URL", "http://user-service:8003")
 AGENT_SERVICE_URL = os.getenv("AGENT_SERVICE_URL", "http://agent-service:8006")
 BOOKING_SERVICE_URL = os.getenv("BOOKING_SERVICE_URL", "http://booking-service:8007")
 
+# Long-lived pooled clients, one per upstream
+upstreams = Upstreams(metrics)
+upstreams.register("bus_booking", BUS_BOOKING_URL)
+upstreams.register("bus_service", BUS_SERVICE_URL)
+upstreams.register("user_service", USER_SERVICE_URL)
+upstreams.register("agent_service", AGENT_SERVICE_URL)
+upstreams.register("booking_service", BOOKING_SERVICE_URL)
+
+# Response cache for bus-service reads; TTLs are in seconds
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+BUSES_CACHE_TTL = float(os.getenv("BUSES_CACHE_TTL", "10"))
+BUS_CACHE_TTL = float(os.getenv("BUS_CACHE_TTL", "30"))
+cache = ResponseCache(CACHE_MAX_ENTRIES)
+# Identical concurrent upstream reads share one call on routes that opt in
+flights = SingleFlight()
+
+# Session tokens from user-service and agent-service are checked here, without a network call
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+verifier = TokenVerifier(cache_size=AUTH_CACHE_SIZE)
+
+# Optional live health feed for the circuit breakers, polled every HEALTH_POLL_INTERVAL seconds
+ERROR_HANDLING_URL = os.getenv("ERROR_HANDLING_URL")
+HEALTH_POLL_INTERVAL = float(os.getenv("HEALTH_POLL_INTERVAL", "15"))
+
+# Per-branch time budget of GET /trips/{bus_id}, in seconds
+TRIP_BRANCH_TIMEOUT = float(os.getenv("TRIP_BRANCH_TIMEOUT", "1.0"))
+TRIP_BOOKINGS_LIMIT = 1000
+
+health_poller = None
+
+@app.on_event("startup")
+async def startup_event():
+    global health_poller
+    await upstreams.open()
+    if ERROR_HANDLING_URL:
+        health_poller = asyncio.create_task(poll_health())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if health_poller is not None:
+        health_poller.cancel()
+    await upstreams.close()
+
+async def poll_health():
+    """Open the breaker of every upstream the error-handling service reports as down"""
+    async with httpx.AsyncClient(base_url=ERROR_HANDLING_URL, timeout=10.0) as client:
+        while True:
+            try:
+                response = await client.get("/health")
+                for service_name, status in response.json().items():
+                    breaker = upstreams.breakers.get(service_name.replace("-", "_"))
+                    if breaker is not None and status["status"] == "down":
+                        breaker.trip("reported down by error-handling service")
+            except Exception as e:
+                logger.warning(f"Health poll failed: {str(e)}")
+            await asyncio.sleep(HEALTH_POLL_INTERVAL)
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+@app.exception_handler(httpx.TimeoutException)
+async def upstream_timeout_handler(request: Request, exc: httpx.TimeoutException):
+    return JSONResponse(status_code=504, content={"detail": "Upstream service timed out"})
+
+@app.exception_handler(httpx.TransportError)
+async def upstream_error_handler(request: Request, exc: httpx.TransportError):
+    return JSONResponse(status_code=502, content={"detail": "Upstream service unavailable"})
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Bus Booking System API Gateway"}
 
+@app.get("/upstreams")
+async def upstream_status():
+    """Circuit breaker state per upstream, with the adaptive timeout of each route it served"""
+    return {name: breaker.snapshot() for name, breaker in upstreams.breakers.items()}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return dict(cache.stats(), single_flight=flights.stats(), token_cache=verifier.stats())
+
+def bearer_claims(request: Request) -> Optional[dict]:
+    """Claims of the request's bearer token, None without one; 401 if it is not valid"""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return verifier.verify(token.strip())
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+
+@app.get("/auth/verify")
+async def verify_auth(request: Request):
+    claims = bearer_claims(request)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    return claims
+
+@app.post("/auth/revoke")
+async def revoke_auth(request: Request):
+    """Revoke the caller's own token, e.g. on logout"""
+    claims = bearer_claims(request)
+    if claims is None:
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    verifier.revoke(claims)
+    return {"message": "Token revoked"}
+
+async def cached_get(request: Request, upstream: str, path: str, ttl: float, coalesce: bool = False) -> Response:
+    """GET through the response cache.
+
+    Fresh entries are served without calling upstream; expired ones are
+    revalidated with their ETag and kept on a 304. Only 200s are cached,
+    and not if a write invalidated the key while they were fetched. With
+    ``coalesce`` concurrent misses for the same key share one upstream
+    call, unless a write came in between them.
+    """
+    key = f"{upstream}:{path}?{request.url.query}"
+    generation = cache.generation(key)
+    entry = cache.get(key)
+    if entry is not None and cache.is_fresh(entry):
+        cache.record_hit(entry)
+    else:
+        headers = {"if-none-match": entry.etag} if entry is not None and entry.etag else {}
+        fetch = partial(upstreams[upstream].get, path, params=request.query_params.multi_items(), headers=headers,
+                        extensions={"route": request.scope["route"].path})
+        if coalesce:
+            response = await flights.do(f"{key}|{headers.get('if-none-match', '')}|{generation}", fetch)
+        else:
+            response = await fetch()
+        if response.status_code == 304 and entry is not None:
+            cache.refresh(entry, ttl)
+            cache.record_hit(entry, revalidated=True)
+        else:
+            cache.record_miss()
+            if response.status_code != 200:
+                return Response(content=response.content, status_code=response.status_code,
+                                media_type=response.headers.get("content-type"))
+            entry = cache.put(key, response.status_code, response.content,
+                              response.headers.get("content-type"), response.headers.get("etag"), ttl, generation)
+
+    headers = {"ETag": entry.etag} if entry.etag else {}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        cache.record_not_modified(entry)
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, status_code=entry.status_code, media_type=entry.media_type, headers=headers)
+
+# Connection-level headers that must not be relayed between hops
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailer", "transfer-encoding", "upgrade", "host", "content-length",
+}
+
+def forwarded_headers(headers) -> list:
+    return [(name, value) for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+
+async def proxy(request: Request, upstream: str, path: str) -> StreamingResponse:
+    """Relay a request upstream and stream the response back untouched.
+
+    The upstream status, headers and body bytes are passed through as they
+    arrive, without decoding or re-encoding the JSON. Accept-Encoding is
+    forwarded as-is (identity if absent) so compressed bodies only reach
+    clients that asked for them. A valid bearer token is passed on as
+    X-Auth-Subject/X-Auth-Role; clients cannot set those headers themselves.
+    """
+    client = upstreams[upstream]
+    claims = bearer_claims(request)
+    headers = [(name, value) for name, value in forwarded_headers(request.headers)
+               if not name.lower().startswith("x-auth-")]
+    if claims is not None:
+        headers += [("x-auth-subject", claims["sub"]), ("x-auth-role", claims["role"])]
+    if "accept-encoding" not in request.headers:
+        headers.append(("accept-encoding", "identity"))
+    upstream_request = client.build_request(
+        request.method,
+        path,
+        params=request.query_params.multi_items(),
+        headers=headers,
+        content=await request.body(),
+        # Timeouts are learned per gateway route, e.g. /users/{user_id}
+        extensions={"route": request.scope["route"].path},
+    )
+    response = await client.send(upstream_request, stream=True)
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=dict(forwarded_headers(response.headers)),
+        background=BackgroundTask(response.aclose),
+    )
+
+async def proxy_write(request: Request, upstream: str, path: str, invalidates: str) -> StreamingResponse:
+    """Proxy a write and, if it succeeded, drop cached reads under the ``invalidates`` key prefix"""
+    response = await proxy(request, upstream, path)
+    if response.status_code < 400:
+        cache.invalidate(invalidates)
+    return response
+
 # Bus Booking Routes
 @app.get("/bookings")
-async def get_bookings():
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{BOOKING_SERVICE_URL}/bookings")
-        return response.json()
+async def get_bookings(request: Request):
+    # Relay the listing chunk by chunk rather than buffering it here again
+    return await proxy(request, "booking_service", "/bookings")
 
 @app.post("/bookings")
-async def create_booking(booking_data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{BOOKING_SERVICE_URL}/bookings", json=booking_data)
-        return response.json()
+async def create_booking(request: Request):
+    return await proxy(request, "booking_service", "/bookings")
+
+@app.post("/bookings/batch")
+async def create_bookings_batch(request: Request):
+    return await proxy(request, "booking_service", "/bookings/batch")
 
 # Bus Service Routes
 @app.get("/buses")
-async def get_buses():
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{BUS_SERVICE_URL}/buses")
-        return response.json()
+async def get_buses(request: Request):
+    return await cached_get(request, "bus_service", "/buses", BUSES_CACHE_TTL, coalesce=True)
+
+@app.post("/buses")
+async def create_bus(request: Request):
+    return await proxy_write(request, "bus_service", "/buses", invalidates="bus_service:/buses")
+
+@app.get("/buses/search")
+async def search_buses(request: Request):
+    return await proxy(request, "bus_service", "/buses/search")
 
 @app.get("/buses/{bus_id}")
-async def get_bus(bus_id: int):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{BUS_SERVICE_URL}/buses/{bus_id}")
-        return response.json()
+async def get_bus(bus_id: str, request: Request):
+    return await cached_get(request, "bus_service", f"/buses/{bus_id}", BUS_CACHE_TTL, coalesce=True)
+
+@app.put("/buses/{bus_id}/seats")
+async def update_seats(bus_id: str, request: Request):
+    return await proxy_write(request, "bus_service", f"/buses/{bus_id}/seats", invalidates="bus_service:/buses")
+
+@app.put("/buses/{bus_id}/seats/{seat_number}")
+async def update_seat(bus_id: str, seat_number: int, request: Request):
+    return await proxy_write(request, "bus_service", f"/buses/{bus_id}/seats/{seat_number}",
+                             invalidates="bus_service:/buses")
 
 # User Service Routes
 @app.post("/users/register")
-async def register_user(user_data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{USER_SERVICE_URL}/users/register", json=user_data)
-        return response.json()
+async def register_user(request: Request):
+    return await proxy(request, "user_service", "/users/register")
 
 @app.post("/users/login")
-async def login_user(credentials: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{USER_SERVICE_URL}/users/login", json=credentials)
-        return response.json()
+async def login_user(request: Request):
+    return await proxy(request, "user_service", "/users/login")
 
 # Agent Service Routes
 @app.get("/agents")
-async def get_agents():
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{AGENT_SERVICE_URL}/agents")
-        return response.json()
+async def get_agents(request: Request):
+    return await proxy(request, "agent_service", "/agents")
 
 @app.post("/agents/register")
-async def register_agent(agent_data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{AGENT_SERVICE_URL}/agents/register", json=agent_data)
-        return response.json()
+async def register_agent(request: Request):
+    return await proxy(request, "agent_service", "/agents/register")
 
 @app.post("/agents/login")
-async def login_agent(credentials: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{AGENT_SERVICE_URL}/agents/login", json=credentials)
-        return response.json()
+async def login_agent(request: Request):
+    return await proxy(request, "agent_service", "/agents/login")
+
+# Trip Routes
+class BranchError(Exception):
+    """An upstream branch of a composite request answered with an error status"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"upstream returned {status_code}")
+        self.status_code = status_code
+
+async def fetch_json(upstream: str, route: str, path: str, params: Optional[dict] = None):
+    request = upstreams[upstream].get(path, params=params, extensions={"route": route})
+    response = await asyncio.wait_for(request, TRIP_BRANCH_TIMEOUT)
+    if response.status_code != 200:
+        raise BranchError(response.status_code)
+    return response.json()
+
+@app.get("/trips/{bus_id}")
+async def get_trip(bus_id: str, date: Optional[date] = None, user_id: Optional[str] = None):
+    """Bus, seat map, bookings and user for a trip page in one round-trip.
+
+    The upstream calls run concurrently, each with its own timeout. A
+    branch that fails or times out is returned as null and listed under
+    ``degraded`` with the reason in ``errors``; only a missing bus fails
+    the whole request.
+    """
+    branches = {"bus": fetch_json("bus_service", "/buses/{bus_id}", f"/buses/{bus_id}")}
+    booking_filters = {"bus_id": bus_id, "limit": TRIP_BOOKINGS_LIMIT}
+    if date is not None:
+        branches["seats"] = fetch_json("bus_service", "/buses/{bus_id}/seats", f"/buses/{bus_id}/seats",
+                                       {"date": date.isoformat()})
+        booking_filters["journey_date"] = date.isoformat()
+    branches["bookings"] = fetch_json("booking_service", "/bookings", "/bookings", booking_filters)
+    if user_id is not None:
+        branches["user"] = fetch_json("user_service", "/users/{user_id}", f"/users/{user_id}")
+
+    results = await asyncio.gather(*branches.values(), return_exceptions=True)
+    trip, errors = {"bus_id": bus_id}, {}
+    for name, result in zip(branches, results):
+        if isinstance(result, asyncio.TimeoutError):
+            errors[name] = f"timed out after {TRIP_BRANCH_TIMEOUT}s"
+        elif isinstance(result, BranchError):
+            errors[name] = str(result)
+        elif isinstance(result, Exception):
+            errors[name] = f"upstream unavailable: {type(result).__name__}"
+        trip[name] = None if name in errors else result
+    if isinstance(results[0], BranchError) and results[0].status_code == 404:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    if trip.get("bookings") is not None:
+        # Larger trips continue through GET /bookings with this cursor
+        trip["bookings_next_cursor"] = trip["bookings"]["next_cursor"]
+        trip["bookings"] = trip["bookings"]["bookings"]
+    trip["degraded"] = list(errors)
+    trip["errors"] = errors
+    return trip
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,117 @@
+#ttl/lru cache for upstream responses in the gateway
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+class CachedResponse:
+    """An upstream response body kept with its ETag and expiry"""
+
+    __slots__ = ("status_code", "body", "media_type", "etag", "expires_at")
+
+    def __init__(self, status_code: int, body: bytes, media_type: Optional[str],
+                 etag: Optional[str], expires_at: float):
+        self.status_code = status_code
+        self.body = body
+        self.media_type = media_type
+        self.etag = etag
+        self.expires_at = expires_at
+
+
+class ResponseCache:
+    """Bounded LRU of upstream responses with a TTL per entry.
+
+    Expired entries are not dropped straight away: if they carry an ETag
+    the caller can revalidate them with If-None-Match and keep the body on
+    a 304. Keys are "<upstream>:<path>?<query>" strings so a write can
+    invalidate everything under a path prefix.
+
+    A read still in flight when its key is invalidated would put back the
+    body from before the write. Callers take the key's ``generation``
+    before fetching and pass it to ``put``, which does not store the body
+    if the key has been invalidated since.
+    """
+
+    def __init__(self, max_entries: int = 1024, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # prefix -> generation of its last invalidation; writes use a handful of fixed prefixes
+        self._invalidated: Dict[str, int] = {}
+        self._generation = 0
+        # Body bytes not fetched from upstream / not sent to clients thanks to the cache
+        self.upstream_bytes_saved = 0
+        self.client_bytes_saved = 0
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        """The entry for ``key``, fresh or expired, or None"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def is_fresh(self, entry: CachedResponse) -> bool:
+        return entry.expires_at > self.clock()
+
+    def generation(self, key: str) -> int:
+        """Generation of the last invalidation that covered ``key``, 0 if none did"""
+        return max((generation for prefix, generation in self._invalidated.items() if key.startswith(prefix)),
+                   default=0)
+
+    def put(self, key: str, status_code: int, body: bytes, media_type: Optional[str],
+            etag: Optional[str], ttl: float, generation: Optional[int] = None) -> CachedResponse:
+        """Cache a response; with ``generation``, only if ``key`` has not been invalidated since it was taken"""
+        entry = CachedResponse(status_code, body, media_type, etag, self.clock() + ttl)
+        if generation is not None and self.generation(key) != generation:
+            return entry
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def refresh(self, entry: CachedResponse, ttl: float):
+        """Extend an entry after upstream confirmed it with a 304"""
+        entry.expires_at = self.clock() + ttl
+
+    def record_hit(self, entry: CachedResponse, revalidated: bool = False):
+        self.hits += 1
+        self.revalidations += revalidated
+        self.upstream_bytes_saved += len(entry.body)
+
+    def record_miss(self):
+        self.misses += 1
+
+    def record_not_modified(self, entry: CachedResponse):
+        """A client's own If-None-Match matched, so the body was not sent"""
+        self.client_bytes_saved += len(entry.body)
+
+    def invalidate(self, prefix: str = ""):
+        """Drop every entry whose key starts with ``prefix`` (everything by default)"""
+        self._generation += 1
+        self._invalidated[prefix] = self._generation
+        stale = [key for key in self._entries if key.startswith(prefix)]
+        for key in stale:
+            del self._entries[key]
+        self.invalidations += len(stale)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "revalidations": self.revalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "upstream_bytes_saved": self.upstream_bytes_saved,
+            "client_bytes_saved": self.client_bytes_saved,
+        }
@@ -0,0 +1,119 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+@pytest.fixture(scope="module")
+def breakers(service_module):
+    return service_module("api-gateway", "circuit_breaker")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_opens_after_consecutive_failures(breakers):
+    clock = Clock()
+    breaker = breakers.CircuitBreaker("svc", failure_threshold=3, reset_timeout=10.0, clock=clock)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure("status 500")
+    breaker.before_call()
+    breaker.record_success(0.01)
+    for _ in range(3):
+        breaker.before_call()
+        breaker.record_failure("status 500")
+    assert breaker.state == breakers.OPEN
+    with pytest.raises(breakers.CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == pytest.approx(10.0)
+    assert breaker.rejected == 1
+
+
+def test_half_open_lets_one_probe_through(breakers):
+    clock = Clock()
+    breaker = breakers.CircuitBreaker("svc", failure_threshold=1, reset_timeout=10.0, clock=clock)
+    breaker.before_call()
+    breaker.record_failure("status 503")
+    clock.now = 10.0
+    breaker.before_call()
+    assert breaker.state == breakers.HALF_OPEN
+    with pytest.raises(breakers.CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success(0.01)
+    assert breaker.state == breakers.CLOSED
+    breaker.before_call()
+
+
+def test_failed_probe_opens_the_circuit_again(breakers):
+    clock = Clock()
+    breaker = breakers.CircuitBreaker("svc", failure_threshold=5, reset_timeout=10.0, clock=clock)
+    breaker.trip("health check")
+    clock.now = 11.0
+    breaker.before_call()
+    breaker.record_failure("status 500")
+    assert breaker.state == breakers.OPEN
+    assert breaker.opened_at == 11.0
+
+
+def test_timeouts_are_learned_per_route(breakers):
+    breaker = breakers.CircuitBreaker("svc", max_timeout=5.0, min_timeout=0.1, timeout_multiplier=2.0,
+                                      min_samples=20, route_timeouts={"POST /users/login": 8.0})
+    for _ in range(20):
+        breaker.record_success(0.2, "GET /users/{user_id}")
+        breaker.record_success(3.0, "POST /users/login")
+    assert breaker.timeout("GET /users/{user_id}") == pytest.approx(0.4)
+    assert breaker.timeout("POST /users/login") == pytest.approx(6.0)
+    assert breaker.timeout("GET /unseen") == 5.0
+
+
+def test_timeout_backs_off_after_a_timed_out_call(breakers):
+    window = breakers.LatencyWindow(max_timeout=5.0, min_timeout=0.1, multiplier=2.0, window=20, min_samples=10)
+    for _ in range(20):
+        window.record(0.1)
+    assert window.timeout() == pytest.approx(0.2)
+    window.record_timeout()
+    assert window.timeout() == 5.0
+
+
+def test_transport_records_upstream_errors(breakers):
+    def handler(request):
+        return httpx.Response(500 if request.url.path == "/fail" else 200)
+
+    async def scenario():
+        breaker = breakers.CircuitBreaker("svc", failure_threshold=2)
+        seen = []
+        transport = breakers.BreakerTransport(httpx.MockTransport(handler), breaker,
+                                              lambda status, latency: seen.append(status))
+        async with httpx.AsyncClient(transport=transport, base_url="http://svc") as client:
+            assert (await client.get("/ok")).status_code == 200
+            await client.get("/fail")
+            await client.get("/fail")
+            with pytest.raises(breakers.CircuitOpenError):
+                await client.get("/ok")
+        return seen
+
+    assert asyncio.run(scenario()) == ["200", "500", "500"]
+
+
+def test_transport_times_out_on_the_learned_deadline(breakers):
+    async def slow(request):
+        await asyncio.sleep(1.0)
+        return httpx.Response(200)
+
+    async def scenario():
+        breaker = breakers.CircuitBreaker("svc", max_timeout=0.05)
+        transport = breakers.BreakerTransport(httpx.MockTransport(slow), breaker)
+        async with httpx.AsyncClient(transport=transport, base_url="http://svc") as client:
+            with pytest.raises(httpx.ReadTimeout):
+                await client.get("/slow", extensions={"route": "/slow"})
+        return breaker
+
+    breaker = asyncio.run(scenario())
+    assert breaker.routes["GET /slow"].timeouts == 1
+    assert breaker.consecutive_failures == 1
@@ -0,0 +1,76 @@
+import asyncio
+
+import httpx
+import pytest
+from starlette.requests import Request
+
+
+@pytest.fixture(scope="module")
+def gateway(service_module):
+    return service_module("api-gateway", "main")
+
+
+class Route:
+    path = "/buses"
+
+
+class SlowUpstream:
+    """Bus service stand-in whose GETs wait until ``release`` is set"""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = 0
+        self.body = b'[{"bus_id": "old"}]'
+
+    async def get(self, path, **kwargs):
+        self.calls += 1
+        body = self.body
+        await self.release.wait()
+        return httpx.Response(200, content=body, headers={"content-type": "application/json"})
+
+    async def called(self, times: int):
+        while self.calls < times:
+            await asyncio.sleep(0)
+
+
+def get_buses() -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/buses", "query_string": b"", "headers": [],
+                    "route": Route()})
+
+
+def test_put_is_skipped_after_an_invalidation(gateway):
+    cache = gateway.ResponseCache()
+    generation = cache.generation("bus_service:/buses?")
+    cache.invalidate("bus_service:/buses")
+    cache.put("bus_service:/buses?", 200, b"old", None, None, 10, generation)
+    assert cache.get("bus_service:/buses?") is None
+    cache.put("bus_service:/buses?", 200, b"new", None, None, 10, cache.generation("bus_service:/buses?"))
+    assert cache.get("bus_service:/buses?").body == b"new"
+    # Invalidating another prefix leaves the generation alone
+    generation = cache.generation("bus_service:/buses?")
+    cache.invalidate("user_service:/users")
+    assert cache.generation("bus_service:/buses?") == generation
+
+
+def test_read_in_flight_during_a_write_is_not_cached(gateway, monkeypatch):
+    upstream = SlowUpstream()
+    monkeypatch.setattr(gateway, "upstreams", {"bus_service": upstream})
+    monkeypatch.setattr(gateway, "cache", gateway.ResponseCache())
+
+    async def scenario():
+        before = asyncio.ensure_future(gateway.get_buses(get_buses()))
+        await upstream.called(1)
+        # A bus is added while the first read is waiting on bus-service
+        upstream.body = b'[{"bus_id": "old"}, {"bus_id": "new"}]'
+        gateway.cache.invalidate("bus_service:/buses")
+        after = asyncio.ensure_future(gateway.get_buses(get_buses()))
+        # The read that started after the write does not join the earlier call
+        await asyncio.wait_for(upstream.called(2), 1)
+        upstream.release.set()
+        stale, fresh = await before, await after
+        cached = await gateway.get_buses(get_buses())
+        return stale.body, fresh.body, cached.body
+
+    stale, fresh, cached = asyncio.run(scenario())
+    assert b"new" not in stale
+    assert b"new" in fresh and cached == fresh
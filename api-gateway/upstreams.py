@@ -0,0 +1,104 @@
+#pooled http clients for the gateway's upstream services
+import os
+from functools import partial
+from typing import Dict, Optional
+
+import httpx
+
+from buscommon.metrics import Metrics
+
+from circuit_breaker import BreakerTransport, CircuitBreaker
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+# Connection pool settings shared by every upstream
+MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+KEEPALIVE_EXPIRY = _env_float("UPSTREAM_KEEPALIVE_EXPIRY", 30.0)
+# HTTP/2 is negotiated over TLS only, so it matters for https:// upstreams
+HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+CONNECT_TIMEOUT = _env_float("UPSTREAM_CONNECT_TIMEOUT", 2.0)
+DEFAULT_TIMEOUT = _env_float("UPSTREAM_TIMEOUT", 5.0)
+# Circuit breaker settings shared by every upstream
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_TIMEOUT = _env_float("BREAKER_RESET_TIMEOUT", 10.0)
+# The adaptive timeout is this multiple of a route's observed p99, but no less than the floor
+ADAPTIVE_TIMEOUT_MULTIPLIER = _env_float("ADAPTIVE_TIMEOUT_MULTIPLIER", 3.0)
+ADAPTIVE_TIMEOUT_FLOOR = _env_float("ADAPTIVE_TIMEOUT_FLOOR", 1.0)
+
+
+def _route_timeouts(value: str) -> Dict[str, float]:
+    """``"POST /users/login=10,GET /bookings=30"`` as {route: seconds}"""
+    timeouts = {}
+    for item in value.split(","):
+        route, _, seconds = item.strip().rpartition("=")
+        if route:
+            timeouts[" ".join(route.split())] = float(seconds)
+    return timeouts
+
+
+# Static timeout caps of single gateway routes, overriding their upstream's
+ROUTE_TIMEOUTS = _route_timeouts(os.getenv("UPSTREAM_ROUTE_TIMEOUTS", ""))
+
+
+class Upstreams:
+    """One long-lived ``httpx.AsyncClient`` per upstream service.
+
+    Clients are created at startup and closed at shutdown, so requests
+    reuse kept-alive connections instead of paying for a new pool and TCP
+    handshake on every call. Each client has its upstream as ``base_url``,
+    so handlers pass paths only.
+
+    Every client sends through a CircuitBreaker for its upstream, which
+    fails calls fast while the upstream is unhealthy and times each route
+    out based on the latency seen on it so far; the configured timeout,
+    or the route's entry in ROUTE_TIMEOUTS, is the ceiling. With ``metrics`` set, every call's latency to response
+    headers is recorded per upstream and status.
+    """
+
+    def __init__(self, metrics: Optional[Metrics] = None):
+        self.metrics = metrics
+        self._settings: Dict[str, tuple] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def register(self, name: str, base_url: str, timeout: Optional[float] = None):
+        """Declare an upstream; its read/write timeout can be overridden with ``<NAME>_TIMEOUT``"""
+        env_name = name.upper().replace("-", "_") + "_TIMEOUT"
+        timeout = _env_float(env_name, DEFAULT_TIMEOUT if timeout is None else timeout)
+        self._settings[name] = (base_url, timeout)
+        self.breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=BREAKER_FAILURE_THRESHOLD,
+            reset_timeout=BREAKER_RESET_TIMEOUT,
+            max_timeout=timeout,
+            min_timeout=ADAPTIVE_TIMEOUT_FLOOR,
+            timeout_multiplier=ADAPTIVE_TIMEOUT_MULTIPLIER,
+            route_timeouts=ROUTE_TIMEOUTS,
+        )
+
+    async def open(self):
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        for name, (base_url, timeout) in self._settings.items():
+            transport = httpx.AsyncHTTPTransport(limits=limits, http2=HTTP2)
+            observe = partial(self.metrics.observe_upstream, name) if self.metrics is not None else None
+            self._clients[name] = httpx.AsyncClient(
+                base_url=base_url,
+                transport=BreakerTransport(transport, self.breakers[name], observe),
+                timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+            )
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def __getitem__(self, name: str) -> httpx.AsyncClient:
+        return self._clients[name]
@@ -0,0 +1,45 @@
+#helpers shared by the benchmark scripts
+import importlib.util
+import os
+import secrets
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Services refuse to issue or verify session tokens without a secret; benchmarks use a throwaway one
+os.environ.setdefault("AUTH_TOKEN_SECRET", secrets.token_hex(32))
+
+
+def load_service(directory: str, module_name: str = None):
+    """Import ``<directory>/main.py`` as a standalone module.
+
+    Service folders are not packages (and most have dashes in their names),
+    so each one is loaded from its path with its own folder on ``sys.path``.
+    Sibling helper modules are dropped from ``sys.modules`` afterwards so two
+    services can ship a module with the same file name.
+    """
+    service_dir = os.path.join(ROOT, directory)
+    module_name = module_name or directory.replace("-", "_")
+    before = set(sys.modules)
+    sys.path.insert(0, service_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(service_dir, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(service_dir)
+        for name in set(sys.modules) - before - {module_name}:
+            path = getattr(sys.modules[name], "__file__", None) or ""
+            if os.path.dirname(os.path.abspath(path)) == service_dir:
+                del sys.modules[name]
+    return module
+
+
+def percentile(samples, pct: float) -> float:
+    """Nearest-rank percentile of an unsorted list of samples"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
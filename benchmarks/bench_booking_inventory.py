@@ -0,0 +1,81 @@
+"""POST /bookings latency in booking-service as the store grows.
+
+Prefills the service with 1k .. 1M bookings and times fresh bookings
+through the ASGI app, which should stay flat now that the seat-conflict
+check is a bitmap lookup rather than a scan of every booking.
+
+    python benchmarks/bench_booking_inventory.py [--requests 2000]
+"""
+import argparse
+import asyncio
+import gc
+import os
+import time
+from datetime import date, timedelta
+
+import httpx
+
+from _service import load_service, percentile
+
+SIZES = [1_000, 10_000, 100_000, 1_000_000]
+SEATS_PER_BUS = 40
+DAYS = 90
+
+
+async def prefill(service, count: int):
+    store = service.store = service.open_store("memory://")
+    start = date(2024, 1, 1)
+    per_bus = SEATS_PER_BUS * DAYS
+    for i in range(count):
+        bus, rest = divmod(i, per_bus)
+        day, seat = divmod(rest, SEATS_PER_BUS)
+        await store.reserve([{
+            "user_id": f"user{i}",
+            "bus_id": f"bus{bus}",
+            "seat_number": seat + 1,
+            "journey_date": start + timedelta(days=day),
+            "agent_id": None,
+        }])
+
+
+async def measure(service, requests: int):
+    transport = httpx.ASGITransport(app=service.app)
+    latencies = []
+    async with httpx.AsyncClient(transport=transport, base_url="http://booking-service") as client:
+        for i in range(requests):
+            payload = {
+                "user_id": "bench",
+                "bus_id": f"fresh{i // SEATS_PER_BUS}",
+                "seat_number": i % SEATS_PER_BUS + 1,
+                "journey_date": "2024-06-01",
+            }
+            started = time.perf_counter()
+            response = await client.post("/bookings", json=payload)
+            latencies.append((time.perf_counter() - started) * 1000)
+            assert response.status_code == 200, response.text
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+    # The buses are made up, so there is no bus-service to check seat numbers against
+    os.environ["BUS_SERVICE_URL"] = ""
+
+    service = load_service("booking-service")
+    print(f"{'existing':>10} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+    for size in SIZES:
+        asyncio.run(prefill(service, size))
+        # Keep full collections of the prefilled store out of the timings
+        gc.collect()
+        gc.freeze()
+        latencies = asyncio.run(measure(service, args.requests))
+        total = sum(latencies) / 1000
+        print(f"{size:>10} {percentile(latencies, 50):8.3f} {percentile(latencies, 99):8.3f} "
+              f"{args.requests / total:8.0f}")
+        gc.unfreeze()
+
+
+if __name__ == "__main__":
+    main()
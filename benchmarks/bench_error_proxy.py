@@ -0,0 +1,93 @@
+"""Throughput of the error handling service's /proxy endpoint.
+
+Starts bus-service under uvicorn on a local port, then drives POST /proxy
+through the error_handling app in-process, once with the upstream response
+wrapped in the JSON envelope and once streamed through. The "direct" row
+calls bus-service with a pooled client and no proxy, as the baseline. On
+a single core the upstream competes with the proxy for CPU, so the "stub"
+row answers from memory instead of bus-service to show what the proxy
+itself sustains.
+
+    python benchmarks/bench_error_proxy.py [--requests 5000] [--concurrency 50] [--path /buses]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+from _service import load_service, percentile
+from bench_gateway_pool import free_port, start_upstream
+
+
+class StubUpstream(httpx.AsyncBaseTransport):
+    """Answers every request with the same small JSON body"""
+
+    async def handle_async_request(self, request):
+        return httpx.Response(200, content=b'[{"bus_id": "1"}]', headers={"content-type": "application/json"})
+
+
+async def drive(send, requests: int, concurrency: int):
+    latencies = []
+
+    async def worker(worker_id: int):
+        for _ in range(worker_id, requests, concurrency):
+            started = time.perf_counter()
+            response = await send()
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, response.text
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    return latencies, time.perf_counter() - started
+
+
+async def run(upstream_url: str, path: str, requests: int, concurrency: int):
+    results = {}
+    async with httpx.AsyncClient(base_url=upstream_url) as client:
+        results["direct"] = await drive(lambda: client.get(path), requests, concurrency)
+
+    service = load_service("error_handling")
+    service.service_registry.clear()
+    service.service_registry["bus-service"] = upstream_url
+    await service.app.router.startup()
+    await service.scheduler.stop()
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for stream in (False, True):
+            body = {"target_service": "bus-service", "endpoint": path, "method": "GET", "stream": stream}
+            results["proxy stream" if stream else "proxy"] = await drive(
+                lambda: client.post("/proxy", json=body), requests, concurrency)
+        await service.service_proxy.close_client("bus-service")
+        service.service_proxy.client("bus-service")
+        service.service_proxy._clients["bus-service"] = httpx.AsyncClient(transport=StubUpstream())
+        body = {"target_service": "bus-service", "endpoint": path, "method": "GET"}
+        results["proxy stub"] = await drive(lambda: client.post("/proxy", json=body), requests, concurrency)
+    await service.app.router.shutdown()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--path", default="/buses")
+    args = parser.parse_args()
+
+    port = free_port()
+    upstream = start_upstream(port)
+    os.environ["ERROR_HISTORY_SIZE"] = "1000"
+    try:
+        results = asyncio.run(run(f"http://127.0.0.1:{port}", args.path, args.requests, args.concurrency))
+        print(f"{'mode':>12} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+        for mode, (latencies, elapsed) in results.items():
+            print(f"{mode:>12} {percentile(latencies, 50) * 1000:8.2f} {percentile(latencies, 99) * 1000:8.2f} "
+                  f"{args.requests / elapsed:8.0f}")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Gateway latency with a new upstream client per request versus pooled clients.
+
+Starts bus-service under uvicorn on a local port, then drives GET /buses
+through the api-gateway app in-process. The "per-request" run swaps the
+gateway's pooled clients for ones that open (and tear down) a fresh
+connection on every call, which is how the gateway used to work.
+
+    python benchmarks/bench_gateway_pool.py [--requests 2000] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from _service import ROOT, load_service, percentile
+
+
+class PerRequestClient:
+    """Stand-in for a pooled client that opens a new AsyncClient for each call"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    async def get(self, path: str, **kwargs):
+        async with httpx.AsyncClient(base_url=self.base_url) as client:
+            return await client.get(path, **kwargs)
+
+    async def aclose(self):
+        pass
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_upstream(port: int) -> subprocess.Popen:
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.join(ROOT, "bus-service"),
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/")
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("bus-service did not start")
+
+
+async def run(gateway, requests: int, concurrency: int, pooled: bool):
+    await gateway.app.router.startup()
+    if not pooled:
+        gateway.upstreams._clients["bus_service"] = PerRequestClient(gateway.BUS_SERVICE_URL)
+    latencies = []
+    transport = httpx.ASGITransport(app=gateway.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker(worker_id: int):
+            for _ in range(worker_id, requests, concurrency):
+                started = time.perf_counter()
+                response = await client.get("/buses")
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    await gateway.app.router.shutdown()
+    return latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    port = free_port()
+    upstream = start_upstream(port)
+    os.environ["BUS_SERVICE_URL"] = f"http://127.0.0.1:{port}"
+    try:
+        print(f"{'clients':>12} {'p50 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+        for pooled in (False, True):
+            gateway = load_service("api-gateway")
+            latencies, elapsed = asyncio.run(run(gateway, args.requests, args.concurrency, pooled))
+            print(f"{'pooled' if pooled else 'per-request':>12} {percentile(latencies, 50) * 1000:8.2f} "
+                  f"{percentile(latencies, 99) * 1000:8.2f} {args.requests / elapsed:8.0f}")
+    finally:
+        upstream.terminate()
+        upstream.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""Cost of releasing expired seat holds with the timing wheel versus a full scan.
+
+Schedules --holds holds with deadlines spread evenly over --ttl seconds
+into bus-booking's TimingWheel, then steps the clock one tick at a time
+and times each ``advance``. A full scan of the same deadlines per tick,
+which is what a periodic sweep over all bookings costs, is timed
+alongside. Scheduling and cancelling (what a confirm does) are timed per
+hold.
+
+    python benchmarks/bench_holds.py [--holds 1000000] [--ttl 600] [--tick 1] [--ticks 30]
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import time
+
+from _service import ROOT, percentile
+
+sys.path.insert(0, os.path.join(ROOT, "bus-booking"))
+from timing_wheel import TimingWheel  # noqa: E402
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--holds", type=int, default=1_000_000)
+    parser.add_argument("--ttl", type=float, default=600)
+    parser.add_argument("--tick", type=float, default=1)
+    parser.add_argument("--slots", type=int, default=4096)
+    parser.add_argument("--ticks", type=int, default=30, help="ticks to step through")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = 1_000_000.0
+    deadlines = {f"hold{i}": start + random.uniform(0, args.ttl) for i in range(args.holds)}
+
+    before = rss_mb()
+    wheel = TimingWheel(tick=args.tick, slots=args.slots, now=start)
+    started = time.perf_counter()
+    for key, deadline in deadlines.items():
+        wheel.schedule(key, deadline)
+    schedule_us = (time.perf_counter() - started) / args.holds * 1e6
+    print(f"{args.holds} holds over {args.ttl:.0f}s, {args.slots} slots of {args.tick}s")
+    print(f"schedule: {schedule_us:.2f} us/hold, wheel grew max RSS by {rss_mb() - before:.0f} MB")
+
+    wheel_times, scan_times, released = [], [], 0
+    now = start
+    for _ in range(args.ticks):
+        now += args.tick
+        started = time.perf_counter()
+        expired = wheel.advance(now)
+        wheel_times.append(time.perf_counter() - started)
+        released += len(expired)
+
+        started = time.perf_counter()
+        scanned = [key for key, deadline in deadlines.items() if deadline <= now]
+        scan_times.append(time.perf_counter() - started)
+        for key in scanned:
+            del deadlines[key]
+        assert sorted(expired) == sorted(scanned)
+
+    print(f"released {released} holds in {args.ticks} ticks, {len(wheel)} still outstanding")
+    print(f"{'sweep':>12} {'p50 ms':>8} {'p99 ms':>8} {'us/released':>12}")
+    for name, times in (("timing wheel", wheel_times), ("full scan", scan_times)):
+        print(f"{name:>12} {percentile(times, 50) * 1000:8.3f} {percentile(times, 99) * 1000:8.3f} "
+              f"{sum(times) / max(released, 1) * 1e6:12.2f}")
+
+    keys = random.sample(list(deadlines), min(100_000, len(deadlines)))
+    started = time.perf_counter()
+    for key in keys:
+        wheel.cancel(key)
+    print(f"cancel: {(time.perf_counter() - started) / len(keys) * 1e6:.2f} us/hold")
+
+
+if __name__ == "__main__":
+    main()
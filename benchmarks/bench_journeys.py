@@ -0,0 +1,58 @@
+"""Journey planner query latency over a large synthetic timetable.
+
+Builds --trips random daily bus runs between --cities cities through the
+planner that bus-service keeps, then times random k-best queries for each
+sort order.
+
+    python benchmarks/bench_journeys.py [--trips 20000] [--cities 200] [--queries 500]
+"""
+import argparse
+import random
+import time
+
+from _service import load_service, percentile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trips", type=int, default=20000)
+    parser.add_argument("--cities", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--k", type=int, default=3)
+    args = parser.parse_args()
+
+    service = load_service("bus-service")
+    planner = service.planner
+    rng = random.Random(42)
+    cities = [f"City{i}" for i in range(args.cities)]
+    started = time.perf_counter()
+    for i in range(args.trips):
+        source, destination = rng.sample(cities, 2)
+        departure = rng.randrange(24 * 60)
+        arrival = (departure + rng.randrange(60, 12 * 60)) % (24 * 60)
+        planner.add({
+            "bus_id": f"bus{i}",
+            "bus_number": f"B{i}",
+            "source": source,
+            "destination": destination,
+            "departure_time": f"{departure // 60:02d}:{departure % 60:02d}",
+            "arrival_time": f"{arrival // 60:02d}:{arrival % 60:02d}",
+            "price": float(rng.randrange(100, 2000)),
+        })
+    print(f"graph built: {args.trips} trips in {time.perf_counter() - started:.2f}s")
+
+    print(f"{'sort_by':>10} {'p50 ms':>8} {'p99 ms':>8} {'found':>6}")
+    for sort_by in ("arrival", "price", "transfers"):
+        latencies, found = [], 0
+        for _ in range(args.queries):
+            source, destination = rng.sample(cities, 2)
+            started = time.perf_counter()
+            itineraries = planner.plan(source, destination, rng.randrange(24 * 60), args.k, sort_by)
+            latencies.append(time.perf_counter() - started)
+            found += bool(itineraries)
+        print(f"{sort_by:>10} {percentile(latencies, 50) * 1000:8.2f} {percentile(latencies, 99) * 1000:8.2f} "
+              f"{found / args.queries:6.0%}")
+
+
+if __name__ == "__main__":
+    main()
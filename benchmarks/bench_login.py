@@ -0,0 +1,74 @@
+"""Login throughput of user-service per password hashing scheme.
+
+Registers --users users directly in the store, then runs concurrent
+POST /users/login in-process while a probe keeps calling GET /. The probe
+latency shows whether hashing holds up the event loop: with the hash on a
+worker pool it stays near zero even for the slow schemes.
+
+    python benchmarks/bench_login.py [--users 10000] [--logins 500] [--concurrency 50]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+import httpx
+
+from _service import load_service, percentile
+
+
+async def run(service, users: int, logins: int, concurrency: int):
+    await service.app.router.startup()
+    encoded = await service.hash_password("secret")
+    for i in range(users):
+        await service.store.create({
+            "user_id": f"id{i}", "username": f"user{i}", "email": f"user{i}@example.com",
+            "password": encoded, "full_name": "Bench User", "phone_number": "0",
+        })
+
+    latencies, probes = [], []
+    done = asyncio.Event()
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker(worker_id: int):
+            for i in range(worker_id, logins, concurrency):
+                started = time.perf_counter()
+                response = await client.post("/users/login", json={"username": f"user{i % users}", "password": "secret"})
+                latencies.append(time.perf_counter() - started)
+                assert response.status_code == 200, response.text
+
+        async def probe():
+            while not done.is_set():
+                started = time.perf_counter()
+                await client.get("/")
+                probes.append(time.perf_counter() - started)
+                await asyncio.sleep(0.01)
+
+        probe_task = asyncio.create_task(probe())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await probe_task
+    await service.app.router.shutdown()
+    return latencies, probes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--logins", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'scheme':>8} {'logins/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'probe p99 ms':>13}")
+    for scheme in ("sha256", "pbkdf2", "scrypt"):
+        os.environ["PASSWORD_HASH"] = scheme
+        service = load_service("user-service")
+        latencies, probes, elapsed = asyncio.run(run(service, args.users, args.logins, args.concurrency))
+        print(f"{scheme:>8} {args.logins / elapsed:9.0f} {percentile(latencies, 50) * 1000:8.2f} "
+              f"{percentile(latencies, 99) * 1000:8.2f} {percentile(probes, 99) * 1000:13.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Per-request overhead of the metrics middleware.
+
+Calls bus-service's ASGI app directly (no HTTP client or server in the
+way) with a raw GET of a cheap route, once as shipped and once with the
+metrics middleware taken out of the stack, and reports the difference in
+microseconds per request.
+
+    python benchmarks/bench_metrics.py [--requests 20000] [--path /buses] [--rounds 5]
+"""
+import argparse
+import asyncio
+import time
+
+from _service import load_service
+
+
+async def call(app, path: str):
+    sent = []
+    request = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if request:
+            return request.pop()
+        # Nothing more to read; wait like a connected client would
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "root_path": "", "headers": [(b"host", b"bench")], "server": ("bench", 80), "client": ("bench", 1),
+    }
+    await app(scope, receive, send)
+    assert sent[0]["status"] == 200, sent
+
+
+async def time_requests(app, path: str, requests: int) -> float:
+    started = time.perf_counter()
+    for _ in range(requests):
+        await call(app, path)
+    return (time.perf_counter() - started) / requests
+
+
+def without_metrics(app):
+    app.user_middleware = [m for m in app.user_middleware if m.cls.__name__ != "MetricsMiddleware"]
+    app.middleware_stack = app.build_middleware_stack()
+
+
+async def run(path: str, requests: int, rounds: int):
+    instrumented = load_service("bus-service", "bench_metrics_on")
+    bare = load_service("bus-service", "bench_metrics_off")
+    without_metrics(bare.app)
+    for service in (instrumented, bare):
+        await service.app.router.startup()
+        await time_requests(service.app, path, 500)
+    # Interleave the runs so drift in machine load affects both alike
+    best = {"with metrics": float("inf"), "without": float("inf")}
+    for _ in range(rounds):
+        best["with metrics"] = min(best["with metrics"], await time_requests(instrumented.app, path, requests))
+        best["without"] = min(best["without"], await time_requests(bare.app, path, requests))
+    for service in (instrumented, bare):
+        await service.app.router.shutdown()
+    return best, instrumented.metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--path", default="/buses")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    best, metrics = asyncio.run(run(args.path, args.requests, args.rounds))
+    print(f"{'run':>14} {'us/request':>11}")
+    for name, seconds in best.items():
+        print(f"{name:>14} {seconds * 1e6:11.1f}")
+    print(f"{'overhead':>14} {(best['with metrics'] - best['without']) * 1e6:11.1f}")
+    print(f"series recorded: {len(metrics.requests)}")
+
+
+if __name__ == "__main__":
+    main()
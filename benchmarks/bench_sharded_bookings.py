@@ -0,0 +1,129 @@
+"""Booking throughput of booking-service in one process versus sharded across processes.
+
+Starts booking-service on a local port, first as a single uvicorn process
+with the memory store, then through shards.py with --shards shard
+processes and --workers uvicorn workers. --clients load processes each
+send their share of POST /bookings over many buses, with every seat
+requested twice, and the run checks that no seat ended up booked twice.
+Throughput only scales when the machine has cores to spare for the
+workers, the shards and the load processes.
+
+    python benchmarks/bench_sharded_bookings.py [--requests 20000] [--shards 4] [--workers 4] [--clients 4]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from _service import ROOT, percentile
+from bench_gateway_pool import free_port
+
+SERVICE_DIR = os.path.join(ROOT, "booking-service")
+
+
+def start(command: list, port: int) -> subprocess.Popen:
+    process = subprocess.Popen(command, cwd=SERVICE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/")
+            return process
+        except httpx.TransportError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("booking-service did not start")
+
+
+def booking(i: int, requests: int) -> dict:
+    # Every seat is asked for twice, by requests i and i + requests // 2
+    seat = i % (requests // 2)
+    return {
+        "user_id": f"user{i}",
+        "bus_id": f"bus{seat // 40}",
+        "seat_number": seat % 40 + 1,
+        "journey_date": "2024-06-01",
+    }
+
+
+def load(port: int, indexes: range, requests: int, concurrency: int, results):
+    async def run():
+        latencies, statuses = [], Counter()
+        limits = httpx.Limits(max_connections=concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits) as client:
+            async def worker(offset: int):
+                for i in indexes[offset::concurrency]:
+                    started = time.perf_counter()
+                    response = await client.post("/bookings", json=booking(i, requests))
+                    latencies.append(time.perf_counter() - started)
+                    statuses[response.status_code] += 1
+            await asyncio.gather(*(worker(offset) for offset in range(concurrency)))
+        return latencies, statuses
+    results.put(asyncio.run(run()))
+
+
+def measure(port: int, requests: int, clients: int, concurrency: int):
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=load, args=(port, range(c, requests, clients), requests, concurrency, results))
+        for c in range(clients)
+    ]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    latencies = [latency for run, _ in outcomes for latency in run]
+    statuses = sum((counts for _, counts in outcomes), Counter())
+
+    listed = httpx.get(f"http://127.0.0.1:{port}/bookings", timeout=60).json()
+    seats = Counter((b["bus_id"], b["journey_date"], b["seat_number"]) for b in listed)
+    double_booked = sum(1 for count in seats.values() if count > 1)
+    return latencies, statuses, elapsed, len(listed), double_booked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=4, help="load generating processes")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent requests per load process")
+    args = parser.parse_args()
+    # The buses are made up, so there is no bus-service to check seat numbers against
+    os.environ["BUS_SERVICE_URL"] = ""
+
+    socket_dir = tempfile.mkdtemp(prefix="booking-shards-")
+    setups = {
+        "single": [sys.executable, "-m", "uvicorn", "main:app", "--log-level", "warning"],
+        f"{args.shards} shards x {args.workers} workers": [
+            sys.executable, "shards.py", "--shards", str(args.shards), "--workers", str(args.workers),
+            "--socket-dir", socket_dir,
+        ],
+    }
+    print(f"{os.cpu_count()} cpus")
+    print(f"{'setup':>24} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'booked':>7} {'double':>7}")
+    for name, command in setups.items():
+        port = free_port()
+        process = start(command + ["--port", str(port)], port)
+        try:
+            latencies, statuses, elapsed, booked, double_booked = measure(
+                port, args.requests, args.clients, args.concurrency)
+        finally:
+            process.terminate()
+            process.wait()
+        assert statuses[200] == booked, statuses
+        print(f"{name:>24} {args.requests / elapsed:8.0f} {percentile(latencies, 50) * 1000:8.2f} "
+              f"{percentile(latencies, 99) * 1000:8.2f} {booked:7d} {double_booked:7d}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Cost of serving GET /buses from the versioned snapshot, by how the client asks.
+
+Fills bus-service's store with --buses buses and calls its ASGI app
+directly, the way bench_metrics.py does. Each read is timed four ways:
+after a write, so the snapshot is rebuilt as every read used to be
+encoded; from the cached body as is; from the cached gzip body; and with
+the current ETag in If-None-Match, which gets a bodyless 304.
+
+    python benchmarks/bench_snapshots.py [--buses 2000] [--requests 2000] [--storage memory://]
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from _service import load_service
+
+
+async def call(app, headers: dict) -> dict:
+    sent = []
+    request = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if request:
+            return request.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": "/buses", "raw_path": b"/buses", "query_string": b"",
+        "root_path": "", "server": ("bench", 80), "client": ("bench", 1),
+        "headers": [(b"host", b"bench")] + [(name.encode(), value.encode()) for name, value in headers.items()],
+    }
+    await app(scope, receive, send)
+    response = dict(sent[0]["headers"])
+    response[b"status"] = sent[0]["status"]
+    response[b"size"] = sum(len(message.get("body", b"")) for message in sent[1:])
+    return response
+
+
+async def run(args):
+    os.environ["STORAGE_URL"] = args.storage
+    service = load_service("bus-service", "bench_snapshots")
+    await service.app.router.startup()
+    store = service.store
+    for i in range(args.buses):
+        await store.create_bus({
+            "bus_id": f"bus-{i}", "bus_number": f"KA-{i:05d}", "source": f"City {i % 40}",
+            "destination": f"City {(i * 7 + 1) % 40}", "total_seats": 40, "available_seats": 40,
+            "departure_time": f"{i % 24:02d}:{i % 60:02d}", "arrival_time": f"{(i + 5) % 24:02d}:{i % 60:02d}",
+            "price": 300 + i % 500,
+        })
+
+    runs = {
+        "rebuilt": ({}, True),
+        "cached": ({}, False),
+        "cached gzip": ({"accept-encoding": "gzip"}, False),
+        "not modified": ({"if-none-match": None}, False),
+    }
+    results = {}
+    for name, (headers, write_first) in runs.items():
+        if "if-none-match" in headers:
+            headers["if-none-match"] = (await call(service.app, {}))[b"etag"].decode()
+        elapsed, size, status = 0.0, 0, None
+        for i in range(args.requests):
+            if write_first:
+                await store.set_available_seats(f"bus-{i % args.buses}", i % 40)
+            started = time.perf_counter()
+            response = await call(service.app, headers)
+            elapsed += time.perf_counter() - started
+            size, status = response[b"size"], response[b"status"]
+        results[name] = (elapsed / args.requests, size, status)
+    await service.app.router.shutdown()
+    return results, service.buses_snapshot.builds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--buses", type=int, default=2000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--storage", default="memory://")
+    args = parser.parse_args()
+
+    results, builds = asyncio.run(run(args))
+    print(f"{args.buses} buses, {args.requests} requests per run, {builds} snapshot builds")
+    print(f"{'run':>13} {'status':>6} {'us/request':>11} {'bytes':>9}")
+    for name, (seconds, size, status) in results.items():
+        print(f"{name:>13} {status:>6} {seconds * 1e6:11.1f} {size:9d}")
+
+
+if __name__ == "__main__":
+    main()
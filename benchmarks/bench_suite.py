@@ -0,0 +1,415 @@
+"""In-process load suite for the whole booking flow.
+
+Loads all seven services into one process and wires them together with
+httpx ASGI transports, so no ports, containers or network are needed: the
+gateway's upstream clients and the error handling service's health probes
+go through a transport that hands each request to the app named by its
+host. Every scenario starts from freshly loaded services, seeds them, then
+drives the gateway with --concurrency virtual users:
+
+  browse      search-heavy browsing: route searches, bus pages, the bus list
+              and trip pages
+  contention  every user trying to book seats on the same bus
+  logins      a login storm against a few hundred accounts
+  agent_bulk  logged-in agents booking blocks of seats with batch requests
+
+Each scenario reports req/s, p50/p95/p99, status codes and memory, and the
+whole run is saved as JSON. Pass --compare with the file of an earlier run
+to see the change per scenario.
+
+All services share one interpreter, so run it with the newer stack from
+the gateway's requirements (fastapi 0.104 / pydantic 2). Login cost is
+dominated by password hashing; see PASSWORD_HASH and PBKDF2_ITERATIONS.
+
+    python benchmarks/bench_suite.py [--scale 1.0] [--concurrency 50] [--scenario browse ...]
+                                     [--output FILE] [--compare FILE] [--trace-memory]
+"""
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from importlib import metadata
+
+import httpx
+
+from _service import ROOT, load_service, percentile
+
+# Host name each service is reached at -> its folder
+SERVICES = {
+    "api-gateway": "api-gateway",
+    "bus-booking": "bus-booking",
+    "bus-service": "bus-service",
+    "user-service": "user-service",
+    "agent-service": "agent-service",
+    "booking-service": "booking-service",
+    "error-handling": "error_handling",
+}
+GATEWAY_UPSTREAMS = {
+    "BUS_BOOKING_URL": "http://bus-booking",
+    "BUS_SERVICE_URL": "http://bus-service",
+    "USER_SERVICE_URL": "http://user-service",
+    "AGENT_SERVICE_URL": "http://agent-service",
+    "BOOKING_SERVICE_URL": "http://booking-service",
+}
+# Where the booking services' outboxes deliver seat changes
+BOOKING_EVENTS_URL = "http://bus-service/events/bookings"
+CITIES = [
+    "Bangalore", "Mysore", "Chennai", "Hyderabad", "Mumbai", "Pune", "Goa", "Mangalore",
+    "Coimbatore", "Madurai", "Kochi", "Trivandrum", "Vijayawada", "Hubli", "Belgaum", "Tirupati",
+]
+TRAVEL_DATE = date(2024, 6, 1)
+
+
+class ServiceRouter(httpx.AsyncBaseTransport):
+    """Hands each request to the in-process app named by the request's host"""
+
+    def __init__(self, apps: dict):
+        self.transports = {host: httpx.ASGITransport(app=app) for host, app in apps.items()}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.transports[request.url.host].handle_async_request(request)
+
+
+class System:
+    """Every service loaded fresh and started, with the gateway as the entry point"""
+
+    async def start(self):
+        os.environ.update(GATEWAY_UPSTREAMS, BOOKING_EVENTS_URL=BOOKING_EVENTS_URL)
+        self.services = {host: load_service(directory) for host, directory in SERVICES.items()}
+        router = ServiceRouter({host: service.app for host, service in self.services.items()})
+        for host in ("booking-service", "bus-booking"):
+            self.services[host].outbox.transport = router
+        self.services["booking-service"].bus_seats.transport = router
+        for service in self.services.values():
+            await service.app.router.startup()
+
+        # Keep the gateway's breakers and metrics, swap only the network underneath them
+        for client in self.gateway.upstreams._clients.values():
+            await client._transport.transport.aclose()
+            client._transport.transport = router
+        handling = self.services["error-handling"]
+        await handling.http_client.aclose()
+        handling.http_client = httpx.AsyncClient(transport=router, timeout=handling.REQUEST_TIMEOUT)
+
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=self.gateway.app), base_url="http://api-gateway", timeout=60.0
+        )
+
+    @property
+    def gateway(self):
+        return self.services["api-gateway"]
+
+    async def stop(self):
+        await self.client.aclose()
+        for service in self.services.values():
+            await service.app.router.shutdown()
+        self.services = {}
+
+
+class Recorder:
+    """Latency, status codes and exceptions of every timed request"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+
+    async def request(self, client: httpx.AsyncClient, method: str, url: str, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except Exception as e:
+            self.errors[type(e).__name__] += 1
+            return None
+        finally:
+            self.latencies.append(time.perf_counter() - started)
+        self.statuses[response.status_code] += 1
+        return response
+
+
+async def run_users(step, requests: int, concurrency: int) -> float:
+    """Run ``step(i)`` for i in range(requests) across ``concurrency`` users; the elapsed seconds"""
+    async def user(user_id: int):
+        for i in range(user_id, requests, concurrency):
+            await step(i)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(u) for u in range(concurrency)))
+    return time.perf_counter() - started
+
+
+async def seed_buses(client: httpx.AsyncClient, rng: random.Random, count: int) -> list:
+    buses = []
+    for i in range(count):
+        source, destination = rng.sample(CITIES, 2)
+        departure = rng.randrange(24 * 60)
+        arrival = (departure + rng.randrange(60, 10 * 60)) % (24 * 60)
+        response = await client.post("/buses", json={
+            "bus_number": f"KA{i:04d}",
+            "source": source,
+            "destination": destination,
+            "total_seats": 40,
+            "available_seats": 40,
+            "departure_time": f"{departure // 60:02d}:{departure % 60:02d}",
+            "arrival_time": f"{arrival // 60:02d}:{arrival % 60:02d}",
+            "price": float(rng.randrange(200, 2000)),
+        })
+        response.raise_for_status()
+        buses.append(response.json())
+    return buses
+
+
+async def browse(system: System, recorder: Recorder, rng: random.Random, scale: float, concurrency: int):
+    client = system.client
+    buses = await seed_buses(client, rng, max(1, int(200 * scale)))
+    routes = [(bus["source"], bus["destination"]) for bus in buses]
+
+    async def step(i: int):
+        roll = rng.random()
+        if roll < 0.5:
+            source, destination = rng.choice(routes)
+            await recorder.request(client, "GET", "/buses/search", params={"source": source, "destination": destination})
+        elif roll < 0.75:
+            await recorder.request(client, "GET", f"/buses/{rng.choice(buses)['bus_id']}")
+        elif roll < 0.9:
+            await recorder.request(client, "GET", "/buses")
+        else:
+            journey_date = TRAVEL_DATE + timedelta(days=rng.randrange(7))
+            await recorder.request(client, "GET", f"/trips/{rng.choice(buses)['bus_id']}",
+                                   params={"date": journey_date.isoformat()})
+
+    elapsed = await run_users(step, int(4000 * scale), concurrency)
+    return elapsed, {"buses": len(buses)}
+
+
+async def contention(system: System, recorder: Recorder, rng: random.Random, scale: float, concurrency: int):
+    client = system.client
+    bus, = await seed_buses(client, rng, 1)
+    dates = [(TRAVEL_DATE + timedelta(days=offset)).isoformat() for offset in range(max(1, int(20 * scale)))]
+
+    async def step(i: int):
+        await recorder.request(client, "POST", "/bookings", json={
+            "user_id": f"user{i % 500}",
+            "bus_id": bus["bus_id"],
+            "seat_number": rng.randint(1, bus["total_seats"]),
+            "journey_date": rng.choice(dates),
+        })
+
+    elapsed = await run_users(step, int(3000 * scale), concurrency)
+
+    # The booked seats reach bus-service through the outbox, shortly after the bookings
+    outbox = system.services["booking-service"].outbox
+    started = time.perf_counter()
+    while outbox.pending:
+        await asyncio.sleep(0.01)
+    propagation = time.perf_counter() - started
+    # The gateway does not expose availability, so ask bus-service itself
+    transport = httpx.ASGITransport(app=system.services["bus-service"].app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bus-service") as bus_service:
+        availability = (await bus_service.get("/buses/availability", params={
+            "start_date": min(dates), "end_date": max(dates), "bus_id": bus["bus_id"]})).json()[bus["bus_id"]]
+    # Every seat on every date can be won once; the rest of the attempts are conflicts
+    return elapsed, {
+        "seats_on_offer": bus["total_seats"] * len(dates),
+        "booked": recorder.statuses[200],
+        "booked_in_bus_service": sum(bus["total_seats"] - seats for seats in availability.values()),
+        "event_drain_seconds": round(propagation, 3),
+    }
+
+
+async def logins(system: System, recorder: Recorder, rng: random.Random, scale: float, concurrency: int):
+    client = system.client
+    users = system.services["user-service"]
+    # Accounts go straight into the store with one shared hash, so seeding skips the hashing cost
+    encoded = await users.hash_password("secret")
+    accounts = max(1, int(300 * scale))
+    for i in range(accounts):
+        await users.store.create({
+            "user_id": f"id{i}", "username": f"user{i}", "email": f"user{i}@example.com",
+            "password": encoded, "full_name": "Bench User", "phone_number": "0",
+        })
+
+    async def step(i: int):
+        # One in ten logins has a wrong password
+        password = "wrong" if rng.random() < 0.1 else "secret"
+        await recorder.request(client, "POST", "/users/login",
+                               json={"username": f"user{rng.randrange(accounts)}", "password": password})
+
+    elapsed = await run_users(step, int(200 * scale), concurrency)
+    return elapsed, {"accounts": accounts}
+
+
+async def agent_bulk(system: System, recorder: Recorder, rng: random.Random, scale: float, concurrency: int):
+    client = system.client
+    buses = await seed_buses(client, rng, max(1, int(50 * scale)))
+    tokens = {}
+    for i in range(max(1, int(20 * scale))):
+        username = f"agent{i}"
+        response = await client.post("/agents/register", json={
+            "username": username, "email": f"{username}@example.com", "password": "secret",
+            "full_name": "Bench Agent", "phone_number": "0", "agency_name": "Bench Travels",
+        })
+        response.raise_for_status()
+        response = await client.post("/agents/login", json={"username": username, "password": "secret"})
+        response.raise_for_status()
+        tokens[username] = response.json()["token"]
+    agents = sorted(tokens)
+    block = 10
+
+    async def step(i: int):
+        agent = rng.choice(agents)
+        bus = rng.choice(buses)
+        first = rng.randint(1, bus["total_seats"] - block + 1)
+        journey_date = (TRAVEL_DATE + timedelta(days=rng.randrange(30))).isoformat()
+        await recorder.request(client, "POST", "/bookings/batch", headers={"Authorization": f"Bearer {tokens[agent]}"},
+                               json={"bookings": [
+                                   {"user_id": agent, "bus_id": bus["bus_id"], "seat_number": seat,
+                                    "journey_date": journey_date, "agent_id": agent}
+                                   for seat in range(first, first + block)
+                               ]})
+
+    elapsed = await run_users(step, int(1000 * scale), concurrency)
+    return elapsed, {"agents": len(agents), "seats_per_batch": block, "batches_booked": recorder.statuses[200]}
+
+
+SCENARIOS = {"browse": browse, "contention": contention, "logins": logins, "agent_bulk": agent_bulk}
+
+
+def rss_mb() -> float:
+    """Current resident set size, or the peak where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+async def run_scenario(name: str, scale: float, concurrency: int, seed: int, trace_memory: bool) -> dict:
+    gc.collect()
+    rss_before = rss_mb()
+    if trace_memory:
+        tracemalloc.start()
+    system = System()
+    await system.start()
+    recorder = Recorder()
+    try:
+        elapsed, details = await SCENARIOS[name](system, recorder, random.Random(seed), scale, concurrency)
+    finally:
+        await system.stop()
+    result = {
+        "requests": len(recorder.latencies),
+        "elapsed_s": round(elapsed, 3),
+        "req_per_s": round(len(recorder.latencies) / elapsed, 1),
+        "p50_ms": round(percentile(recorder.latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(recorder.latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(recorder.latencies, 99) * 1000, 2),
+        "statuses": {str(status): count for status, count in sorted(recorder.statuses.items())},
+        "errors": dict(recorder.errors),
+        "rss_mb": round(rss_mb(), 1),
+        "rss_growth_mb": round(rss_mb() - rss_before, 1),
+        **details,
+    }
+    if trace_memory:
+        result["heap_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        tracemalloc.stop()
+    return result
+
+
+def git_revision() -> dict:
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    try:
+        return {"commit": git("rev-parse", "--short", "HEAD"), "dirty": bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except OSError:
+        return {"commit": None, "dirty": None}
+
+
+def versions() -> dict:
+    packages = {}
+    for package in ("fastapi", "starlette", "pydantic", "httpx"):
+        try:
+            packages[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            packages[package] = None
+    return packages
+
+
+def print_results(scenarios: dict):
+    print(f"{'scenario':>12} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MB':>7}  statuses")
+    for name, result in scenarios.items():
+        statuses = " ".join(f"{status}:{count}" for status, count in result["statuses"].items())
+        if result["errors"]:
+            statuses += " " + " ".join(f"{error}:{count}" for error, count in result["errors"].items())
+        print(f"{name:>12} {result['requests']:9d} {result['req_per_s']:8.1f} {result['p50_ms']:8.2f} "
+              f"{result['p95_ms']:8.2f} {result['p99_ms']:8.2f} {result['rss_mb']:7.1f}  {statuses}")
+
+
+def print_comparison(previous: dict, current: dict):
+    print(f"\ncompared with {previous.get('commit')} ({previous.get('timestamp')}):")
+    print(f"{'scenario':>12} {'req/s':>18} {'change':>8} {'p99 ms':>18} {'change':>8}")
+    for name, result in current["scenarios"].items():
+        before = previous.get("scenarios", {}).get(name)
+        if before is None:
+            continue
+
+        def change(key):
+            return (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+        print(f"{name:>12} {before['req_per_s']:8.1f} -> {result['req_per_s']:7.1f} {change('req_per_s'):+7.1f}% "
+              f"{before['p99_ms']:8.2f} -> {result['p99_ms']:7.2f} {change('p99_ms'):+7.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for seed data and request counts")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="results file (default: benchmarks/results/suite-<commit>.json)")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+    parser.add_argument("--trace-memory", action="store_true", help="also report the Python heap peak; slows every request, so timings are not comparable")
+    args = parser.parse_args()
+
+    # The services log every upstream call at INFO, which would swamp the output and the timings
+    logging.disable(logging.INFO)
+    revision = git_revision()
+    scenarios = {}
+    for name in args.scenario or SCENARIOS:
+        scenarios[name] = asyncio.run(run_scenario(name, args.scale, args.concurrency, args.seed, args.trace_memory))
+    results = {
+        **revision,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "packages": versions(),
+        "cpus": os.cpu_count(),
+        "args": {"scale": args.scale, "concurrency": args.concurrency, "seed": args.seed,
+                 "trace_memory": args.trace_memory},
+        "scenarios": scenarios,
+    }
+    print_results(scenarios)
+
+    output = args.output or os.path.join(ROOT, "benchmarks", "results", f"suite-{revision['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Booking throughput with the write-ahead log on versus off.
+
+Runs concurrent POST /bookings against booking-service (or bus-booking)
+in-process, once with DATA_DIR unset and once pointing at a temporary
+directory, and reports bookings/sec and how many fsyncs the group commit
+needed.
+
+    python benchmarks/bench_wal.py [--service booking-service] [--bookings 20000] [--concurrency 200]
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+
+from _service import load_service
+
+
+async def run(service, bookings: int, concurrency: int) -> float:
+    await service.app.router.startup()
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def worker(worker_id: int):
+            for i in range(worker_id, bookings, concurrency):
+                payload = {
+                    "user_id": f"user{i}",
+                    "bus_id": f"bus{i // 40}",
+                    "seat_number": i % 40 + 1,
+                    "journey_date": "2024-06-01",
+                }
+                response = await client.post("/bookings", json=payload)
+                assert response.status_code == 200, response.text
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(w) for w in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    await service.app.router.shutdown()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--service", default="booking-service", choices=["booking-service", "bus-booking"])
+    parser.add_argument("--bookings", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    args = parser.parse_args()
+    # The buses are made up, so there is no bus-service to check seat numbers against
+    os.environ["BUS_SERVICE_URL"] = ""
+
+    print(f"{'durability':>10} {'bookings/s':>11} {'fsyncs':>7}")
+    for durable in (False, True):
+        with tempfile.TemporaryDirectory() as data_dir:
+            if durable:
+                os.environ["DATA_DIR"] = data_dir
+            else:
+                os.environ.pop("DATA_DIR", None)
+            service = load_service(args.service)
+            elapsed = asyncio.run(run(service, args.bookings, args.concurrency))
+            fsyncs = service.wal.commits if service.wal is not None else 0
+            print(f"{'on' if durable else 'off':>10} {args.bookings / elapsed:11.0f} {fsyncs:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#seat counts of buses, looked up in bus-service for booking validation
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+
+from seat_inventory import MAX_SEAT_NUMBER
+
+
+class BusSeats:
+    """``total_seats`` of each bus, fetched from bus-service and cached.
+
+    Seats are numbered from 1 to the bus's ``total_seats``, which only
+    bus-service knows. A count is cached for ``ttl`` seconds and
+    concurrent lookups of the same bus share one request. Unknown buses
+    are cached as None for ``missing_ttl`` seconds. While bus-service
+    cannot be reached, a bus looked up before keeps its last known count,
+    so bookings only depend on bus-service for buses not seen yet. An
+    empty ``url`` turns the lookup off, and every bus then allows seats up
+    to MAX_SEAT_NUMBER.
+    """
+
+    def __init__(self, url: str, ttl: float = 300.0, missing_ttl: float = 5.0, timeout: float = 2.0):
+        self.url = url.rstrip("/")
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.timeout = timeout
+        # Transport for the bus-service client; None means real HTTP
+        self.transport: Optional[httpx.AsyncBaseTransport] = None
+        self.client: Optional[httpx.AsyncClient] = None
+        self._cache: Dict[str, Tuple[float, Optional[int]]] = {}
+        self._fetching: Dict[str, asyncio.Future] = {}
+
+    async def start(self):
+        if self.url:
+            self.client = httpx.AsyncClient(base_url=self.url, timeout=self.timeout, transport=self.transport)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def total_seats(self, bus_id: str) -> Optional[int]:
+        """Highest seat number of a bus, or None if bus-service does not know it.
+
+        Raises httpx.HTTPError when bus-service cannot be asked and has
+        never given a count for the bus.
+        """
+        if not self.url:
+            return MAX_SEAT_NUMBER
+        cached = self._cache.get(bus_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        fetching = self._fetching.get(bus_id)
+        if fetching is None:
+            fetching = self._fetching[bus_id] = asyncio.ensure_future(self._fetch(bus_id))
+            fetching.add_done_callback(lambda _: self._fetching.pop(bus_id, None))
+        try:
+            # Shielded so one cancelled request does not cancel the lookup others are waiting on
+            return await asyncio.shield(fetching)
+        except httpx.HTTPError:
+            if cached is None or cached[1] is None:
+                raise
+            # Seat counts rarely change, so the expired one beats failing the booking
+            return cached[1]
+
+    async def _fetch(self, bus_id: str) -> Optional[int]:
+        response = await self.client.get(f"/buses/{quote(bus_id, safe='')}")
+        if response.status_code == 404:
+            self._cache[bus_id] = (time.monotonic() + self.missing_ttl, None)
+            return None
+        response.raise_for_status()
+        total = min(int(response.json()["total_seats"]), MAX_SEAT_NUMBER)
+        self._cache[bus_id] = (time.monotonic() + self.ttl, total)
+        return total
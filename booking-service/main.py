@@ -1,9 +1,27 @@
 #booking service main file
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import date
+import asyncio
+import json
+import os
+
+import httpx
+
+from buscommon.listing import (
+    MAX_PAGE_SIZE, NDJSON_MEDIA_TYPE, STREAM_CHUNK_SIZE,
+    decode_cursor, encode_cursor, json_array_stream, ndjson_stream,
+)
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.outbox import EventOutbox
+from buscommon.snapshots import etag_matches, not_modified, version_etag
+from buscommon.wal import WriteAheadLog
+
+from bus_seats import BusSeats
+from storage import batch_outcome, open_store
 
 app = FastAPI(title="Booking Service")
 
@@ -16,8 +34,47 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory storage
-bookings = []
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Largest number of seats accepted in one batch booking
+MAX_BATCH_SIZE = 500
+
+# Storage backend: memory:// (default) or sqlite:///path/to/bookings.db
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+
+# Durability for the memory backend: bookings are logged under DATA_DIR when it is set
+DATA_DIR = os.getenv("DATA_DIR")
+wal = WriteAheadLog(
+    DATA_DIR,
+    commit_window=float(os.getenv("WAL_COMMIT_WINDOW_MS", "2")) / 1000,
+    snapshot_every=int(os.getenv("WAL_SNAPSHOT_EVERY", "100000")),
+) if DATA_DIR and STORAGE_URL.startswith("memory://") else None
+
+store = open_store(STORAGE_URL, wal)
+
+# Booked seats are reported to bus-service in the background; an empty URL turns this off
+outbox = EventOutbox(
+    os.getenv("BOOKING_EVENTS_URL", "http://bus-service:8002/events/bookings"),
+    "booking-service",
+    batch_size=int(os.getenv("BOOKING_EVENTS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("BOOKING_EVENTS_FLUSH_MS", "50")) / 1000,
+    # Undelivered events survive a restart when DATA_DIR is set
+    directory=DATA_DIR,
+    commit_window=float(os.getenv("WAL_COMMIT_WINDOW_MS", "2")) / 1000,
+    snapshot_every=int(os.getenv("WAL_SNAPSHOT_EVERY", "100000")),
+)
+
+# Seat numbers are checked against each bus's total_seats in bus-service; an empty URL checks 1..1023 only
+bus_seats = BusSeats(
+    os.getenv("BUS_SERVICE_URL", "http://bus-service:8002"),
+    ttl=float(os.getenv("BUS_SEATS_TTL", "300")),
+)
 
 class Booking(BaseModel):
     user_id: str
@@ -26,25 +83,154 @@ class Booking(BaseModel):
     journey_date: date
     agent_id: Optional[str] = None
 
+class BookingBatch(BaseModel):
+    bookings: List[Booking]
+
+@app.on_event("startup")
+async def startup_event():
+    await store.open()
+    await outbox.start()
+    await bus_seats.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await bus_seats.close()
+    await outbox.close()
+    await store.close()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Booking Service"}
 
+@app.get("/events/outbox")
+async def get_outbox():
+    """Delivery state of the booking events sent to bus-service"""
+    return outbox.stats()
+
+def _encode_booking(booking: dict) -> str:
+    return json.dumps(booking, default=str)
+
+async def _document_chunks(filters: dict, after: int):
+    """Encoded bookings after the cursor, fetched from the store a chunk at a time"""
+    while True:
+        page = await store.page(filters, after, STREAM_CHUNK_SIZE)
+        yield [_encode_booking(booking) for _, booking in page]
+        if len(page) < STREAM_CHUNK_SIZE:
+            return
+        after = page[-1][0]
+
 @app.get("/bookings")
-async def get_bookings():
-    return bookings
+async def get_bookings(
+    request: Request,
+    response: Response,
+    user_id: Optional[str] = None,
+    bus_id: Optional[str] = None,
+    journey_date: Optional[date] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
+    """List bookings.
+
+    Without ``limit``/``cursor`` the whole store is streamed as a JSON array.
+    With them a page is returned along with ``next_cursor``. Sending
+    ``Accept: application/x-ndjson`` streams one booking per line instead.
+    The ETag changes with every booking recorded, and sending it back as
+    ``If-None-Match`` gets a 304 while nothing has.
+    """
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    try:
+        after = decode_cursor(cursor) if cursor else -1
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    accept = request.headers.get("accept", "")
+    etag = version_etag(await store.data_version(), str(request.url.query), accept)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag, "Accept")
+
+    filters = {"user_id": user_id, "bus_id": bus_id, "journey_date": journey_date}
+    paginated = limit is not None or cursor is not None
+    validators = {"ETag": etag, "Vary": "Accept"}
+
+    if not paginated:
+        chunks = _document_chunks(filters, after)
+        if NDJSON_MEDIA_TYPE in accept:
+            return StreamingResponse(ndjson_stream(chunks), media_type=NDJSON_MEDIA_TYPE, headers=validators)
+        return StreamingResponse(json_array_stream(chunks), media_type="application/json", headers=validators)
+
+    page_size = limit or MAX_PAGE_SIZE
+    page = await store.page(filters, after, page_size)
+    next_cursor = encode_cursor(page[-1][0]) if len(page) == page_size else None
+
+    if NDJSON_MEDIA_TYPE in accept:
+        headers = dict(validators)
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+
+        async def single_chunk():
+            yield [_encode_booking(booking) for _, booking in page]
+        return StreamingResponse(ndjson_stream(single_chunk()), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+    response.headers.update(validators)
+    return {"bookings": [booking for _, booking in page], "next_cursor": next_cursor}
+
+async def seat_totals(bus_ids) -> dict:
+    """total_seats of each bus (None for unknown buses), or a 503 if bus-service cannot say"""
+    bus_ids = list(set(bus_ids))
+    try:
+        totals = await asyncio.gather(*(bus_seats.total_seats(bus_id) for bus_id in bus_ids))
+    except httpx.HTTPError:
+        raise HTTPException(status_code=503, detail="Bus service unavailable, cannot check seat numbers")
+    return dict(zip(bus_ids, totals))
 
 @app.post("/bookings")
 async def create_booking(booking: Booking):
-    # Check if seat is already booked for the given bus and date
-    if any(b.bus_id == booking.bus_id and 
-           b.seat_number == booking.seat_number and 
-           b.journey_date == booking.journey_date for b in bookings):
+    total_seats = (await seat_totals([booking.bus_id]))[booking.bus_id]
+    if total_seats is None:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    if not 1 <= booking.seat_number <= total_seats:
+        raise HTTPException(status_code=400, detail=f"Seat number must be between 1 and {total_seats}")
+    booking_dict = booking.dict()
+    status, = await store.reserve([booking_dict])
+    if status != "booked":
         raise HTTPException(status_code=400, detail="Seat already booked")
-    
-    bookings.append(booking)
+    outbox.publish("booking.created", booking_dict)
+    await outbox.persisted()
     return {"message": "Booking created successfully", "booking": booking}
 
+@app.post("/bookings/batch")
+async def create_bookings_batch(batch: BookingBatch):
+    """Book several seats at once; either every seat is booked or none is"""
+    if not batch.bookings:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one booking")
+    if len(batch.bookings) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"Batch cannot exceed {MAX_BATCH_SIZE} bookings")
+
+    bookings = [b.dict() for b in batch.bookings]
+    totals = await seat_totals(b["bus_id"] for b in bookings)
+    checked = [
+        "unknown_bus" if totals[b["bus_id"]] is None
+        else "invalid_seat_number" if not 1 <= b["seat_number"] <= totals[b["bus_id"]]
+        else None
+        for b in bookings
+    ]
+    statuses = batch_outcome(checked) if any(checked) else await store.reserve(bookings)
+    results = [
+        {"index": index, "bus_id": b.bus_id, "journey_date": b.journey_date.isoformat(),
+         "seat_number": b.seat_number, "status": status}
+        for index, (b, status) in enumerate(zip(batch.bookings, statuses))
+    ]
+    if any(status != "booked" for status in statuses):
+        raise HTTPException(
+            status_code=400,
+            detail={"message": "Batch rejected, no seats were booked", "results": results},
+        )
+    for booking_dict in bookings:
+        outbox.publish("booking.created", booking_dict)
+    await outbox.persisted()
+    return {"message": f"{len(results)} bookings created successfully", "results": results}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8007) 
\ No newline at end of file
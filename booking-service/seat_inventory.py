@@ -0,0 +1,81 @@
+#seat inventory for the booking service
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import AsyncIterator, Dict, Tuple
+
+# Highest seat number a journey bitmap will grow to
+MAX_SEAT_NUMBER = 1023
+
+JourneyKey = Tuple[str, date]
+
+
+class _JourneyLock:
+    """A journey's lock and how many reservations hold or wait for it"""
+
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+
+class SeatInventory:
+    """Per-journey seat bitmaps keyed by (bus_id, journey_date).
+
+    Each journey costs one bit per seat, so checking or reserving a seat
+    is constant time no matter how many bookings already exist.
+    """
+
+    def __init__(self):
+        self._seats: Dict[JourneyKey, bytearray] = {}
+        self._locks: Dict[JourneyKey, _JourneyLock] = {}
+
+    @asynccontextmanager
+    async def lock(self, bus_id: str, journey_date: date) -> AsyncIterator[None]:
+        """Hold the lock serialising reservations for one journey.
+
+        A journey's lock only exists while a reservation holds or waits
+        for it, so the table does not grow with every journey ever booked.
+        """
+        key = (bus_id, journey_date)
+        journey = self._locks.get(key)
+        if journey is None:
+            journey = self._locks[key] = _JourneyLock()
+        journey.users += 1
+        try:
+            async with journey.lock:
+                yield
+        finally:
+            journey.users -= 1
+            if journey.users == 0:
+                del self._locks[key]
+
+    def is_reserved(self, bus_id: str, journey_date: date, seat_number: int) -> bool:
+        seats = self._seats.get((bus_id, journey_date))
+        byte, bit = divmod(seat_number, 8)
+        return seats is not None and byte < len(seats) and bool(seats[byte] & (1 << bit))
+
+    def reserve(self, bus_id: str, journey_date: date, seat_number: int) -> bool:
+        """Mark a seat as taken; returns False if it was already taken"""
+        if not 0 <= seat_number <= MAX_SEAT_NUMBER:
+            raise ValueError(f"Seat number must be between 0 and {MAX_SEAT_NUMBER}")
+        key = (bus_id, journey_date)
+        seats = self._seats.get(key)
+        byte, bit = divmod(seat_number, 8)
+        if seats is None:
+            seats = self._seats[key] = bytearray(byte + 1)
+        elif byte >= len(seats):
+            seats.extend(bytes(byte + 1 - len(seats)))
+        mask = 1 << bit
+        if seats[byte] & mask:
+            return False
+        seats[byte] |= mask
+        return True
+
+    def release(self, bus_id: str, journey_date: date, seat_number: int):
+        """Free a previously reserved seat"""
+        seats = self._seats.get((bus_id, journey_date))
+        byte, bit = divmod(seat_number, 8)
+        if seats is not None and byte < len(seats):
+            seats[byte] &= ~(1 << bit) & 0xFF
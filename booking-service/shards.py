@@ -0,0 +1,515 @@
+#bus_id-sharded booking storage for running the booking service on several cores
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import time
+import uuid
+import zlib
+from datetime import date
+from typing import Any, Dict, List, Optional, Set
+
+from buscommon.wal import WriteAheadLog
+
+from storage import BookingStore, MemoryBookingStore, Page, batch_outcome
+
+logger = logging.getLogger(__name__)
+
+# Frames are a 4-byte big-endian length followed by that many bytes of JSON
+_LENGTH = struct.Struct(">I")
+# A shard frees the seats of a prepared transaction that is not resolved in time
+PREPARE_TIMEOUT = float(os.getenv("SHARD_PREPARE_TIMEOUT", "30"))
+# Longest pause between attempts to deliver a commit to a shard
+COMMIT_RETRY_MAX_DELAY = 2.0
+# Bits of a listing position given to each shard's local position
+POSITION_BITS = 40
+SHARD_COUNT_FILE = "shards.json"
+
+
+def shard_for(bus_id: str, shards: int) -> int:
+    """The shard that owns every seat of a bus"""
+    return zlib.crc32(bus_id.encode()) % shards
+
+
+def socket_path(directory: str, index: int) -> str:
+    return os.path.join(directory, f"shard-{index}.sock")
+
+
+def _to_wire(value: Any) -> bytes:
+    data = json.dumps(value, default=str).encode()
+    return _LENGTH.pack(len(data)) + data
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> Any:
+    size, = _LENGTH.unpack(await reader.readexactly(_LENGTH.size))
+    return json.loads(await reader.readexactly(size))
+
+
+def _from_wire(booking: dict) -> dict:
+    return dict(booking, journey_date=date.fromisoformat(booking["journey_date"]))
+
+
+class DecisionLog:
+    """Outcomes of cross-shard transactions, one file per transaction.
+
+    The first outcome recorded for a transaction wins: the coordinator
+    records "commit" once every shard has voted yes, and a shard whose
+    prepared seats time out records "abort". The file is linked into place
+    in one step, so that race is settled by the filesystem across
+    processes, and it is fsynced first, so it survives a crash. A
+    transaction with no file aborted (presumed abort). The coordinator
+    deletes the file once every shard has applied the outcome, and a shard
+    deletes an "abort" it recorded for a transaction the coordinator had
+    already aborted there. Only the files of transactions whose
+    coordinator died before finishing them are left behind.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, transaction: str) -> str:
+        return os.path.join(self.directory, transaction)
+
+    def _decide(self, transaction: str, outcome: str) -> str:
+        path = self._path(transaction)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(outcome)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            with open(path) as f:
+                return f.read()
+        finally:
+            os.unlink(tmp_path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return outcome
+
+    async def decide(self, transaction: str, outcome: str) -> str:
+        """Record ``outcome`` unless one is recorded already; returns the one that stands"""
+        return await asyncio.get_running_loop().run_in_executor(None, self._decide, transaction, outcome)
+
+    async def forget(self, transaction: str):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, os.unlink, self._path(transaction))
+        except FileNotFoundError:
+            pass
+
+
+class ShardServer:
+    """Serves one shard's MemoryBookingStore on a Unix socket.
+
+    Requests on a connection are handled concurrently and answered by id,
+    so a booking waiting on the write-ahead log does not hold up the ones
+    behind it. A prepared transaction that is neither committed nor
+    aborted within PREPARE_TIMEOUT, including one replayed from the log
+    after a restart, is settled through the decision log.
+    """
+
+    def __init__(self, store: MemoryBookingStore, decisions: DecisionLog, index: int = 0, shards: int = 1):
+        self.store = store
+        self.decisions = decisions
+        self.index = index
+        self.shards = shards
+        self._expiries: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def serve(self, path: str):
+        if os.path.exists(path):
+            os.unlink(path)
+        await self.store.open()
+        for transaction in self.store.prepared():
+            self._expire_later(transaction)
+        server = await asyncio.start_unix_server(self._connection, path)
+        async with server:
+            await server.serve_forever()
+
+    def _spawn(self, coroutine):
+        # The loop only keeps weak references to tasks
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request = await _read_frame(reader)
+                self._spawn(self._answer(request, writer))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    async def _answer(self, request: dict, writer: asyncio.StreamWriter):
+        try:
+            response = {"id": request["id"], "result": await self._dispatch(request)}
+        except Exception as e:
+            logger.exception("Shard request failed")
+            response = {"id": request["id"], "error": f"{type(e).__name__}: {e}"}
+        if not writer.is_closing():
+            writer.write(_to_wire(response))
+
+    async def _dispatch(self, request: dict):
+        op = request["op"]
+        if op == "reserve":
+            return await self.store.reserve([_from_wire(b) for b in request["bookings"]])
+        if op == "prepare":
+            transaction = request["transaction"]
+            statuses = await self.store.prepare(transaction, [_from_wire(b) for b in request["bookings"]])
+            if statuses[0] == "booked":
+                self._expire_later(transaction)
+            return statuses
+        if op in ("commit", "abort"):
+            return await self._resolve(request["transaction"], commit=op == "commit")
+        if op == "info":
+            return {"index": self.index, "shards": self.shards}
+        if op == "page":
+            filters = request["filters"]
+            if filters.get("journey_date") is not None:
+                filters["journey_date"] = date.fromisoformat(filters["journey_date"])
+            return await self.store.page(filters, request["after"], request["limit"])
+        if op == "version":
+            return await self.store.data_version()
+        raise ValueError(f"Unknown operation '{op}'")
+
+    def _expire_later(self, transaction: str):
+        self._expiries[transaction] = asyncio.get_running_loop().call_later(
+            PREPARE_TIMEOUT, lambda: self._spawn(self._expire(transaction)))
+
+    async def _expire(self, transaction: str):
+        # The coordinator may have decided to commit and then died or lost
+        # its connection; otherwise this abort stops it from committing
+        self._expiries.pop(transaction, None)
+        try:
+            outcome = await self.decisions.decide(transaction, "abort")
+            if outcome == "commit":
+                logger.warning(f"Committing transaction {transaction} from the decision log")
+            prepared = transaction in self.store.prepared()
+            await self._resolve(transaction, commit=outcome == "commit")
+            if outcome == "abort" and not prepared:
+                # The coordinator aborted it here while the decision was being
+                # written, so it is done with it and may have cleared the log already
+                await self.decisions.forget(transaction)
+        except Exception:
+            logger.exception(f"Could not settle expired transaction {transaction}")
+            if transaction in self.store.prepared():
+                self._expire_later(transaction)
+
+    async def _resolve(self, transaction: str, commit: bool) -> Optional[bool]:
+        expiry = self._expiries.pop(transaction, None)
+        if expiry is not None:
+            expiry.cancel()
+        try:
+            if commit:
+                return await self.store.commit(transaction)
+            await self.store.abort(transaction)
+        except BaseException:
+            # Still holding its seats; try again after the timeout
+            if transaction in self.store.prepared() and transaction not in self._expiries:
+                self._expire_later(transaction)
+            raise
+        return None
+
+
+class ShardClient:
+    """One multiplexed connection to a shard, reconnected on demand"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+        self._connecting: Optional[asyncio.Lock] = None
+
+    async def _connect(self):
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._writer is None or self._writer.is_closing():
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                self._reader_task = asyncio.ensure_future(self._read(reader, self._writer))
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        error = "connection closed"
+        try:
+            while True:
+                response = await _read_frame(reader)
+                future = self._pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RuntimeError(f"Shard {self.path}: {response['error']}"))
+                else:
+                    future.set_result(response["result"])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            error = str(e)
+        except Exception as e:
+            logger.exception(f"Unreadable response from shard {self.path}")
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            # Every call waiting on this connection fails, so none of them hangs
+            writer.close()
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f"Lost connection to shard {self.path}: {error}"))
+
+    async def call(self, op: str, **args) -> Any:
+        if self._writer is None or self._writer.is_closing():
+            await self._connect()
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[self._next_id] = future
+        self._writer.write(_to_wire({"id": self._next_id, "op": op, **args}))
+        await self._writer.drain()
+        return await future
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self._writer is not None:
+            self._writer.close()
+
+
+class ShardedBookingStore(BookingStore):
+    """Bookings partitioned by bus across shard processes.
+
+    Every seat of a bus lives on ``shard_for(bus_id)``, so the shard alone
+    decides whether a seat is free and no seat can be booked twice however
+    many front-end workers there are. A batch that touches one shard is a
+    single call; one spread over several is booked with two-phase commit:
+    every shard holds its seats, then all commit or all abort.
+
+    A listing position packs the local position reached on every shard,
+    POSITION_BITS bits each, so a cursor tells each shard where to resume
+    however unevenly the shards grow, and positions still increase through
+    a listing. Pages merge the shards by local position.
+    """
+
+    def __init__(self, directory: str, shards: int, decisions: Optional[str] = None):
+        self.shards = shards
+        self.clients = [ShardClient(socket_path(directory, index)) for index in range(shards)]
+        self.decisions = DecisionLog(decisions or os.path.join(directory, "decisions"))
+        # Commits and aborts still being delivered; they outlive a cancelled request
+        self._deliveries: Set[asyncio.Task] = set()
+
+    async def open(self):
+        infos = await asyncio.gather(*(client.call("info") for client in self.clients))
+        for index, info in enumerate(infos):
+            if info != {"index": index, "shards": self.shards}:
+                raise RuntimeError(f"Shard {index} serves {info}, but this worker expects {self.shards} shards; "
+                                   "BOOKING_SHARDS must match the shard processes")
+
+    async def close(self):
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        for client in self.clients:
+            await client.close()
+
+    async def reserve(self, bookings: List[dict]) -> List[str]:
+        groups: Dict[int, List[int]] = {}
+        for i, b in enumerate(bookings):
+            groups.setdefault(shard_for(b["bus_id"], self.shards), []).append(i)
+        if len(groups) == 1:
+            shard, = groups
+            return await self.clients[shard].call("reserve", bookings=bookings)
+
+        transaction = uuid.uuid4().hex
+        try:
+            results = await asyncio.gather(*(
+                self.clients[shard].call("prepare", transaction=transaction, bookings=[bookings[i] for i in indexes])
+                for shard, indexes in groups.items()
+            ))
+        except BaseException:
+            await self._abort(groups, transaction)
+            raise
+        statuses: List[Optional[str]] = [None] * len(bookings)
+        for indexes, shard_statuses in zip(groups.values(), results):
+            for i, status in zip(indexes, shard_statuses):
+                statuses[i] = None if status in ("booked", "not_booked") else status
+        if any(statuses):
+            await self._abort(groups, transaction)
+            return batch_outcome(statuses)
+        if await self.decisions.decide(transaction, "commit") != "commit":
+            # A shard gave up waiting and freed its seats first
+            await self._abort(groups, transaction)
+            return ["transaction_expired"] * len(bookings)
+        # Once decided the commit must reach every shard, even if this request is cancelled
+        await asyncio.shield(self._deliver_later(self._commit(groups, transaction)))
+        return batch_outcome(statuses)
+
+    def _deliver_later(self, coroutine) -> asyncio.Task:
+        task = asyncio.ensure_future(coroutine)
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+        return task
+
+    async def _abort(self, groups: Dict[int, List[int]], transaction: str):
+        """Free the transaction's seats on every shard it touched.
+
+        Shards that miss the first attempt free them after PREPARE_TIMEOUT
+        and record "abort" in the decision log, so the abort keeps being
+        delivered in the background and the record is removed once every
+        shard has applied it.
+        """
+        results = await asyncio.gather(
+            *(self.clients[shard].call("abort", transaction=transaction) for shard in groups),
+            return_exceptions=True)
+        missed = []
+        for shard, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                logger.warning(f"Could not abort transaction {transaction} on shard {shard}: {result}")
+                missed.append(shard)
+        self._deliver_later(self._finish_abort(missed, transaction))
+
+    async def _finish_abort(self, missed: List[int], transaction: str):
+        await asyncio.gather(*(self._deliver(shard, "abort", transaction) for shard in missed))
+        await self.decisions.forget(transaction)
+
+    async def _commit(self, groups: Dict[int, List[int]], transaction: str):
+        await asyncio.gather(*(self._commit_on(shard, transaction) for shard in groups))
+        await self.decisions.forget(transaction)
+
+    async def _commit_on(self, shard: int, transaction: str):
+        if not await self._deliver(shard, "commit", transaction):
+            raise RuntimeError(f"Shard {shard} aborted transaction {transaction} after it was committed")
+
+    async def _deliver(self, shard: int, op: str, transaction: str) -> Any:
+        """Send a decided outcome to one shard, retrying until it is applied"""
+        delay = 0.05
+        while True:
+            try:
+                return await self.clients[shard].call(op, transaction=transaction)
+            except (ConnectionError, OSError, RuntimeError) as e:
+                logger.warning(f"{op.capitalize()} of transaction {transaction} on shard {shard} failed, "
+                               f"retrying: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, COMMIT_RETRY_MAX_DELAY)
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        bus_id = filters.get("bus_id")
+        shards = [shard_for(bus_id, self.shards)] if bus_id is not None else range(self.shards)
+        # Each field holds a local position plus one, so -1 resumes every shard from the start
+        packed = after + 1
+        mask = (1 << POSITION_BITS) - 1
+        offsets = [((packed >> (shard * POSITION_BITS)) & mask) - 1 for shard in range(self.shards)]
+        pages = await asyncio.gather(*(
+            self.clients[shard].call("page", filters=filters, after=offsets[shard], limit=limit)
+            for shard in shards
+        ))
+        merged = sorted(
+            ((position, shard, booking) for shard, page in zip(shards, pages) for position, booking in page),
+            key=lambda item: item[:2],
+        )[:limit]
+        packed = sum((offset + 1) << (shard * POSITION_BITS) for shard, offset in enumerate(offsets))
+        result = []
+        for position, shard, booking in merged:
+            packed += (position - offsets[shard]) << (shard * POSITION_BITS)
+            offsets[shard] = position
+            result.append((packed - 1, _from_wire(booking)))
+        return result
+
+    async def data_version(self) -> str:
+        versions = await asyncio.gather(*(client.call("version") for client in self.clients))
+        return hashlib.sha1("/".join(versions).encode()).hexdigest()[:16]
+
+
+def decisions_dir(socket_dir: str, data_dir: Optional[str]) -> str:
+    """Where the decision log lives; with DATA_DIR it has to be as durable as the shards' logs"""
+    return os.path.join(data_dir or socket_dir, "decisions")
+
+
+def check_shard_count(data_dir: str, shards: int):
+    """Refuse to serve a data directory written with a different number of shards.
+
+    shard_for is the CRC of the bus id modulo the shard count, so with
+    another count most buses would land on shards that hold none of their
+    bookings and their seats could be booked again.
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, SHARD_COUNT_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            recorded = json.load(f)["shards"]
+        if recorded != shards:
+            raise SystemExit(f"{data_dir} holds bookings for {recorded} shards; "
+                             f"start with --shards {recorded} or use a new DATA_DIR")
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"shards": shards}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def serve_shard(index: int, shards: int, directory: str, data_dir: Optional[str]):
+    """Entry point of one shard process"""
+    wal = WriteAheadLog(
+        os.path.join(data_dir, f"shard-{index}"),
+        commit_window=float(os.getenv("WAL_COMMIT_WINDOW_MS", "2")) / 1000,
+        snapshot_every=int(os.getenv("WAL_SNAPSHOT_EVERY", "100000")),
+    ) if data_dir else None
+    decisions = DecisionLog(decisions_dir(directory, data_dir))
+    server = ShardServer(MemoryBookingStore(wal), decisions, index, shards)
+    try:
+        asyncio.run(server.serve(socket_path(directory, index)))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the booking service with bus_id-sharded seat inventory")
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="uvicorn worker processes")
+    parser.add_argument("--socket-dir", default=os.getenv("SHARD_SOCKET_DIR", "/tmp/booking-shards"))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8007)
+    args = parser.parse_args()
+
+    data_dir = os.getenv("DATA_DIR")
+    if data_dir:
+        check_shard_count(data_dir, args.shards)
+    os.makedirs(args.socket_dir, exist_ok=True)
+    paths = [socket_path(args.socket_dir, index) for index in range(args.shards)]
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+    processes = [
+        multiprocessing.Process(target=serve_shard, args=(index, args.shards, args.socket_dir, data_dir),
+                                daemon=True)
+        for index in range(args.shards)
+    ]
+    for process in processes:
+        process.start()
+    deadline = time.monotonic() + 10
+    while not all(os.path.exists(path) for path in paths):
+        if time.monotonic() > deadline or not all(process.is_alive() for process in processes):
+            raise SystemExit("Booking shards did not start")
+        time.sleep(0.05)
+    # Workers find the shards through these; they are read when main.py is imported
+    os.environ["STORAGE_URL"] = f"shards://{args.socket_dir}"
+    os.environ["BOOKING_SHARDS"] = str(args.shards)
+    os.environ["SHARD_DECISION_DIR"] = decisions_dir(args.socket_dir, data_dir)
+
+    import uvicorn
+    try:
+        uvicorn.run("main:app", host=args.host, port=args.port, workers=args.workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+if __name__ == "__main__":
+    main()
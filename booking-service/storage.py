@@ -0,0 +1,396 @@
+#storage backends for the booking service
+import asyncio
+import os
+import sqlite3
+import uuid
+from collections import OrderedDict
+from contextlib import AsyncExitStack
+from datetime import date
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from buscommon.listing import PositionIndex
+from buscommon.sqlite import SQLitePool
+from buscommon.wal import WriteAheadLog
+
+from seat_inventory import SeatInventory, MAX_SEAT_NUMBER
+
+# (position, booking) pairs; positions only grow and back listing cursors
+Page = List[Tuple[int, dict]]
+
+BOOKING_FIELDS = ("user_id", "bus_id", "seat_number", "journey_date", "agent_id")
+# How many aborted transaction ids a store remembers to refuse their late commits
+ABORTED_REMEMBERED = 10_000
+
+
+def _precheck(bookings: List[dict]) -> List[Optional[str]]:
+    """Statuses for problems that do not depend on stored state (None means fine so far)"""
+    statuses, requested = [], set()
+    for b in bookings:
+        seat = (b["bus_id"], b["journey_date"], b["seat_number"])
+        if not 1 <= b["seat_number"] <= MAX_SEAT_NUMBER:
+            statuses.append("invalid_seat_number")
+        elif seat in requested:
+            statuses.append("duplicate_in_batch")
+        else:
+            statuses.append(None)
+        requested.add(seat)
+    return statuses
+
+
+def _parse(data: dict) -> dict:
+    return dict(data, journey_date=date.fromisoformat(data["journey_date"]))
+
+
+def batch_outcome(statuses: List[Optional[str]]) -> List[str]:
+    """Final per-booking statuses of an all-or-nothing batch from its per-booking problems (None if fine)"""
+    if any(statuses):
+        return [status or "not_booked" for status in statuses]
+    return ["booked"] * len(statuses)
+
+
+class BookingStore:
+    """Interface of the booking storage backends.
+
+    Bookings are plain dicts keyed by ``BOOKING_FIELDS`` with
+    ``journey_date`` as a ``date``.
+    """
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def reserve(self, bookings: List[dict]) -> List[str]:
+        """Book every seat or none of them.
+
+        Returns one status per booking: all "booked" on success, otherwise
+        the reason each seat failed and "not_booked" for the rest.
+        """
+        raise NotImplementedError
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        """Up to ``limit`` bookings after position ``after`` matching every non-None filter"""
+        raise NotImplementedError
+
+    async def data_version(self) -> str:
+        """Token that changes whenever a booking is recorded"""
+        raise NotImplementedError
+
+
+class MemoryBookingStore(BookingStore):
+    """Bookings in process memory, optionally made durable by a write-ahead log"""
+
+    def __init__(self, wal: Optional[WriteAheadLog] = None):
+        self.wal = wal
+        # None marks a booking whose log write failed; positions never shift
+        self.bookings: List[Optional[dict]] = []
+        self.version = 0
+        self.inventory = SeatInventory()
+        self.index = PositionIndex("user_id", "bus_id", "journey_date")
+        # Held seats of prepared transactions, by transaction id
+        self._prepared: Dict[str, List[dict]] = {}
+        # Recently aborted transactions, so a late commit of one fails
+        self._aborted: "OrderedDict[str, None]" = OrderedDict()
+        # The epoch keeps versions from before a restart from matching
+        self.epoch = uuid.uuid4().hex[:12]
+
+    def _append(self, booking: dict):
+        self.version += 1
+        self.index.add(len(self.bookings), user_id=booking["user_id"], bus_id=booking["bus_id"],
+                       journey_date=booking["journey_date"])
+        self.bookings.append(booking)
+
+    def _list(self, bookings: List[dict]) -> range:
+        start = len(self.bookings)
+        for b in bookings:
+            self._append(b)
+        return range(start, len(self.bookings))
+
+    def _unlist(self, positions: range):
+        self.version += 1
+        for position in positions:
+            self.bookings[position] = None
+
+    def _restore(self, data: dict):
+        booking = _parse(data)
+        self.inventory.reserve(booking["bus_id"], booking["journey_date"], booking["seat_number"])
+        self._append(booking)
+
+    def _restore_prepared(self, transaction: str, data: List[dict]):
+        bookings = [_parse(d) for d in data]
+        for b in bookings:
+            self.inventory.reserve(b["bus_id"], b["journey_date"], b["seat_number"])
+        self._prepared[transaction] = bookings
+
+    def _replay(self, record: dict):
+        if "prepared" in record:
+            self._restore_prepared(record["prepared"], record["bookings"])
+        elif "aborted" in record:
+            self._release(self._prepared.pop(record["aborted"], None) or [])
+        elif self._prepared.pop(record.get("transaction"), None) is not None:
+            # The seats were taken when the prepare record was replayed
+            self._list([_parse(data) for data in record["bookings"]])
+        else:
+            for data in record["bookings"]:
+                self._restore(data)
+
+    async def open(self):
+        """Rebuild bookings and held seats from the last snapshot and the log written after it"""
+        if self.wal is None:
+            return
+        state = self.wal.load_snapshot()
+        if isinstance(state, list):
+            # Snapshots used to hold the bookings alone
+            state = {"bookings": state, "prepared": {}}
+        for data in (state or {}).get("bookings", []):
+            self._restore(data)
+        for transaction, data in (state or {}).get("prepared", {}).items():
+            self._restore_prepared(transaction, data)
+        for record in self.wal.records():
+            self._replay(record)
+        await self.wal.start(self._state)
+
+    def _state(self) -> dict:
+        # Bookings are never modified in place, so shallow copies are a consistent snapshot
+        return {"bookings": [b for b in self.bookings if b is not None], "prepared": dict(self._prepared)}
+
+    def prepared(self) -> List[str]:
+        """Transactions holding seats and waiting for commit or abort"""
+        return list(self._prepared)
+
+    async def close(self):
+        if self.wal is not None:
+            await self.wal.close()
+
+    async def _hold(self, bookings: List[dict]) -> List[Optional[str]]:
+        """Check every seat and, if all are free, take them in the inventory"""
+        statuses = _precheck(bookings)
+        # Lock every journey in a fixed order so overlapping batches cannot deadlock
+        journeys = sorted({(b["bus_id"], b["journey_date"]) for b in bookings})
+        async with AsyncExitStack() as stack:
+            for bus_id, journey_date in journeys:
+                await stack.enter_async_context(self.inventory.lock(bus_id, journey_date))
+            for i, b in enumerate(bookings):
+                if statuses[i] is None and self.inventory.is_reserved(b["bus_id"], b["journey_date"],
+                                                                      b["seat_number"]):
+                    statuses[i] = "seat_already_booked"
+            if not any(statuses):
+                for b in bookings:
+                    self.inventory.reserve(b["bus_id"], b["journey_date"], b["seat_number"])
+        return statuses
+
+    def _release(self, bookings: List[dict]):
+        for b in bookings:
+            self.inventory.release(b["bus_id"], b["journey_date"], b["seat_number"])
+
+    async def _log(self, record: dict, undo: Optional[Callable[[], None]] = None):
+        """Wait for a record to be group-committed, running ``undo`` if the write fails.
+
+        Changes are made in memory first, as the snapshots assume. ``undo``
+        runs from the log's own future, so it also runs when the request
+        waiting on it has been cancelled.
+        """
+        if self.wal is None:
+            return
+        future = self.wal.append(record)
+
+        def settle(future: asyncio.Future):
+            if not future.cancelled() and future.exception() is not None and undo is not None:
+                undo()
+        future.add_done_callback(settle)
+        await asyncio.shield(future)
+
+    async def reserve(self, bookings: List[dict]) -> List[str]:
+        statuses = await self._hold(bookings)
+        if not any(statuses):
+            positions = self._list(bookings)
+
+            def undo():
+                self._unlist(positions)
+                self._release(bookings)
+            # The group commit is awaited after the journey locks are released
+            await self._log({"bookings": bookings}, undo)
+        return batch_outcome(statuses)
+
+    async def prepare(self, transaction: str, bookings: List[dict]) -> List[str]:
+        """First phase of a booking spread over several stores.
+
+        On success the seats are held, so no other booking can take them,
+        until ``commit`` records the bookings or ``abort`` frees the seats.
+        With a write-ahead log the hold is on disk before this returns, so
+        it survives a restart until the transaction is resolved.
+        """
+        statuses = await self._hold(bookings)
+        if any(statuses):
+            return batch_outcome(statuses)
+        self._prepared[transaction] = bookings
+
+        def undo():
+            if self._prepared.pop(transaction, None) is not None:
+                self._release(bookings)
+        await self._log({"prepared": transaction, "bookings": bookings}, undo)
+        return batch_outcome(statuses)
+
+    async def commit(self, transaction: str) -> bool:
+        """Record a prepared transaction's bookings.
+
+        Returns False if the transaction was aborted, True once its
+        bookings are recorded, including by an earlier call. If the log
+        write fails the seats stay held for another attempt.
+        """
+        bookings = self._prepared.pop(transaction, None)
+        if bookings is None:
+            return transaction not in self._aborted
+        positions = self._list(bookings)
+
+        def undo():
+            self._unlist(positions)
+            self._prepared[transaction] = bookings
+        await self._log({"bookings": bookings, "transaction": transaction}, undo)
+        return True
+
+    async def abort(self, transaction: str):
+        bookings = self._prepared.pop(transaction, None)
+        if bookings is None:
+            return
+        self._release(bookings)
+        self._aborted[transaction] = None
+        if len(self._aborted) > ABORTED_REMEMBERED:
+            self._aborted.popitem(last=False)
+        # If this is lost the replayed hold expires and is aborted again
+        await self._log({"aborted": transaction})
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        matches = (
+            (position, self.bookings[position])
+            for position in self.index.scan(filters, after, len(self.bookings))
+            if self.bookings[position] is not None
+            and all(value is None or self.bookings[position][field] == value for field, value in filters.items())
+        )
+        return list(islice(matches, limit))
+
+    async def data_version(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    bus_id TEXT NOT NULL,
+    seat_number INTEGER NOT NULL,
+    journey_date TEXT NOT NULL,
+    agent_id TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS bookings_seat ON bookings (bus_id, journey_date, seat_number);
+CREATE INDEX IF NOT EXISTS bookings_user ON bookings (user_id, id);
+CREATE INDEX IF NOT EXISTS bookings_bus ON bookings (bus_id, id);
+CREATE INDEX IF NOT EXISTS bookings_journey_date ON bookings (journey_date, id);
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO data_version (id, epoch, version) VALUES (1, lower(hex(randomblob(6))), 0);
+CREATE TRIGGER IF NOT EXISTS bookings_inserted AFTER INSERT ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS bookings_updated AFTER UPDATE ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS bookings_deleted AFTER DELETE ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+"""
+
+_SEAT_TAKEN = "SELECT 1 FROM bookings WHERE bus_id = ? AND journey_date = ? AND seat_number = ?"
+_INSERT = ("INSERT INTO bookings (user_id, bus_id, seat_number, journey_date, agent_id) "
+           "VALUES (?, ?, ?, ?, ?)")
+
+
+def _row_to_booking(row: sqlite3.Row) -> dict:
+    booking = {field: row[field] for field in BOOKING_FIELDS}
+    booking["journey_date"] = date.fromisoformat(booking["journey_date"])
+    return booking
+
+
+class SQLiteBookingStore(BookingStore):
+    """Bookings in a SQLite database shared by every worker process.
+
+    The unique (bus_id, journey_date, seat_number) index is what rules out
+    double bookings across processes; the seat check and inserts run in
+    one IMMEDIATE transaction so a batch is still all-or-nothing.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: Optional[SQLitePool] = None
+
+    async def open(self):
+        self.pool = SQLitePool(self.path, self.pool_size, SQLITE_SCHEMA)
+
+    async def close(self):
+        self.pool.close()
+
+    async def reserve(self, bookings: List[dict]) -> List[str]:
+        return await self.pool.run(self._reserve, bookings, _precheck(bookings))
+
+    @staticmethod
+    def _reserve(connection: sqlite3.Connection, bookings: List[dict], statuses: List[Optional[str]]):
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for i, b in enumerate(bookings):
+                seat = (b["bus_id"], b["journey_date"].isoformat(), b["seat_number"])
+                if statuses[i] is None and connection.execute(_SEAT_TAKEN, seat).fetchone():
+                    statuses[i] = "seat_already_booked"
+            if any(statuses):
+                connection.execute("ROLLBACK")
+                return batch_outcome(statuses)
+            connection.executemany(_INSERT, [
+                (b["user_id"], b["bus_id"], b["seat_number"], b["journey_date"].isoformat(), b["agent_id"])
+                for b in bookings
+            ])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return batch_outcome(statuses)
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        clauses, params = ["id > ?"], [after]
+        for field in ("user_id", "bus_id", "journey_date"):
+            value = filters.get(field)
+            if value is not None:
+                clauses.append(f"{field} = ?")
+                params.append(value.isoformat() if isinstance(value, date) else value)
+        sql = (f"SELECT id, {', '.join(BOOKING_FIELDS)} FROM bookings "
+               f"WHERE {' AND '.join(clauses)} ORDER BY id LIMIT ?")
+        params.append(limit)
+
+        def fetch(connection):
+            return [(row["id"], _row_to_booking(row)) for row in connection.execute(sql, params)]
+        return await self.pool.run(fetch)
+
+    async def data_version(self) -> str:
+        def fetch(connection):
+            epoch, version = connection.execute("SELECT epoch, version FROM data_version").fetchone()
+            return f"{epoch}-{version}"
+        return await self.pool.run(fetch)
+
+
+def open_store(url: str, wal: Optional[WriteAheadLog] = None) -> BookingStore:
+    """Build the backend named by a storage URL.
+
+    ``memory://``, ``sqlite:///path/to.db`` or ``shards:///socket/dir`` for
+    the shard processes started by shards.py (``BOOKING_SHARDS`` of them).
+    """
+    if url.startswith("shards://"):
+        # Imported here because the shard module builds on the stores above
+        from shards import ShardedBookingStore
+        return ShardedBookingStore(url[len("shards://"):], int(os.getenv("BOOKING_SHARDS", "1")),
+                                   os.getenv("SHARD_DECISION_DIR"))
+    if url.startswith("sqlite://"):
+        return SQLiteBookingStore(url[len("sqlite://"):], int(os.getenv("SQLITE_POOL_SIZE", "4")))
+    if url.startswith("memory://"):
+        return MemoryBookingStore(wal)
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")
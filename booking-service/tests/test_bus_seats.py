@@ -0,0 +1,39 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+@pytest.fixture(scope="module")
+def bus_seats(service_module):
+    return service_module("booking-service", "bus_seats")
+
+
+def test_last_known_count_is_kept_while_bus_service_is_down(bus_seats):
+    up = True
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if not up:
+            raise httpx.ConnectError("bus-service is down", request=request)
+        if request.url.path == "/buses/b1":
+            return httpx.Response(200, json={"bus_id": "b1", "total_seats": 40})
+        return httpx.Response(404)
+
+    async def scenario():
+        nonlocal up
+        seats = bus_seats.BusSeats("http://bus-service", ttl=0, missing_ttl=0)
+        seats.transport = httpx.MockTransport(handler)
+        await seats.start()
+        try:
+            assert await seats.total_seats("b1") == 40
+            assert await seats.total_seats("b2") is None
+            up = False
+            assert await seats.total_seats("b1") == 40
+            # Neither a bus never counted nor one last seen as unknown has a count to fall back on
+            for bus_id in ("b2", "b3"):
+                with pytest.raises(httpx.HTTPError):
+                    await seats.total_seats(bus_id)
+        finally:
+            await seats.close()
+
+    asyncio.run(scenario())
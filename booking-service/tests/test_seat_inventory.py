@@ -0,0 +1,43 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+JOURNEY = date(2024, 6, 1)
+
+
+@pytest.fixture(scope="module")
+def seat_inventory(service_module):
+    return service_module("booking-service", "seat_inventory")
+
+
+def test_journey_lock_serialises_and_is_dropped_when_idle(seat_inventory):
+    inventory = seat_inventory.SeatInventory()
+    order = []
+
+    async def hold(name: str):
+        async with inventory.lock("b1", JOURNEY):
+            order.append(f"{name} in")
+            await asyncio.sleep(0.01)
+            order.append(f"{name} out")
+
+    async def scenario():
+        first = asyncio.ensure_future(hold("first"))
+        await asyncio.sleep(0)
+        assert len(inventory._locks) == 1
+        await asyncio.gather(first, hold("second"))
+
+    asyncio.run(scenario())
+    assert order == ["first in", "first out", "second in", "second out"]
+    assert inventory._locks == {}
+
+
+def test_reserve_and_release(seat_inventory):
+    inventory = seat_inventory.SeatInventory()
+    assert inventory.reserve("b1", JOURNEY, 9)
+    assert not inventory.reserve("b1", JOURNEY, 9)
+    assert inventory.is_reserved("b1", JOURNEY, 9) and not inventory.is_reserved("b1", JOURNEY, 8)
+    inventory.release("b1", JOURNEY, 9)
+    assert not inventory.is_reserved("b1", JOURNEY, 9)
+    with pytest.raises(ValueError):
+        inventory.reserve("b1", JOURNEY, seat_inventory.MAX_SEAT_NUMBER + 1)
@@ -0,0 +1,232 @@
+import asyncio
+import os
+import uuid
+from datetime import date
+
+import pytest
+
+from buscommon.wal import WriteAheadLog
+
+JOURNEY = date(2024, 6, 1)
+
+
+@pytest.fixture(scope="module")
+def shards(service_module):
+    return service_module("booking-service", "shards")
+
+
+@pytest.fixture(scope="module")
+def buses(shards):
+    """One bus id owned by each of two shards"""
+    owned = {}
+    for i in range(100):
+        owned.setdefault(shards.shard_for(f"bus-{i}", 2), f"bus-{i}")
+    return [owned[0], owned[1]]
+
+
+def booking(bus_id: str, seat: int) -> dict:
+    return {"user_id": "u1", "bus_id": bus_id, "seat_number": seat, "journey_date": JOURNEY, "agent_id": None}
+
+
+class Cluster:
+    """Shard servers on Unix sockets in ``directory``, plus a coordinator talking to them"""
+
+    def __init__(self, shards, directory: str, count: int = 2, durable: bool = False):
+        self.shards = shards
+        self.directory = directory
+        self.count = count
+        self.durable = durable
+        self.decisions = os.path.join(directory, "decisions")
+        self.servers = {}
+        self.tasks = {}
+        self.store = None
+
+    async def start_shard(self, index: int):
+        wal = WriteAheadLog(os.path.join(self.directory, f"shard-{index}"), commit_window=0.001) \
+            if self.durable else None
+        server = self.shards.ShardServer(self.shards.MemoryBookingStore(wal), self.shards.DecisionLog(self.decisions),
+                                         index, self.count)
+        path = self.shards.socket_path(self.directory, index)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.servers[index] = server
+        self.tasks[index] = asyncio.ensure_future(server.serve(path))
+        while not os.path.exists(path):
+            await asyncio.sleep(0.01)
+        return server
+
+    async def stop_shard(self, index: int):
+        # A shard process that exits drops its connections; a cancelled server task does not
+        if self.store is not None:
+            await self.store.clients[index].close()
+        self.tasks[index].cancel()
+        await asyncio.gather(self.tasks[index], return_exceptions=True)
+        await self.servers[index].store.close()
+
+    async def __aenter__(self):
+        for index in range(self.count):
+            await self.start_shard(index)
+        self.store = self.shards.ShardedBookingStore(self.directory, self.count, self.decisions)
+        await self.store.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.store.close()
+        for index in list(self.tasks):
+            await self.stop_shard(index)
+
+
+def test_cross_shard_batch_commits_on_every_shard(shards, buses, tmp_path):
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            statuses = await cluster.store.reserve([booking(buses[0], 1), booking(buses[1], 1)])
+            page = await cluster.store.page({}, -1, 10)
+            return statuses, page, os.listdir(cluster.decisions)
+
+    statuses, page, decisions = asyncio.run(scenario())
+    assert statuses == ["booked", "booked"]
+    assert sorted(b["bus_id"] for _, b in page) == sorted(buses)
+    # The commit decision is forgotten once every shard has applied it
+    assert decisions == []
+
+
+def test_conflict_on_one_shard_aborts_the_whole_batch(shards, buses, tmp_path):
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            assert await cluster.store.reserve([booking(buses[1], 7)]) == ["booked"]
+            statuses = await cluster.store.reserve([booking(buses[0], 7), booking(buses[1], 7)])
+            prepared = [server.store.prepared() for server in cluster.servers.values()]
+            retry = await cluster.store.reserve([booking(buses[0], 7)])
+            return statuses, prepared, retry
+
+    statuses, prepared, retry = asyncio.run(scenario())
+    assert statuses == ["not_booked", "seat_already_booked"]
+    assert prepared == [[], []]
+    assert retry == ["booked"]
+
+
+def test_shard_that_aborts_first_wins_over_the_coordinator(shards, buses, tmp_path, monkeypatch):
+    transaction = uuid.UUID(int=1).hex
+
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            # The next transaction the coordinator starts gets a known id
+            fixed, real_uuid4 = iter([uuid.UUID(int=1)]), uuid.uuid4
+            monkeypatch.setattr(shards.uuid, "uuid4", lambda: next(fixed, None) or real_uuid4())
+            # As if a shard's prepare timed out before every vote was in
+            await shards.DecisionLog(cluster.decisions).decide(transaction, "abort")
+            statuses = await cluster.store.reserve([booking(buses[0], 2), booking(buses[1], 2)])
+            late_commit = await cluster.servers[0].store.commit(transaction)
+            retry = await cluster.store.reserve([booking(buses[0], 2), booking(buses[1], 2)])
+        return statuses, late_commit, retry, os.listdir(cluster.decisions)
+
+    statuses, late_commit, retry, decisions = asyncio.run(scenario())
+    assert statuses == ["transaction_expired", "transaction_expired"]
+    assert late_commit is False
+    assert retry == ["booked", "booked"]
+    # The abort is forgotten once every shard has applied it
+    assert decisions == []
+
+
+def test_prepared_seats_are_freed_when_nobody_commits(shards, buses, tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "PREPARE_TIMEOUT", 0.05)
+
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            await cluster.store.clients[0].call("prepare", transaction="t1", bookings=[booking(buses[0], 3)])
+            assert cluster.servers[0].store.prepared() == ["t1"]
+            await asyncio.sleep(0.2)
+            with open(os.path.join(cluster.decisions, "t1")) as f:
+                decision = f.read()
+            return cluster.servers[0].store.prepared(), decision, await cluster.store.reserve([booking(buses[0], 3)])
+
+    assert asyncio.run(scenario()) == ([], "abort", ["booked"])
+
+
+def test_cursor_resumes_every_shard_where_it_left_off(shards, buses, tmp_path):
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            for seat in (1, 2, 3):
+                await cluster.store.reserve([booking(buses[1], seat)])
+            first = await cluster.store.page({}, -1, 2)
+            # Booked after the first page, at a local position the cursor has passed on the other shard
+            await cluster.store.reserve([booking(buses[0], 9)])
+            second = await cluster.store.page({}, first[-1][0], 10)
+            return first, second
+
+    first, second = asyncio.run(scenario())
+    assert [b["seat_number"] for _, b in first] == [1, 2]
+    assert sorted((b["bus_id"], b["seat_number"]) for _, b in second) == [(buses[0], 9), (buses[1], 3)]
+    positions = [position for position, _ in first + second]
+    assert positions == sorted(positions)
+
+
+def test_unreadable_response_fails_the_waiting_call(shards, tmp_path):
+    async def garbage(reader, writer):
+        await reader.read(1)
+        writer.write(b"\x00\x00\x00\x03{{{")
+
+    async def scenario():
+        path = str(tmp_path / "garbage.sock")
+        server = await asyncio.start_unix_server(garbage, path)
+        client = shards.ShardClient(path)
+        try:
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(client.call("info"), 1)
+        finally:
+            await client.close()
+            server.close()
+
+    asyncio.run(scenario())
+
+
+def test_restarted_shard_applies_a_recorded_commit(shards, buses, tmp_path, monkeypatch):
+    monkeypatch.setattr(shards, "PREPARE_TIMEOUT", 0.05)
+
+    async def scenario():
+        async with Cluster(shards, str(tmp_path), durable=True) as cluster:
+            await cluster.store.clients[0].call("prepare", transaction="t2", bookings=[booking(buses[0], 5)])
+            # The coordinator decided to commit, then went away before telling the shard
+            await shards.DecisionLog(cluster.decisions).decide("t2", "commit")
+            cluster.servers[0]._expiries.pop("t2").cancel()
+            await cluster.stop_shard(0)
+            server = await cluster.start_shard(0)
+            replayed = server.store.prepared()
+            await asyncio.sleep(0.2)
+            bookings = [b for _, b in await cluster.store.page({"bus_id": buses[0]}, -1, 10)]
+            return replayed, server.store.prepared(), bookings
+
+    replayed, prepared, bookings = asyncio.run(scenario())
+    assert replayed == ["t2"]
+    assert prepared == []
+    assert [b["seat_number"] for b in bookings] == [5]
+
+
+def test_coordinator_refuses_a_different_shard_count(shards, tmp_path):
+    async def scenario():
+        async with Cluster(shards, str(tmp_path)) as cluster:
+            mismatched = shards.ShardedBookingStore(cluster.directory, 1, cluster.decisions)
+            try:
+                with pytest.raises(RuntimeError):
+                    await mismatched.open()
+            finally:
+                await mismatched.close()
+
+    asyncio.run(scenario())
+    shards.check_shard_count(str(tmp_path / "data"), 2)
+    shards.check_shard_count(str(tmp_path / "data"), 2)
+    with pytest.raises(SystemExit):
+        shards.check_shard_count(str(tmp_path / "data"), 3)
+
+
+def test_decision_log_keeps_the_first_outcome(shards, tmp_path):
+    async def scenario():
+        log = shards.DecisionLog(str(tmp_path))
+        first = await log.decide("t", "commit")
+        second = await log.decide("t", "abort")
+        await log.forget("t")
+        await log.forget("t")
+        return first, second, await log.decide("t", "abort")
+
+    assert asyncio.run(scenario()) == ("commit", "commit", "abort")
+    assert sorted(os.listdir(tmp_path)) == ["t"]
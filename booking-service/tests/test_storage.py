@@ -0,0 +1,91 @@
+import asyncio
+from datetime import date
+
+import pytest
+
+from buscommon.wal import WriteAheadLog
+
+JOURNEY = date(2024, 6, 1)
+
+
+@pytest.fixture(scope="module")
+def storage(service_module):
+    return service_module("booking-service", "storage")
+
+
+def booking(seat: int, bus_id: str = "bus-1") -> dict:
+    return {"user_id": "u1", "bus_id": bus_id, "seat_number": seat, "journey_date": JOURNEY, "agent_id": None}
+
+
+async def seats(store) -> list:
+    return sorted(b["seat_number"] for _, b in await store.page({}, -1, 100))
+
+
+def test_batch_is_all_or_nothing(storage):
+    async def scenario():
+        store = storage.MemoryBookingStore()
+        assert await store.reserve([booking(1), booking(2)]) == ["booked", "booked"]
+        statuses = await store.reserve([booking(3), booking(2), booking(3), booking(0)])
+        return statuses, await seats(store)
+
+    statuses, booked = asyncio.run(scenario())
+    assert statuses == ["not_booked", "seat_already_booked", "duplicate_in_batch", "invalid_seat_number"]
+    assert booked == [1, 2]
+
+
+def test_failed_log_write_rolls_the_booking_back(storage, tmp_path, failing_writes):
+    async def scenario():
+        store = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path), commit_window=0.001))
+        await store.open()
+        await store.reserve([booking(1)])
+        version = await store.data_version()
+        with failing_writes(store.wal), pytest.raises(OSError):
+            await store.reserve([booking(2), booking(3)])
+        state = await seats(store), version != await store.data_version()
+        assert await store.reserve([booking(2)]) == ["booked"]
+        await store.close()
+        return state
+
+    assert asyncio.run(scenario()) == ([1], True)
+
+
+def test_prepared_transactions_survive_a_restart(storage, tmp_path):
+    async def write():
+        store = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path), commit_window=0.001))
+        await store.open()
+        await store.prepare("committed", [booking(1)])
+        await store.prepare("aborted", [booking(2)])
+        await store.prepare("open", [booking(3)])
+        assert await store.commit("committed")
+        await store.abort("aborted")
+        assert not await store.commit("aborted")
+        await store.close()
+
+    async def reopen():
+        store = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path)))
+        await store.open()
+        state = store.prepared(), await seats(store)
+        statuses = [await store.reserve([booking(seat)]) for seat in (1, 2, 3)]
+        await store.close()
+        return state, statuses
+
+    asyncio.run(write())
+    (prepared, booked), statuses = asyncio.run(reopen())
+    assert prepared == ["open"]
+    assert booked == [1]
+    assert statuses == [["seat_already_booked"], ["booked"], ["seat_already_booked"]]
+
+
+def test_failed_commit_keeps_the_seats_held(storage, tmp_path, failing_writes):
+    async def scenario():
+        store = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path), commit_window=0.001))
+        await store.open()
+        await store.prepare("t", [booking(4)])
+        with failing_writes(store.wal), pytest.raises(OSError):
+            await store.commit("t")
+        state = store.prepared(), await seats(store)
+        assert await store.commit("t")
+        await store.close()
+        return state, await seats(store)
+
+    assert asyncio.run(scenario()) == ((["t"], []), [4])
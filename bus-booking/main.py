@@ -1,50 +1,212 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
+import asyncio
+import json
+import logging
+import os
+import time
 import uuid
-from datetime import datetime
+
+from buscommon.listing import (
+    MAX_PAGE_SIZE, NDJSON_MEDIA_TYPE, STREAM_CHUNK_SIZE,
+    decode_cursor, encode_cursor, json_array_stream, ndjson_stream,
+)
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.outbox import EventOutbox
+from buscommon.snapshots import etag_matches, not_modified, version_etag
+from buscommon.wal import WriteAheadLog
+
+from storage import ACTIVE_STATUSES, open_store, timestamp
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Bus Booking Service")
 
-# In-memory storage
-bookings = {}
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Storage backend: memory:// (default) or sqlite:///path/to/bookings.db
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+
+# Durability for the memory backend: bookings are logged under DATA_DIR when it is set
+DATA_DIR = os.getenv("DATA_DIR")
+wal = WriteAheadLog(
+    DATA_DIR,
+    commit_window=float(os.getenv("WAL_COMMIT_WINDOW_MS", "2")) / 1000,
+    snapshot_every=int(os.getenv("WAL_SNAPSHOT_EVERY", "100000")),
+) if DATA_DIR and STORAGE_URL.startswith("memory://") else None
+
+# Seat holds: how long a held seat waits for confirmation, and how often expired holds are released
+HOLD_TTL_SECONDS = float(os.getenv("HOLD_TTL_SECONDS", "600"))
+HOLD_SWEEP_INTERVAL = float(os.getenv("HOLD_SWEEP_INTERVAL", "1"))
+
+# Seats taken and freed are reported to bus-service in the background; an empty URL turns this off
+outbox = EventOutbox(
+    os.getenv("BOOKING_EVENTS_URL", "http://bus-service:8002/events/bookings"),
+    "bus-booking",
+    batch_size=int(os.getenv("BOOKING_EVENTS_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("BOOKING_EVENTS_FLUSH_MS", "50")) / 1000,
+    # Undelivered events survive a restart when DATA_DIR is set
+    directory=DATA_DIR,
+    commit_window=float(os.getenv("WAL_COMMIT_WINDOW_MS", "2")) / 1000,
+    snapshot_every=int(os.getenv("WAL_SNAPSHOT_EVERY", "100000")),
+)
+
+store = open_store(STORAGE_URL, wal, hold_tick=HOLD_SWEEP_INTERVAL, on_seat_change=outbox.publish)
+hold_sweeper: Optional[asyncio.Task] = None
 
 class Booking(BaseModel):
     user_id: str
     bus_id: str
     seat_number: int
     journey_date: str
+    # "confirmed", or "held" to reserve the seat for HOLD_TTL_SECONDS until POST /bookings/{id}/confirm
     status: str = "confirmed"
 
+async def release_expired_holds():
+    """Free the seats of holds that were not confirmed in time"""
+    while True:
+        await asyncio.sleep(HOLD_SWEEP_INTERVAL)
+        try:
+            released = await store.expire_holds(time.time())
+            if released:
+                logger.info(f"Released {released} expired seat holds")
+        except Exception:
+            logger.exception("Releasing expired holds failed")
+
+@app.on_event("startup")
+async def startup_event():
+    global hold_sweeper
+    await store.open()
+    await outbox.start()
+    hold_sweeper = asyncio.ensure_future(release_expired_holds())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    if hold_sweeper is not None:
+        hold_sweeper.cancel()
+    await outbox.close()
+    await store.close()
+
 @app.get("/")
 async def root():
     return {"message": "Welcome to Bus Booking Service"}
 
+@app.get("/events/outbox")
+async def get_outbox():
+    """Delivery state of the booking events sent to bus-service"""
+    return outbox.stats()
+
+async def _document_chunks(filters: dict, after: int):
+    """Encoded bookings after the cursor, fetched from the store a chunk at a time"""
+    while True:
+        page = await store.page(filters, after, STREAM_CHUNK_SIZE)
+        yield [json.dumps(booking) for _, booking in page]
+        if len(page) < STREAM_CHUNK_SIZE:
+            return
+        after = page[-1][0]
+
 @app.get("/bookings")
-async def get_bookings():
-    return list(bookings.values())
+async def get_bookings(
+    request: Request,
+    response: Response,
+    user_id: Optional[str] = None,
+    bus_id: Optional[str] = None,
+    journey_date: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+):
+    """List bookings.
+
+    Without ``limit``/``cursor`` the whole store is streamed as a JSON array.
+    With them a page is returned along with ``next_cursor``. Sending
+    ``Accept: application/x-ndjson`` streams one booking per line instead.
+    The ETag changes whenever a booking is created or changes status, and
+    sending it back as ``If-None-Match`` gets a 304 while nothing has.
+    """
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    try:
+        after = decode_cursor(cursor) if cursor else -1
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    accept = request.headers.get("accept", "")
+    etag = version_etag(await store.data_version(), str(request.url.query), accept)
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag, "Accept")
+
+    filters = {"user_id": user_id, "bus_id": bus_id, "journey_date": journey_date}
+    paginated = limit is not None or cursor is not None
+    validators = {"ETag": etag, "Vary": "Accept"}
+
+    if not paginated:
+        chunks = _document_chunks(filters, after)
+        if NDJSON_MEDIA_TYPE in accept:
+            return StreamingResponse(ndjson_stream(chunks), media_type=NDJSON_MEDIA_TYPE, headers=validators)
+        return StreamingResponse(json_array_stream(chunks), media_type="application/json", headers=validators)
+
+    page_size = limit or MAX_PAGE_SIZE
+    page = await store.page(filters, after, page_size)
+    next_cursor = encode_cursor(page[-1][0]) if len(page) == page_size else None
+
+    if NDJSON_MEDIA_TYPE in accept:
+        headers = dict(validators)
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+
+        async def single_chunk():
+            yield [json.dumps(booking) for _, booking in page]
+        return StreamingResponse(ndjson_stream(single_chunk()), media_type=NDJSON_MEDIA_TYPE, headers=headers)
+
+    response.headers.update(validators)
+    return {"bookings": [booking for _, booking in page], "next_cursor": next_cursor}
 
 @app.post("/bookings")
 async def create_booking(booking: Booking):
+    if booking.status not in ACTIVE_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(ACTIVE_STATUSES)}")
     booking_id = str(uuid.uuid4())
     booking_dict = booking.dict()
     booking_dict["booking_id"] = booking_id
-    booking_dict["created_at"] = datetime.now().isoformat()
-    bookings[booking_id] = booking_dict
+    now = time.time()
+    booking_dict["created_at"] = timestamp(now)
+    booking_dict["expires_at"] = timestamp(now + HOLD_TTL_SECONDS) if booking.status == "held" else None
+    if not await store.create(booking_dict):
+        raise HTTPException(status_code=400, detail="Seat already booked")
+    await outbox.persisted()
     return booking_dict
 
 @app.get("/bookings/{booking_id}")
 async def get_booking(booking_id: str):
-    if booking_id not in bookings:
+    booking = await store.get(booking_id)
+    if booking is None:
+        raise HTTPException(status_code=404, detail="Booking not found")
+    return booking
+
+@app.post("/bookings/{booking_id}/confirm")
+async def confirm_booking(booking_id: str):
+    booking = await store.confirm(booking_id)
+    await outbox.persisted()
+    if booking is None:
         raise HTTPException(status_code=404, detail="Booking not found")
-    return bookings[booking_id]
+    if booking["status"] != "confirmed":
+        raise HTTPException(status_code=400, detail=f"Booking is {booking['status']}")
+    return booking
 
 @app.delete("/bookings/{booking_id}")
 async def cancel_booking(booking_id: str):
-    if booking_id not in bookings:
+    booking = await store.cancel(booking_id)
+    await outbox.persisted()
+    if booking is None:
         raise HTTPException(status_code=404, detail="Booking not found")
-    booking = bookings[booking_id]
-    booking["status"] = "cancelled"
     return booking
 
 if __name__ == "__main__":
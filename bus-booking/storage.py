@@ -0,0 +1,512 @@
+#storage backends for the bus booking service
+import asyncio
+import math
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime, timezone
+from itertools import islice
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from buscommon.listing import PositionIndex
+from buscommon.sqlite import SQLitePool, write_transaction
+from buscommon.wal import WriteAheadLog
+
+from timing_wheel import TimingWheel
+
+# (position, booking) pairs; positions only grow and back listing cursors
+Page = List[Tuple[int, dict]]
+
+BOOKING_FIELDS = (
+    "user_id", "bus_id", "seat_number", "journey_date", "status", "booking_id", "created_at", "expires_at",
+)
+# Statuses that keep a seat from being booked by anyone else
+ACTIVE_STATUSES = ("held", "confirmed")
+
+
+def _seat(booking: dict) -> Tuple[str, str, int]:
+    return booking["bus_id"], booking["journey_date"], booking["seat_number"]
+
+
+def timestamp(seconds: float) -> str:
+    """Fixed-width UTC time, so timestamps compare correctly as strings and do not move with DST"""
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat(timespec="microseconds")
+
+
+def _deadline(booking: dict) -> float:
+    """When a held booking's hold runs out, as a unix timestamp; never for holds made without one"""
+    expires_at = booking.get("expires_at")
+    return datetime.fromisoformat(expires_at).timestamp() if expires_at else math.inf
+
+
+class BookingStore:
+    """Interface of the booking storage backends; bookings are plain dicts keyed by ``BOOKING_FIELDS``.
+
+    ``on_seat_change(event_type, booking)`` is called once for every booking
+    that takes a seat ("booking.created") or gives one back
+    ("booking.cancelled", "booking.expired"), in the order the changes
+    happened and only once they are stored; replaying the write-ahead log
+    does not call it.
+    """
+
+    on_seat_change: Optional[Callable[[str, dict], None]] = None
+
+    def _notify(self, event_type: str, booking: dict):
+        if self.on_seat_change is not None:
+            self.on_seat_change(event_type, booking)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def create(self, booking: dict) -> bool:
+        """Store a booking unless its seat is already held or booked; False if it is"""
+        raise NotImplementedError
+
+    async def get(self, booking_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def cancel(self, booking_id: str) -> Optional[dict]:
+        """Mark a booking cancelled and return it, or None if it does not exist"""
+        raise NotImplementedError
+
+    async def confirm(self, booking_id: str) -> Optional[dict]:
+        """Turn a live hold into a confirmed booking and return the booking, or None if it does not exist.
+
+        A hold that has run out is marked expired instead; the returned
+        status tells the caller which happened.
+        """
+        raise NotImplementedError
+
+    async def expire_holds(self, now: float) -> int:
+        """Release every hold whose deadline is at or before ``now``; returns how many"""
+        raise NotImplementedError
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        """Up to ``limit`` bookings after position ``after`` matching every non-None filter"""
+        raise NotImplementedError
+
+    async def data_version(self) -> str:
+        """Token that changes whenever a booking is created or changes status"""
+        raise NotImplementedError
+
+
+class MemoryBookingStore(BookingStore):
+    """Bookings in process memory, optionally made durable by a write-ahead log.
+
+    Live holds sit in a timing wheel keyed by booking id, so releasing
+    expired holds touches only the holds that are due.
+    """
+
+    def __init__(self, wal: Optional[WriteAheadLog] = None, hold_tick: float = 1.0,
+                 on_seat_change: Optional[Callable[[str, dict], None]] = None):
+        self.wal = wal
+        self.on_seat_change = on_seat_change
+        self.bookings: Dict[str, dict] = {}
+        # Booking ids in creation order, so listings can resume from a cursor;
+        # None where a create was taken back because its log write failed
+        self.order: List[Optional[str]] = []
+        self.index = PositionIndex("user_id", "bus_id", "journey_date")
+        # (bus_id, journey_date, seat_number) -> id of the held or confirmed booking of that seat
+        self.seats: Dict[Tuple[str, str, int], str] = {}
+        self.holds = TimingWheel(tick=hold_tick, now=time.time())
+        # The epoch keeps versions from before a restart from matching
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+
+    def _store(self, booking: dict) -> int:
+        self.version += 1
+        position = len(self.order)
+        self.bookings[booking["booking_id"]] = booking
+        self.index.add(position, user_id=booking["user_id"], bus_id=booking["bus_id"],
+                       journey_date=booking["journey_date"])
+        self.order.append(booking["booking_id"])
+        if booking["status"] in ACTIVE_STATUSES:
+            self.seats[_seat(booking)] = booking["booking_id"]
+        if booking["status"] == "held" and booking.get("expires_at"):
+            self.holds.schedule(booking["booking_id"], _deadline(booking))
+        return position
+
+    def _unstore(self, booking: dict, position: int):
+        """Take back a booking whose create never reached the log; its position stays empty"""
+        self.version += 1
+        del self.bookings[booking["booking_id"]]
+        self.order[position] = None
+        self.holds.cancel(booking["booking_id"])
+        self._free(booking)
+
+    def _end(self, booking: dict, status: str):
+        """Give a booking its final ``status``; the seat is freed separately, by ``_free``"""
+        self.version += 1
+        booking["status"] = status
+        self.holds.cancel(booking["booking_id"])
+
+    def _reopen(self, booking: dict, status: str, expires_at: Optional[str]):
+        """Put back the status and hold deadline a booking had before ``_end`` or ``_confirm``"""
+        self.version += 1
+        booking["status"] = status
+        booking["expires_at"] = expires_at
+        if status == "held" and expires_at:
+            self.holds.schedule(booking["booking_id"], _deadline(booking))
+
+    def _free(self, booking: dict):
+        if self.seats.get(_seat(booking)) == booking["booking_id"]:
+            del self.seats[_seat(booking)]
+
+    def _release(self, booking: dict, status: str):
+        """End a booking with ``status``, freeing its seat"""
+        self._end(booking, status)
+        self._free(booking)
+
+    def _confirm(self, booking: dict):
+        self.version += 1
+        booking["status"] = "confirmed"
+        booking["expires_at"] = None
+        self.holds.cancel(booking["booking_id"])
+
+    def _apply(self, record: dict):
+        if record["op"] == "create":
+            # Holds past their deadline that the new booking's seat was taken from
+            for booking_id in record.get("expired", []):
+                self._release(self.bookings[booking_id], "expired")
+            self._store(record["booking"])
+        elif record["op"] == "cancel":
+            self._release(self.bookings[record["booking_id"]], "cancelled")
+        elif record["op"] == "confirm":
+            self._confirm(self.bookings[record["booking_id"]])
+        elif record["op"] == "expire":
+            for booking_id in record["booking_ids"]:
+                self._release(self.bookings[booking_id], "expired")
+
+    async def _log(self, record: dict, undo: Optional[Callable[[], None]] = None,
+                   done: Optional[Callable[[], None]] = None):
+        """Wait for a record to be group-committed, then run ``done``; run ``undo`` instead if the write fails.
+
+        Changes are made in memory first, as the snapshots assume. Seats
+        given back are freed and events sent by ``done``, only once the
+        record is on disk, so nothing can take a seat or act on an event
+        that a failed write takes back. Both run from the log's own future,
+        so they also run when the request waiting on it has been cancelled.
+        """
+        if self.wal is None:
+            if done is not None:
+                done()
+            return
+        future = self.wal.append(record)
+
+        def settle(future: asyncio.Future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                if undo is not None:
+                    undo()
+            elif done is not None:
+                done()
+        future.add_done_callback(settle)
+        await asyncio.shield(future)
+
+    async def open(self):
+        """Rebuild bookings from the last snapshot and the log written after it"""
+        if self.wal is None:
+            return
+        for booking in self.wal.load_snapshot() or []:
+            self._store(booking)
+        for record in self.wal.records():
+            self._apply(record)
+        # Cancellation mutates booking dicts, so the snapshot copies each of them
+        await self.wal.start(lambda: [dict(self.bookings[booking_id]) for booking_id in self.order
+                                      if booking_id is not None])
+
+    async def close(self):
+        if self.wal is not None:
+            await self.wal.close()
+
+    async def _expire(self, booking_ids: List[str]):
+        bookings = [self.bookings[booking_id] for booking_id in booking_ids]
+        before = [(booking["status"], booking.get("expires_at")) for booking in bookings]
+        for booking in bookings:
+            self._end(booking, "expired")
+
+        def undo():
+            for booking, (status, expires_at) in zip(bookings, before):
+                self._reopen(booking, status, expires_at)
+
+        def done():
+            for booking in bookings:
+                self._free(booking)
+                self._notify("booking.expired", booking)
+        await self._log({"op": "expire", "booking_ids": booking_ids}, undo, done)
+
+    async def create(self, booking: dict) -> bool:
+        holder = self.seats.get(_seat(booking)) if booking["status"] in ACTIVE_STATUSES else None
+        expired = None
+        if holder is not None:
+            expired = self.bookings[holder]
+            if expired["status"] != "held" or _deadline(expired) > time.time():
+                return False
+            # A hold past its deadline that the sweeper has not reached yet; the new booking takes its seat
+            expires_at = expired.get("expires_at")
+            self._end(expired, "expired")
+        position = self._store(booking)
+
+        def undo():
+            self._unstore(booking, position)
+            if expired is not None:
+                self._reopen(expired, "held", expires_at)
+                self.seats[_seat(expired)] = expired["booking_id"]
+
+        def done():
+            if expired is not None:
+                self._notify("booking.expired", expired)
+            if booking["status"] in ACTIVE_STATUSES:
+                self._notify("booking.created", booking)
+        record = {"op": "create", "booking": booking}
+        if expired is not None:
+            record["expired"] = [holder]
+        await self._log(record, undo, done)
+        return True
+
+    async def get(self, booking_id: str) -> Optional[dict]:
+        return self.bookings.get(booking_id)
+
+    async def cancel(self, booking_id: str) -> Optional[dict]:
+        booking = self.bookings.get(booking_id)
+        if booking is None:
+            return None
+        status, expires_at = booking["status"], booking.get("expires_at")
+        self._end(booking, "cancelled")
+
+        def done():
+            self._free(booking)
+            if status in ACTIVE_STATUSES:
+                self._notify("booking.cancelled", booking)
+        await self._log({"op": "cancel", "booking_id": booking_id},
+                        lambda: self._reopen(booking, status, expires_at), done)
+        return booking
+
+    async def confirm(self, booking_id: str) -> Optional[dict]:
+        booking = self.bookings.get(booking_id)
+        if booking is None or booking["status"] != "held":
+            return booking
+        if _deadline(booking) <= time.time():
+            await self._expire([booking_id])
+        else:
+            expires_at = booking.get("expires_at")
+            self._confirm(booking)
+            await self._log({"op": "confirm", "booking_id": booking_id},
+                            lambda: self._reopen(booking, "held", expires_at))
+        return booking
+
+    async def expire_holds(self, now: float) -> int:
+        expired = self.holds.advance(now)
+        if expired:
+            await self._expire(expired)
+        return len(expired)
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        matches = (
+            (position, self.bookings[self.order[position]])
+            for position in self.index.scan(filters, after, len(self.order))
+            if self.order[position] is not None
+            and all(value is None or self.bookings[self.order[position]][field] == value
+                   for field, value in filters.items())
+        )
+        return list(islice(matches, limit))
+
+    async def data_version(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bookings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    booking_id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL,
+    bus_id TEXT NOT NULL,
+    seat_number INTEGER NOT NULL,
+    journey_date TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    expires_at TEXT
+);
+CREATE INDEX IF NOT EXISTS bookings_seat ON bookings (bus_id, journey_date, seat_number);
+CREATE INDEX IF NOT EXISTS bookings_user ON bookings (user_id, id);
+CREATE INDEX IF NOT EXISTS bookings_bus ON bookings (bus_id, id);
+CREATE INDEX IF NOT EXISTS bookings_journey_date ON bookings (journey_date, id);
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO data_version (id, epoch, version) VALUES (1, lower(hex(randomblob(6))), 0);
+CREATE TRIGGER IF NOT EXISTS bookings_inserted AFTER INSERT ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS bookings_updated AFTER UPDATE ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS bookings_deleted AFTER DELETE ON bookings
+BEGIN UPDATE data_version SET version = version + 1; END;
+"""
+
+_COLUMNS = ", ".join(BOOKING_FIELDS)
+_INSERT = f"INSERT INTO bookings ({_COLUMNS}) VALUES ({', '.join('?' for _ in BOOKING_FIELDS)})"
+_SELECT_ONE = f"SELECT {_COLUMNS} FROM bookings WHERE booking_id = ?"
+_CANCEL = "UPDATE bookings SET status = 'cancelled' WHERE booking_id = ?"
+_SEAT_HOLDERS = (
+    f"SELECT {_COLUMNS} FROM bookings WHERE bus_id = ? AND journey_date = ? AND seat_number = ?"
+    " AND status IN ('held', 'confirmed')"
+)
+_CONFIRM = (
+    "UPDATE bookings SET status = 'confirmed', expires_at = NULL"
+    " WHERE booking_id = ? AND status = 'held' AND expires_at > ?"
+)
+_EXPIRE_ONE = "UPDATE bookings SET status = 'expired' WHERE booking_id = ? AND status = 'held'"
+# The partial index holds only live holds, so the sweep reads just the expired ones
+_DUE_HOLDS = f"SELECT {_COLUMNS} FROM bookings WHERE status = 'held' AND expires_at <= ?"
+_EXPIRE_DUE = "UPDATE bookings SET status = 'expired' WHERE status = 'held' AND expires_at <= ?"
+_HOLD_EXPIRY_INDEX = "CREATE INDEX IF NOT EXISTS bookings_hold_expiry ON bookings (expires_at) WHERE status = 'held'"
+
+
+def _migrate(connection: sqlite3.Connection):
+    """Add the hold deadline column to databases created before holds existed"""
+    with write_transaction(connection):
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(bookings)")}
+        if "expires_at" not in columns:
+            connection.execute("ALTER TABLE bookings ADD COLUMN expires_at TEXT")
+        connection.execute(_HOLD_EXPIRY_INDEX)
+
+
+def _row_to_booking(row: sqlite3.Row) -> dict:
+    return {field: row[field] for field in BOOKING_FIELDS}
+
+
+class SQLiteBookingStore(BookingStore):
+    """Bookings in a SQLite database shared by every worker process.
+
+    Holds are swept with one UPDATE over a partial index of live holds, so
+    every worker can run the sweep and each pass reads only expired rows.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4,
+                 on_seat_change: Optional[Callable[[str, dict], None]] = None):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: Optional[SQLitePool] = None
+        self.on_seat_change = on_seat_change
+
+    async def open(self):
+        self.pool = SQLitePool(self.path, self.pool_size, SQLITE_SCHEMA)
+        await self.pool.run(_migrate)
+
+    async def close(self):
+        self.pool.close()
+
+    async def create(self, booking: dict) -> bool:
+        active = booking["status"] in ACTIVE_STATUSES
+
+        def insert(connection):
+            with write_transaction(connection):
+                holders = []
+                if active:
+                    holders = [_row_to_booking(row) for row in connection.execute(_SEAT_HOLDERS, _seat(booking))]
+                now = timestamp(time.time())
+                if any(holder["status"] != "held" or not holder["expires_at"] or holder["expires_at"] > now
+                       for holder in holders):
+                    return None
+                # Holds past their deadline that no sweep has reached yet are released first
+                for holder in holders:
+                    connection.execute(_EXPIRE_ONE, (holder["booking_id"],))
+                    holder["status"] = "expired"
+                connection.execute(_INSERT, [booking.get(field) for field in BOOKING_FIELDS])
+            return holders
+
+        expired = await self.pool.run(insert)
+        if expired is None:
+            return False
+        for holder in expired:
+            self._notify("booking.expired", holder)
+        if active:
+            self._notify("booking.created", booking)
+        return True
+
+    async def get(self, booking_id: str) -> Optional[dict]:
+        def fetch(connection):
+            row = connection.execute(_SELECT_ONE, (booking_id,)).fetchone()
+            return _row_to_booking(row) if row else None
+        return await self.pool.run(fetch)
+
+    async def cancel(self, booking_id: str) -> Optional[dict]:
+        def update(connection):
+            with write_transaction(connection):
+                row = connection.execute(_SELECT_ONE, (booking_id,)).fetchone()
+                if row is not None:
+                    connection.execute(_CANCEL, (booking_id,))
+            return _row_to_booking(row) if row else None
+
+        booking = await self.pool.run(update)
+        if booking is None:
+            return None
+        active = booking["status"] in ACTIVE_STATUSES
+        booking["status"] = "cancelled"
+        if active:
+            self._notify("booking.cancelled", booking)
+        return booking
+
+    async def confirm(self, booking_id: str) -> Optional[dict]:
+        def update(connection):
+            with write_transaction(connection):
+                expired = False
+                if connection.execute(_CONFIRM, (booking_id, timestamp(time.time()))).rowcount == 0:
+                    # Not a live hold: either already settled or past its deadline
+                    expired = connection.execute(_EXPIRE_ONE, (booking_id,)).rowcount == 1
+                row = connection.execute(_SELECT_ONE, (booking_id,)).fetchone()
+            return _row_to_booking(row) if row else None, expired
+
+        booking, expired = await self.pool.run(update)
+        if expired:
+            self._notify("booking.expired", booking)
+        return booking
+
+    async def expire_holds(self, now: float) -> int:
+        def sweep(connection):
+            with write_transaction(connection):
+                due = connection.execute(_DUE_HOLDS, (timestamp(now),)).fetchall()
+                if due:
+                    connection.execute(_EXPIRE_DUE, (timestamp(now),))
+            return [dict(_row_to_booking(row), status="expired") for row in due]
+
+        expired = await self.pool.run(sweep)
+        for booking in expired:
+            self._notify("booking.expired", booking)
+        return len(expired)
+
+    async def page(self, filters: Dict[str, Any], after: int, limit: int) -> Page:
+        clauses, params = ["id > ?"], [after]
+        for field in ("user_id", "bus_id", "journey_date"):
+            if filters.get(field) is not None:
+                clauses.append(f"{field} = ?")
+                params.append(filters[field])
+        sql = f"SELECT id, {_COLUMNS} FROM bookings WHERE {' AND '.join(clauses)} ORDER BY id LIMIT ?"
+        params.append(limit)
+
+        def fetch(connection):
+            return [(row["id"], _row_to_booking(row)) for row in connection.execute(sql, params)]
+        return await self.pool.run(fetch)
+
+    async def data_version(self) -> str:
+        def fetch(connection):
+            epoch, version = connection.execute("SELECT epoch, version FROM data_version").fetchone()
+            return f"{epoch}-{version}"
+        return await self.pool.run(fetch)
+
+
+def open_store(url: str, wal: Optional[WriteAheadLog] = None, hold_tick: float = 1.0,
+               on_seat_change: Optional[Callable[[str, dict], None]] = None) -> BookingStore:
+    """Build the backend named by a storage URL: ``memory://`` or ``sqlite:///path/to.db``"""
+    if url.startswith("sqlite://"):
+        return SQLiteBookingStore(url[len("sqlite://"):], int(os.getenv("SQLITE_POOL_SIZE", "4")), on_seat_change)
+    if url.startswith("memory://"):
+        return MemoryBookingStore(wal, hold_tick, on_seat_change)
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import uuid
+
+import pytest
+
+from buscommon.wal import WriteAheadLog
+
+
+@pytest.fixture(scope="module")
+def storage(service_module):
+    return service_module("bus-booking", "storage")
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_store(request, storage, tmp_path):
+    def make(events):
+        if request.param == "sqlite":
+            url = f"sqlite:///{tmp_path}/bookings.db"
+        else:
+            url = "memory://"
+        return storage.open_store(url, hold_tick=0.1, on_seat_change=lambda kind, booking: events.append(kind))
+    return make
+
+
+def booking(storage, seat: int, status: str = "confirmed", expires: float = None) -> dict:
+    return {
+        "user_id": "u1", "bus_id": "b1", "seat_number": seat, "journey_date": "2024-06-01",
+        "status": status, "booking_id": str(uuid.uuid4()), "created_at": storage.timestamp(time.time()),
+        "expires_at": storage.timestamp(expires) if expires is not None else None,
+    }
+
+
+def test_hold_blocks_the_seat_until_it_expires(make_store, storage):
+    async def scenario():
+        events = []
+        store = make_store(events)
+        await store.open()
+        now = time.time()
+        hold = booking(storage, 3, "held", now + 60)
+        assert await store.create(hold)
+        assert not await store.create(booking(storage, 3))
+        assert await store.expire_holds(now + 30) == 0
+        assert await store.expire_holds(now + 61) == 1
+        assert (await store.get(hold["booking_id"]))["status"] == "expired"
+        assert await store.create(booking(storage, 3))
+        await store.close()
+        return events
+
+    assert asyncio.run(scenario()) == ["booking.created", "booking.expired", "booking.created"]
+
+
+def test_confirm_ends_the_hold(make_store, storage):
+    async def scenario():
+        store = make_store([])
+        await store.open()
+        now = time.time()
+        hold = booking(storage, 4, "held", now + 60)
+        await store.create(hold)
+        confirmed = await store.confirm(hold["booking_id"])
+        assert confirmed["status"] == "confirmed" and confirmed["expires_at"] is None
+        assert await store.expire_holds(now + 120) == 0
+        assert not await store.create(booking(storage, 4))
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_confirming_a_lapsed_hold_expires_it(make_store, storage):
+    async def scenario():
+        store = make_store([])
+        await store.open()
+        hold = booking(storage, 5, "held", time.time() - 1)
+        await store.create(hold)
+        assert (await store.confirm(hold["booking_id"]))["status"] == "expired"
+        assert await store.create(booking(storage, 5))
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_lapsed_hold_not_yet_swept_does_not_block_the_seat(make_store, storage):
+    async def scenario():
+        store = make_store([])
+        await store.open()
+        hold = booking(storage, 6, "held", time.time() - 1)
+        await store.create(hold)
+        assert await store.create(booking(storage, 6))
+        assert (await store.get(hold["booking_id"]))["status"] == "expired"
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_failed_log_write_takes_the_change_back(storage, tmp_path, failing_writes):
+    async def scenario():
+        events = []
+        store = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path), commit_window=0.001),
+                                           on_seat_change=lambda kind, booking: events.append(kind))
+        await store.open()
+        now = time.time()
+        kept, hold = booking(storage, 1), booking(storage, 2, "held", now + 60)
+        assert await store.create(kept)
+        assert await store.create(hold)
+        with failing_writes(store.wal):
+            with pytest.raises(OSError):
+                await store.create(booking(storage, 3))
+            with pytest.raises(OSError):
+                await store.cancel(kept["booking_id"])
+            with pytest.raises(OSError):
+                await store.confirm(hold["booking_id"])
+            with pytest.raises(OSError):
+                await store.expire_holds(now + 61)
+        state = [(b["seat_number"], b["status"]) for _, b in await store.page({}, -1, 10)], list(events)
+        assert not await store.create(booking(storage, 1))
+        # The hold went back into the wheel, so the next sweep releases it
+        assert await store.expire_holds(now + 62) == 1
+        assert await store.create(booking(storage, 3))
+        await store.close()
+        return state, events
+
+    (listed, before), events = asyncio.run(scenario())
+    assert listed == [(1, "confirmed"), (2, "held")]
+    assert before == ["booking.created", "booking.created"]
+    assert events == before + ["booking.expired", "booking.created"]
+    replayed = storage.MemoryBookingStore(WriteAheadLog(str(tmp_path)))
+    asyncio.run(replayed.open())
+    assert [(b["seat_number"], b["status"]) for b in replayed.bookings.values()] == [
+        (1, "confirmed"), (2, "expired"), (3, "confirmed")]
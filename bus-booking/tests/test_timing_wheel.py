@@ -0,0 +1,53 @@
+import pytest
+
+
+@pytest.fixture(scope="module")
+def TimingWheel(service_module):
+    return service_module("bus-booking", "timing_wheel").TimingWheel
+
+
+def test_advance_returns_due_keys_only(TimingWheel):
+    wheel = TimingWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 2.5)
+    wheel.schedule("b", 5.0)
+    assert wheel.advance(2.0) == []
+    assert wheel.advance(3.0) == ["a"]
+    assert "a" not in wheel and "b" in wheel
+    assert wheel.advance(5.0) == ["b"]
+    assert len(wheel) == 0
+
+
+def test_key_a_revolution_later_stays_in_its_bucket(TimingWheel):
+    wheel = TimingWheel(tick=1.0, slots=4)
+    wheel.schedule("soon", 1.0)
+    wheel.schedule("later", 5.0)
+    assert wheel.slots[1] == {"soon": 1.0, "later": 5.0}
+    assert wheel.advance(1.0) == ["soon"]
+    assert wheel.advance(4.0) == []
+    assert wheel.advance(5.0) == ["later"]
+
+
+def test_advance_past_a_whole_revolution_expires_everything(TimingWheel):
+    wheel = TimingWheel(tick=1.0, slots=4)
+    for i in range(10):
+        wheel.schedule(i, float(i + 1))
+    assert sorted(wheel.advance(100.0)) == list(range(10))
+    assert len(wheel) == 0
+
+
+def test_reschedule_and_cancel(TimingWheel):
+    wheel = TimingWheel(tick=1.0, slots=8)
+    wheel.schedule("a", 2.0)
+    wheel.schedule("a", 6.0)
+    assert len(wheel) == 1
+    assert wheel.advance(3.0) == []
+    assert wheel.cancel("a")
+    assert not wheel.cancel("a")
+    assert wheel.advance(10.0) == []
+
+
+def test_deadline_in_the_past_expires_on_the_next_tick(TimingWheel):
+    wheel = TimingWheel(tick=1.0, slots=8, now=10.0)
+    wheel.schedule("late", 3.0)
+    assert wheel.advance(10.5) == []
+    assert wheel.advance(11.0) == ["late"]
@@ -0,0 +1,69 @@
+#hashed timing wheel for expiring seat holds
+import math
+from typing import Dict, Hashable, List
+
+
+class TimingWheel:
+    """Deadlines hashed into a ring of ``slots`` buckets, each ``tick`` seconds wide.
+
+    A key due at time t sits in bucket ceil(t / tick) % slots. ``advance``
+    only visits the buckets for the ticks that have passed since its last
+    call, so releasing expired keys costs O(expired) plus the few keys that
+    hashed into the same buckets but are due a whole revolution later,
+    however many keys are outstanding. Scheduling and cancelling are O(1).
+    Keys come out of ``advance`` at most one tick after their deadline.
+    """
+
+    def __init__(self, tick: float = 1.0, slots: int = 4096, now: float = 0.0):
+        self.tick = tick
+        self.slots: List[Dict[Hashable, float]] = [{} for _ in range(slots)]
+        # Last tick whose bucket has been visited
+        self._current = math.floor(now / tick)
+        # key -> bucket it is in, so it can be cancelled without a search
+        self._where: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._where
+
+    def schedule(self, key: Hashable, deadline: float):
+        """Expire ``key`` at ``deadline``, replacing any deadline it had"""
+        self.cancel(key)
+        due = max(math.ceil(deadline / self.tick), self._current + 1)
+        slot = due % len(self.slots)
+        self.slots[slot][key] = deadline
+        self._where[key] = slot
+
+    def cancel(self, key: Hashable) -> bool:
+        """Forget ``key``; False if it was not scheduled"""
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Remove and return every key whose deadline is at or before ``now``"""
+        target = math.floor(now / self.tick)
+        if target <= self._current:
+            return []
+        # After a full revolution every bucket has been passed over once
+        ticks = min(target - self._current, len(self.slots))
+        expired = []
+        for due in range(target - ticks + 1, target + 1):
+            slot = due % len(self.slots)
+            bucket = self.slots[slot]
+            if not bucket:
+                continue
+            later = {}
+            for key, deadline in bucket.items():
+                if deadline <= now:
+                    expired.append(key)
+                    del self._where[key]
+                else:
+                    later[key] = deadline
+            self.slots[slot] = later
+        self._current = target
+        return expired
@@ -0,0 +1,72 @@
+#booking events from the booking services, coalesced into per bus and date seat changes
+from datetime import date
+from typing import Dict, List, Tuple
+
+# Seats taken (+1) or given back (-1) by each event type
+SEAT_DELTAS = {"booking.created": 1, "booking.cancelled": -1, "booking.expired": -1}
+
+
+def unseen(events: List[dict], sequence: int) -> Tuple[List[dict], int]:
+    """Events after a source's high-water mark, and how many sequence numbers were skipped before them.
+
+    An outbox numbers its events one apart and delivers them in order, so
+    an event at or below the mark has been applied already, and a jump
+    past mark + 1 means the outbox dropped events.
+    """
+    fresh = [event for event in events if event["sequence"] > sequence]
+    missed = fresh[0]["sequence"] - sequence - 1 if fresh and sequence else 0
+    return fresh, missed
+
+
+def coalesce(events: List[dict]) -> Tuple[Dict[Tuple[str, date], Dict[int, int]], int]:
+    """Net seat change per (bus_id, journey_date) and seat, plus how many events were unusable.
+
+    A seat booked and cancelled within the batch nets to 0 and is not
+    touched at all.
+    """
+    groups: Dict[Tuple[str, date], Dict[int, int]] = {}
+    invalid = 0
+    for event in events:
+        delta = SEAT_DELTAS.get(event["type"])
+        try:
+            journey_date = date.fromisoformat(event["journey_date"])
+        except ValueError:
+            delta = None
+        if delta is None:
+            invalid += 1
+            continue
+        seats = groups.setdefault((event["bus_id"], journey_date), {})
+        seats[event["seat_number"]] = seats.get(event["seat_number"], 0) + delta
+    return groups, invalid
+
+
+def new_source(source: str, now: float) -> dict:
+    """Consumer state of an outbox seen for the first time"""
+    return {"source": source, "sequence": 0, "head": 0, "missed": 0, "applied_at": now, "delay": None}
+
+
+def advance(state: dict, head: int, fresh: List[dict], missed: int, now: float):
+    """Move a source's high-water mark past a batch that has just been applied"""
+    state["head"] = max(state["head"], head)
+    if fresh:
+        state["sequence"] = fresh[-1]["sequence"]
+        state["missed"] += missed
+        state["applied_at"] = now
+        state["delay"] = now - min(event["occurred_at"] for event in fresh)
+
+
+def lag_report(sources: List[dict], now: float) -> dict:
+    """How far the consumer is behind each outbox, from the per source state kept by the store"""
+    report = [
+        {
+            "source": state["source"],
+            "applied_sequence": state["sequence"],
+            "head_sequence": state["head"],
+            "lag_events": state["head"] - state["sequence"],
+            "missed_events": state["missed"],
+            "seconds_since_applied": now - state["applied_at"],
+            "last_batch_delay_seconds": state["delay"],
+        }
+        for state in sources
+    ]
+    return {"lag_events": sum(source["lag_events"] for source in report), "sources": report}
@@ -0,0 +1,158 @@
+#multi-leg journey planner for the bus service
+import heapq
+from bisect import insort
+from typing import Dict, List, Set, Tuple
+
+from route_index import city_key, parse_clock
+
+MINUTES_PER_DAY = 24 * 60
+SORT_KEYS = ("arrival", "price", "transfers")
+
+
+class _Trip:
+    """A daily bus run as an edge of the route graph"""
+
+    __slots__ = ("bus", "destination_key", "departure", "duration")
+
+    def __init__(self, bus: dict):
+        self.bus = bus
+        self.destination_key = city_key(bus["destination"])
+        self.departure = parse_clock(bus["departure_time"])
+        # An arrival at or before the departure time of day is on the next day
+        self.duration = (parse_clock(bus["arrival_time"]) - self.departure) % MINUTES_PER_DAY or MINUTES_PER_DAY
+
+
+class JourneyPlanner:
+    """Time-expanded route graph over the daily schedule of every bus.
+
+    Each city keeps its outgoing trips sorted by departure time, grouped
+    by destination as well, plus the set of cities with a trip into it. Buses run
+    every day, so from any moment the next run of a trip is found with
+    modular arithmetic instead of materialising one node per day. Adding a
+    bus is an insort into its source city, so the graph never needs a
+    rebuild.
+
+    Planning is a best-first search over partial itineraries ordered by
+    the requested criterion. Every criterion only grows as legs are added,
+    so itineraries reach the destination best-first, and each city is
+    expanded at most ``k`` times, which bounds the work for k results.
+    Trips into cities that cannot reach the destination with the legs left
+    are never queued, and the last leg only looks at direct trips to it.
+    """
+
+    def __init__(self):
+        # city -> every trip leaving it, and city -> destination -> trips on that route
+        self._departures: Dict[str, List[Tuple[int, str, _Trip]]] = {}
+        self._routes: Dict[str, Dict[str, List[Tuple[int, str, _Trip]]]] = {}
+        # city -> cities with a direct trip to it
+        self._predecessors: Dict[str, Set[str]] = {}
+
+    def add(self, bus: dict):
+        trip = _Trip(bus)
+        source = city_key(bus["source"])
+        entry = (trip.departure, bus["bus_id"], trip)
+        insort(self._departures.setdefault(source, []), entry)
+        insort(self._routes.setdefault(source, {}).setdefault(trip.destination_key, []), entry)
+        self._predecessors.setdefault(trip.destination_key, set()).add(source)
+
+    def _reaching(self, target: str, max_legs: int) -> List[Set[str]]:
+        """``reaching[n]``: cities from which ``target`` is reachable in at most n legs"""
+        reaching = [{target}]
+        for _ in range(max_legs - 1):
+            previous = reaching[-1]
+            cities = set(previous)
+            for city in previous:
+                cities |= self._predecessors.get(city, set())
+            reaching.append(cities)
+            if cities == previous:
+                break
+        return reaching
+
+    def plan(
+        self,
+        source: str,
+        destination: str,
+        depart_after: int = 0,
+        k: int = 3,
+        sort_by: str = "arrival",
+        min_connection: int = 30,
+        max_legs: int = 3,
+    ) -> List[dict]:
+        """Up to ``k`` itineraries from ``source`` to ``destination``, best first.
+
+        ``depart_after`` is minutes past midnight on the day of travel and
+        ``min_connection`` the minimum minutes between arriving in a city
+        and leaving it again. No itinerary passes through a city twice.
+        """
+        if sort_by not in SORT_KEYS:
+            raise ValueError(f"sort_by must be one of {', '.join(SORT_KEYS)}")
+        origin, target = city_key(source), city_key(destination)
+        if origin == target:
+            return []
+
+        def priority(arrival: int, price: float, legs: int) -> tuple:
+            if sort_by == "price":
+                return (price, arrival, legs)
+            if sort_by == "transfers":
+                return (legs, arrival, price)
+            return (arrival, price, legs)
+
+        # (priority, tie-breaker, time, price, city, legs as (trip, departure) pairs)
+        reaching = self._reaching(target, max_legs)
+        heap = [(priority(depart_after, 0.0, 0), 0, depart_after, 0.0, origin, ())]
+        expanded: Dict[str, int] = {}
+        pushed = 0
+        itineraries = []
+        while heap and len(itineraries) < k:
+            _, _, time, price, city, legs = heapq.heappop(heap)
+            if city == target:
+                itineraries.append(self._itinerary(legs, price))
+                continue
+            if expanded.get(city, 0) >= k or len(legs) >= max_legs:
+                continue
+            expanded[city] = expanded.get(city, 0) + 1
+            visited = {origin} | {trip.destination_key for trip, _ in legs}
+            ready = time + (min_connection if legs else 0)
+            # Only follow trips to cities that can still reach the target with the legs left
+            useful = reaching[min(max_legs - len(legs) - 1, len(reaching) - 1)]
+            if len(legs) == max_legs - 1:
+                departures = self._routes.get(city, {}).get(target, ())
+            else:
+                departures = self._departures.get(city, ())
+            for departure, _, trip in departures:
+                destination = trip.destination_key
+                if destination in visited or destination not in useful or expanded.get(destination, 0) >= k:
+                    continue
+                leaves = ready + (departure - ready) % MINUTES_PER_DAY
+                arrives = leaves + trip.duration
+                cost = price + trip.bus["price"]
+                pushed += 1
+                heapq.heappush(heap, (priority(arrives, cost, len(legs) + 1), pushed, arrives, cost,
+                                      destination, legs + ((trip, leaves),)))
+        return itineraries
+
+    @staticmethod
+    def _itinerary(legs: tuple, price: float) -> dict:
+        steps = []
+        for trip, leaves in legs:
+            bus = trip.bus
+            steps.append({
+                "bus_id": bus["bus_id"],
+                "bus_number": bus["bus_number"],
+                "source": bus["source"],
+                "destination": bus["destination"],
+                "departure_time": bus["departure_time"],
+                "arrival_time": bus["arrival_time"],
+                # Days after the day of travel on which this leg departs / arrives
+                "departure_day": leaves // MINUTES_PER_DAY,
+                "arrival_day": (leaves + trip.duration) // MINUTES_PER_DAY,
+                "price": bus["price"],
+            })
+        first_departure = legs[0][1]
+        last_trip, last_departure = legs[-1]
+        return {
+            "legs": steps,
+            "transfers": len(legs) - 1,
+            "total_price": round(price, 2),
+            "duration_minutes": last_departure + last_trip.duration - first_departure,
+        }
@@ -1,12 +1,54 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from typing import List, Dict
+from typing import List, Dict, Optional
+from datetime import date, timedelta
+import asyncio
+import hashlib
+import json
+import os
+import time
 import uuid
 
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.snapshots import Snapshot, etag_matches, not_modified, version_etag
+
+from booking_events import lag_report
+from journey_planner import JourneyPlanner
+from route_index import parse_clock
+from storage import open_store
+
 app = FastAPI(title="Bus Service")
 
-# In-memory storage
-buses = {}
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Storage backend: memory:// (default) or sqlite:///path/to/buses.db
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+store = open_store(STORAGE_URL)
+
+# Encoded GET /buses body, rebuilt on the first read after a bus is added or changed
+buses_snapshot = Snapshot(store.list_buses)
+
+# Longest date range accepted by the availability query
+MAX_AVAILABILITY_DAYS = 366
+
+# Route graph for multi-leg journeys, with the store epoch and bus position it is current to
+planner = JourneyPlanner()
+planner_epoch: Optional[str] = None
+planner_position = 0
+planner_lock: Optional[asyncio.Lock] = None
+MIN_CONNECTION_MINUTES = int(os.getenv("MIN_CONNECTION_MINUTES", "30"))
+MAX_ITINERARIES = 10
+MAX_LEGS = 4
+
+# Largest batch of booking events accepted in one POST /events/bookings
+MAX_EVENT_BATCH = 5000
 
 class Bus(BaseModel):
     bus_number: str
@@ -18,6 +60,22 @@ class Bus(BaseModel):
     arrival_time: str
     price: float
 
+class BookingEvent(BaseModel):
+    event_id: str
+    sequence: int
+    type: str
+    booking_id: Optional[str] = None
+    bus_id: str
+    journey_date: str
+    seat_number: int
+    occurred_at: float
+
+class BookingEventBatch(BaseModel):
+    # Outbox that sent the batch and the last sequence number it has assigned
+    source: str
+    head: int
+    events: List[BookingEvent]
+
 # Initialize with some sample buses
 sample_buses = [
     {
@@ -42,42 +100,215 @@ sample_buses = [
     }
 ]
 
-for bus in sample_buses:
-    bus_id = str(uuid.uuid4())
-    bus["bus_id"] = bus_id
-    buses[bus_id] = bus
+def etag_response(request: Request, payload) -> Response:
+    """JSON response with a content-hash ETag, or a bodiless 304 if the client already has it"""
+    body = json.dumps(jsonable_encoder(payload)).encode()
+    etag = f'"{hashlib.sha1(body).hexdigest()}"'
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+@app.on_event("startup")
+async def startup_event():
+    await store.open()
+    # Seed the sample buses into an empty store only, so a shared database is not re-seeded
+    if await store.count() == 0:
+        for bus in sample_buses:
+            await store.create_bus(dict(bus, bus_id=str(uuid.uuid4())))
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await store.close()
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to Bus Service"}
 
 @app.get("/buses")
-async def get_buses():
-    return list(buses.values())
+async def get_buses(request: Request):
+    return await buses_snapshot.respond(request, await store.data_version())
+
+@app.get("/buses/search")
+async def search_buses(
+    request: Request,
+    response: Response,
+    source: str,
+    destination: str,
+    depart_after: Optional[str] = None,
+    depart_before: Optional[str] = None,
+    max_price: Optional[float] = None,
+):
+    """Buses on a route, earliest departure first"""
+    # Bad parameters get their 400 even from a client that sends an ETag
+    try:
+        after = parse_clock(depart_after) if depart_after else None
+        before = parse_clock(depart_before) if depart_before else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Results only change with the buses, so the version tells whether the client's copy is current
+    etag = version_etag(await store.data_version(), str(request.url.query))
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return not_modified(etag, "Accept-Encoding")
+    response.headers.update({"ETag": etag, "Vary": "Accept-Encoding"})
+    matches = await store.search(source, destination, after, before)
+    return [bus for bus in matches if max_price is None or bus["price"] <= max_price]
+
+def build_planner(buses: List[dict]) -> JourneyPlanner:
+    built = JourneyPlanner()
+    for bus in buses:
+        built.add(bus)
+    return built
+
+async def current_planner() -> JourneyPlanner:
+    """The route graph with every bus in the store.
+
+    Buses are only ever added, and seat updates leave the schedule alone,
+    so the graph just takes in the buses added since the last plan,
+    including those added through other workers sharing a SQLite
+    database. It is built from scratch, in the default executor, only on
+    the first plan and after the store has been recreated.
+    """
+    global planner, planner_epoch, planner_position, planner_lock
+    epoch, _, added = await store.added_buses(planner_position)
+    if epoch == planner_epoch and not added:
+        return planner
+    if planner_lock is None:
+        planner_lock = asyncio.Lock()
+    # Requests that arrive during an update wait for it instead of applying the same buses again
+    async with planner_lock:
+        epoch, position, added = await store.added_buses(planner_position)
+        if epoch != planner_epoch:
+            if planner_position:
+                # Positions from another epoch do not carry over
+                epoch, position, added = await store.added_buses(0)
+            planner = await asyncio.get_running_loop().run_in_executor(None, build_planner, added)
+        else:
+            for bus in added:
+                planner.add(bus)
+        planner_epoch, planner_position = epoch, position
+    return planner
+
+@app.get("/journeys")
+async def plan_journeys(
+    source: str,
+    destination: str,
+    depart_after: Optional[str] = None,
+    sort_by: str = "arrival",
+    k: int = Query(3, ge=1, le=MAX_ITINERARIES),
+    max_legs: int = Query(3, ge=1, le=MAX_LEGS),
+    min_connection: int = Query(MIN_CONNECTION_MINUTES, ge=0),
+):
+    """The k best itineraries between two cities, with transfers, by arrival time, price or transfers"""
+    try:
+        after = parse_clock(depart_after) if depart_after else 0
+        return (await current_planner()).plan(source, destination, after, k, sort_by, min_connection, max_legs)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/buses/availability")
+async def get_availability(
+    start_date: date,
+    end_date: date,
+    bus_id: Optional[List[str]] = Query(None),
+):
+    """Available seats per bus and date over an inclusive date range"""
+    days = (end_date - start_date).days + 1
+    if not 1 <= days <= MAX_AVAILABILITY_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Date range must cover between 1 and {MAX_AVAILABILITY_DAYS} days",
+        )
+    if bus_id:
+        selected = []
+        for b in bus_id:
+            bus = await store.get_bus(b)
+            if bus is None:
+                raise HTTPException(status_code=404, detail=f"Bus not found: {b}")
+            selected.append(bus)
+    else:
+        selected = await store.list_buses()
+
+    dates = [start_date + timedelta(days=offset) for offset in range(days)]
+    return await store.availability(selected, dates)
 
 @app.get("/buses/{bus_id}")
-async def get_bus(bus_id: str):
-    if bus_id not in buses:
+async def get_bus(bus_id: str, request: Request):
+    bus = await store.get_bus(bus_id)
+    if bus is None:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    return etag_response(request, bus)
+
+@app.get("/buses/{bus_id}/seats")
+async def get_seat_map(bus_id: str, date: date):
+    """Seat availability of a bus on one journey date"""
+    bus = await store.get_bus(bus_id)
+    if bus is None:
         raise HTTPException(status_code=404, detail="Bus not found")
-    return buses[bus_id]
+    booked_seats = await store.booked_seats(bus_id, date)
+    return {
+        "bus_id": bus_id,
+        "journey_date": date,
+        "total_seats": bus["total_seats"],
+        "available_seats": bus["total_seats"] - len(booked_seats),
+        "booked_seats": booked_seats,
+    }
+
+@app.put("/buses/{bus_id}/seats/{seat_number}")
+async def update_seat(bus_id: str, seat_number: int, date: date, booked: bool = True):
+    """Book or release a single seat on one journey date"""
+    bus = await store.get_bus(bus_id)
+    if bus is None:
+        raise HTTPException(status_code=404, detail="Bus not found")
+    if not 1 <= seat_number <= bus["total_seats"]:
+        raise HTTPException(status_code=400, detail=f"Seat number must be between 1 and {bus['total_seats']}")
+    available_seats = await store.update_seat(bus, date, seat_number, booked)
+    if available_seats is None:
+        raise HTTPException(status_code=409, detail="Seat already booked" if booked else "Seat is not booked")
+    return {
+        "bus_id": bus_id,
+        "journey_date": date,
+        "seat_number": seat_number,
+        "booked": booked,
+        "available_seats": available_seats,
+    }
 
 @app.post("/buses")
 async def create_bus(bus: Bus):
+    try:
+        parse_clock(bus.departure_time)
+        # The journey planner needs the arrival time too
+        parse_clock(bus.arrival_time)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     bus_id = str(uuid.uuid4())
     bus_dict = bus.dict()
     bus_dict["bus_id"] = bus_id
-    buses[bus_id] = bus_dict
+    await store.create_bus(bus_dict)
     return bus_dict
 
+@app.post("/events/bookings")
+async def consume_booking_events(batch: BookingEventBatch):
+    """Apply a batch of booking events from a booking service outbox to the seat maps"""
+    if len(batch.events) > MAX_EVENT_BATCH:
+        raise HTTPException(status_code=400, detail=f"Batch cannot exceed {MAX_EVENT_BATCH} events")
+    events = sorted((event.dict() for event in batch.events), key=lambda event: event["sequence"])
+    return await store.apply_booking_events(batch.source, batch.head, events, time.time())
+
+@app.get("/events/bookings/lag")
+async def get_booking_event_lag():
+    """Events each booking service outbox has assigned but this service has not applied yet"""
+    return lag_report(await store.event_sources(), time.time())
+
 @app.put("/buses/{bus_id}/seats")
 async def update_seats(bus_id: str, seats: int):
-    if bus_id not in buses:
+    """Overwrite the date-less available_seats counter; per-date maps are left untouched"""
+    bus = await store.get_bus(bus_id)
+    if bus is None:
         raise HTTPException(status_code=404, detail="Bus not found")
-    bus = buses[bus_id]
     if seats > bus["total_seats"]:
         raise HTTPException(status_code=400, detail="Seats cannot exceed total seats")
-    bus["available_seats"] = seats
-    return bus
+    return await store.set_available_seats(bus_id, seats)
 
 if __name__ == "__main__":
     import uvicorn
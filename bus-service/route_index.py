@@ -0,0 +1,47 @@
+#route search index for the bus service
+from bisect import bisect_left, insort
+from typing import Dict, List, Optional, Tuple
+
+
+def parse_clock(value: str) -> int:
+    """Convert an "HH:MM" time of day into minutes past midnight"""
+    hours, _, minutes = value.partition(":")
+    if not (hours.isdigit() and minutes.isdigit() and len(minutes) == 2):
+        raise ValueError(f"Invalid time '{value}', expected HH:MM")
+    if int(hours) > 23 or int(minutes) > 59:
+        raise ValueError(f"Invalid time '{value}', expected HH:MM")
+    return int(hours) * 60 + int(minutes)
+
+
+def city_key(city: str) -> str:
+    return city.strip().casefold()
+
+
+class RouteIndex:
+    """source -> destination -> buses sorted by departure time.
+
+    A search is a dict lookup plus two bisects, so it costs O(log n + k)
+    for k matching departures instead of a scan over the whole fleet.
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, Dict[str, List[Tuple[int, str]]]] = {}
+
+    def add(self, bus: dict):
+        departures = self._routes.setdefault(city_key(bus["source"]), {}).setdefault(
+            city_key(bus["destination"]), []
+        )
+        insort(departures, (parse_clock(bus["departure_time"]), bus["bus_id"]))
+
+    def search(
+        self,
+        source: str,
+        destination: str,
+        depart_after: Optional[int] = None,
+        depart_before: Optional[int] = None,
+    ) -> List[str]:
+        """Bus ids on the route departing within [depart_after, depart_before], earliest first"""
+        departures = self._routes.get(city_key(source), {}).get(city_key(destination), [])
+        start = 0 if depart_after is None else bisect_left(departures, (depart_after, ""))
+        stop = len(departures) if depart_before is None else bisect_left(departures, (depart_before + 1, ""))
+        return [bus_id for _, bus_id in departures[start:stop]]
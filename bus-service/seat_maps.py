@@ -0,0 +1,78 @@
+#per-date seat maps for the bus service
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+
+class SeatMap:
+    """Booked seats of one bus on one date, one bit per seat (seats are numbered from 1)"""
+
+    __slots__ = ("total_seats", "booked_count", "_bits")
+
+    def __init__(self, total_seats: int):
+        self.total_seats = total_seats
+        self.booked_count = 0
+        self._bits = bytearray((total_seats + 7) // 8)
+
+    @property
+    def available_seats(self) -> int:
+        return self.total_seats - self.booked_count
+
+    def _locate(self, seat_number: int) -> Tuple[int, int]:
+        if not 1 <= seat_number <= self.total_seats:
+            raise ValueError(f"Seat number must be between 1 and {self.total_seats}")
+        byte, bit = divmod(seat_number - 1, 8)
+        return byte, 1 << bit
+
+    def is_booked(self, seat_number: int) -> bool:
+        byte, mask = self._locate(seat_number)
+        return bool(self._bits[byte] & mask)
+
+    def book(self, seat_number: int) -> bool:
+        """Mark a seat as booked; returns False if it already was"""
+        byte, mask = self._locate(seat_number)
+        if self._bits[byte] & mask:
+            return False
+        self._bits[byte] |= mask
+        self.booked_count += 1
+        return True
+
+    def release(self, seat_number: int) -> bool:
+        """Mark a seat as free; returns False if it already was"""
+        byte, mask = self._locate(seat_number)
+        if not self._bits[byte] & mask:
+            return False
+        self._bits[byte] &= ~mask & 0xFF
+        self.booked_count -= 1
+        return True
+
+    def booked_seats(self) -> List[int]:
+        return [
+            byte * 8 + bit + 1
+            for byte, value in enumerate(self._bits) if value
+            for bit in range(8) if value & (1 << bit)
+        ]
+
+
+class SeatMaps:
+    """Seat maps keyed by (bus_id, journey_date), created on first write.
+
+    Dates nobody has booked on have no map at all and read as fully
+    available, so holding a 90 day window costs nothing until it is used.
+    """
+
+    def __init__(self):
+        self._maps: Dict[Tuple[str, date], SeatMap] = {}
+
+    def get(self, bus_id: str, journey_date: date) -> Optional[SeatMap]:
+        return self._maps.get((bus_id, journey_date))
+
+    def get_or_create(self, bus_id: str, journey_date: date, total_seats: int) -> SeatMap:
+        key = (bus_id, journey_date)
+        seat_map = self._maps.get(key)
+        if seat_map is None:
+            seat_map = self._maps[key] = SeatMap(total_seats)
+        return seat_map
+
+    def available_seats(self, bus_id: str, journey_date: date, total_seats: int) -> int:
+        seat_map = self._maps.get((bus_id, journey_date))
+        return total_seats if seat_map is None else seat_map.available_seats
@@ -0,0 +1,382 @@
+#storage backends for the bus service
+import os
+import sqlite3
+import uuid
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from buscommon.sqlite import SQLitePool, write_transaction
+
+from booking_events import advance, coalesce, new_source, unseen
+from route_index import RouteIndex, parse_clock, city_key
+from seat_maps import SeatMaps
+
+BUS_FIELDS = ("bus_number", "source", "destination", "total_seats", "available_seats",
+              "departure_time", "arrival_time", "price", "bus_id")
+
+
+class BusStore:
+    """Interface of the bus storage backends; buses are plain dicts keyed by ``BUS_FIELDS``"""
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def count(self) -> int:
+        raise NotImplementedError
+
+    async def data_version(self) -> str:
+        """Token that changes whenever a bus is added or changed; seat maps are not part of it"""
+        raise NotImplementedError
+
+    async def create_bus(self, bus: dict):
+        raise NotImplementedError
+
+    async def get_bus(self, bus_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def list_buses(self) -> List[dict]:
+        raise NotImplementedError
+
+    async def added_buses(self, after: int) -> Tuple[str, int, List[dict]]:
+        """The store's epoch, the position of its newest bus and the buses added after position ``after``.
+
+        Buses are never removed and only their seat counts change, so a
+        copy of the schedule stays current by taking in the buses added
+        since it last looked. A new epoch means the store was recreated
+        and positions start over.
+        """
+        raise NotImplementedError
+
+    async def search(self, source: str, destination: str,
+                     depart_after: Optional[int], depart_before: Optional[int]) -> List[dict]:
+        """Buses on a route leaving within the window (minutes past midnight), earliest first"""
+        raise NotImplementedError
+
+    async def set_available_seats(self, bus_id: str, seats: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def update_seat(self, bus: dict, journey_date: date, seat_number: int, booked: bool) -> Optional[int]:
+        """Book or release one seat; returns the seats left, or None if the seat was already in that state"""
+        raise NotImplementedError
+
+    async def booked_seats(self, bus_id: str, journey_date: date) -> List[int]:
+        raise NotImplementedError
+
+    async def availability(self, buses: List[dict], dates: List[date]) -> Dict[str, Dict[str, int]]:
+        """Available seats per bus id and ISO date"""
+        raise NotImplementedError
+
+    async def apply_booking_events(self, source: str, head: int, events: List[dict], now: float) -> Dict[str, int]:
+        """Apply one outbox batch to the seat maps, each seat once with its net change.
+
+        Events at or below the source's high-water mark were applied before
+        and are skipped. Returns counts of events (applied, duplicates,
+        missed, invalid) and of seats (booked, released, unchanged, unknown).
+        """
+        raise NotImplementedError
+
+    async def event_sources(self) -> List[dict]:
+        """Consumer state per outbox: applied and head sequence, missed events, last batch time and delay"""
+        raise NotImplementedError
+
+
+def _event_counts(events: List[dict], fresh: List[dict], missed: int, invalid: int) -> Dict[str, int]:
+    return {
+        "applied": len(fresh), "duplicates": len(events) - len(fresh), "missed": missed, "invalid": invalid,
+        "booked": 0, "released": 0, "unchanged": 0, "unknown": 0,
+    }
+
+
+class MemoryBusStore(BusStore):
+    """Buses, the route index and per-date seat maps in process memory"""
+
+    def __init__(self):
+        self.buses: Dict[str, dict] = {}
+        # Bus ids in the order they were added, for added_buses
+        self.order: List[str] = []
+        self.route_index = RouteIndex()
+        self.seat_maps = SeatMaps()
+        # outbox source -> consumer state, see booking_events.new_source
+        self.sources: Dict[str, dict] = {}
+        # The epoch keeps versions from before a restart from matching
+        self.epoch = uuid.uuid4().hex[:12]
+        self.version = 0
+
+    async def count(self) -> int:
+        return len(self.buses)
+
+    async def data_version(self) -> str:
+        return f"{self.epoch}-{self.version}"
+
+    async def create_bus(self, bus: dict):
+        self.buses[bus["bus_id"]] = bus
+        self.order.append(bus["bus_id"])
+        self.route_index.add(bus)
+        self.version += 1
+
+    async def get_bus(self, bus_id: str) -> Optional[dict]:
+        return self.buses.get(bus_id)
+
+    async def list_buses(self) -> List[dict]:
+        # Copies, as seat counts change in place and the listing is encoded off the event loop
+        return [dict(bus) for bus in self.buses.values()]
+
+    async def added_buses(self, after: int) -> Tuple[str, int, List[dict]]:
+        return self.epoch, len(self.order), [dict(self.buses[bus_id]) for bus_id in self.order[after:]]
+
+    async def search(self, source, destination, depart_after, depart_before) -> List[dict]:
+        return [self.buses[bus_id] for bus_id in
+                self.route_index.search(source, destination, depart_after, depart_before)]
+
+    async def set_available_seats(self, bus_id: str, seats: int) -> Optional[dict]:
+        bus = self.buses.get(bus_id)
+        if bus is not None:
+            bus["available_seats"] = seats
+            self.version += 1
+        return bus
+
+    async def update_seat(self, bus, journey_date, seat_number, booked) -> Optional[int]:
+        seat_map = self.seat_maps.get_or_create(bus["bus_id"], journey_date, bus["total_seats"])
+        changed = seat_map.book(seat_number) if booked else seat_map.release(seat_number)
+        return seat_map.available_seats if changed else None
+
+    async def booked_seats(self, bus_id: str, journey_date: date) -> List[int]:
+        seat_map = self.seat_maps.get(bus_id, journey_date)
+        return [] if seat_map is None else seat_map.booked_seats()
+
+    async def availability(self, buses, dates) -> Dict[str, Dict[str, int]]:
+        return {
+            bus["bus_id"]: {
+                day.isoformat(): self.seat_maps.available_seats(bus["bus_id"], day, bus["total_seats"])
+                for day in dates
+            }
+            for bus in buses
+        }
+
+    async def apply_booking_events(self, source, head, events, now) -> Dict[str, int]:
+        state = self.sources.get(source) or new_source(source, now)
+        fresh, missed = unseen(events, state["sequence"])
+        groups, invalid = coalesce(fresh)
+        counts = _event_counts(events, fresh, missed, invalid)
+        for (bus_id, journey_date), seats in groups.items():
+            bus = self.buses.get(bus_id)
+            for seat_number, delta in seats.items():
+                if bus is None or not 1 <= seat_number <= bus["total_seats"]:
+                    counts["unknown"] += 1
+                elif delta:
+                    seat_map = self.seat_maps.get_or_create(bus_id, journey_date, bus["total_seats"])
+                    changed = seat_map.book(seat_number) if delta > 0 else seat_map.release(seat_number)
+                    counts[("booked" if delta > 0 else "released") if changed else "unchanged"] += 1
+                else:
+                    counts["unchanged"] += 1
+        advance(state, head, fresh, missed, now)
+        self.sources[source] = state
+        return counts
+
+    async def event_sources(self) -> List[dict]:
+        return list(self.sources.values())
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buses (
+    bus_id TEXT PRIMARY KEY,
+    bus_number TEXT NOT NULL,
+    source TEXT NOT NULL,
+    destination TEXT NOT NULL,
+    source_key TEXT NOT NULL,
+    destination_key TEXT NOT NULL,
+    departure_minutes INTEGER NOT NULL,
+    total_seats INTEGER NOT NULL,
+    available_seats INTEGER NOT NULL,
+    departure_time TEXT NOT NULL,
+    arrival_time TEXT NOT NULL,
+    price REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS buses_route ON buses (source_key, destination_key, departure_minutes);
+CREATE TABLE IF NOT EXISTS booked_seats (
+    bus_id TEXT NOT NULL,
+    journey_date TEXT NOT NULL,
+    seat_number INTEGER NOT NULL,
+    PRIMARY KEY (bus_id, journey_date, seat_number)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS data_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO data_version (id, epoch, version) VALUES (1, lower(hex(randomblob(6))), 0);
+CREATE TRIGGER IF NOT EXISTS buses_inserted AFTER INSERT ON buses
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS buses_updated AFTER UPDATE ON buses
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TRIGGER IF NOT EXISTS buses_deleted AFTER DELETE ON buses
+BEGIN UPDATE data_version SET version = version + 1; END;
+CREATE TABLE IF NOT EXISTS event_sources (
+    source TEXT PRIMARY KEY,
+    sequence INTEGER NOT NULL,
+    head INTEGER NOT NULL,
+    missed INTEGER NOT NULL,
+    applied_at REAL NOT NULL,
+    delay REAL
+);
+"""
+
+_COLUMNS = ", ".join(BUS_FIELDS)
+_INSERT_BUS = (f"INSERT INTO buses ({_COLUMNS}, source_key, destination_key, departure_minutes) "
+               f"VALUES ({', '.join('?' for _ in BUS_FIELDS)}, ?, ?, ?)")
+_SELECT_BUS = f"SELECT {_COLUMNS} FROM buses WHERE bus_id = ?"
+_ADDED_BUSES = f"SELECT rowid AS position, {_COLUMNS} FROM buses WHERE rowid > ? ORDER BY rowid"
+_SEARCH = (f"SELECT {_COLUMNS} FROM buses WHERE source_key = ? AND destination_key = ? "
+           f"AND departure_minutes BETWEEN ? AND ? ORDER BY departure_minutes, bus_id")
+_BOOK_SEAT = "INSERT OR IGNORE INTO booked_seats (bus_id, journey_date, seat_number) VALUES (?, ?, ?)"
+_RELEASE_SEAT = "DELETE FROM booked_seats WHERE bus_id = ? AND journey_date = ? AND seat_number = ?"
+_COUNT_BOOKED = "SELECT COUNT(*) FROM booked_seats WHERE bus_id = ? AND journey_date = ?"
+_BOOKED_SEATS = "SELECT seat_number FROM booked_seats WHERE bus_id = ? AND journey_date = ? ORDER BY seat_number"
+_BOOKED_BY_DATE = ("SELECT journey_date, COUNT(*) FROM booked_seats WHERE bus_id = ? "
+                   "AND journey_date BETWEEN ? AND ? GROUP BY journey_date")
+_SOURCE_FIELDS = ("source", "sequence", "head", "missed", "applied_at", "delay")
+_SELECT_SOURCE = f"SELECT {', '.join(_SOURCE_FIELDS)} FROM event_sources WHERE source = ?"
+_SAVE_SOURCE = (f"INSERT OR REPLACE INTO event_sources ({', '.join(_SOURCE_FIELDS)}) "
+                f"VALUES ({', '.join('?' for _ in _SOURCE_FIELDS)})")
+
+
+def _row_to_bus(row: sqlite3.Row) -> dict:
+    return {field: row[field] for field in BUS_FIELDS}
+
+
+class SQLiteBusStore(BusStore):
+    """Buses and booked seats in a SQLite database shared by every worker process.
+
+    Triggers on the buses table bump the data version in the same
+    transaction as the write, whichever worker made it.
+    """
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: Optional[SQLitePool] = None
+
+    async def open(self):
+        self.pool = SQLitePool(self.path, self.pool_size, SQLITE_SCHEMA)
+
+    async def close(self):
+        self.pool.close()
+
+    async def count(self) -> int:
+        return await self.pool.run(lambda connection: connection.execute("SELECT COUNT(*) FROM buses").fetchone()[0])
+
+    async def data_version(self) -> str:
+        def fetch(connection):
+            epoch, version = connection.execute("SELECT epoch, version FROM data_version").fetchone()
+            return f"{epoch}-{version}"
+        return await self.pool.run(fetch)
+
+    async def create_bus(self, bus: dict):
+        params = [bus[field] for field in BUS_FIELDS] + [
+            city_key(bus["source"]), city_key(bus["destination"]), parse_clock(bus["departure_time"])]
+        await self.pool.run(lambda connection: connection.execute(_INSERT_BUS, params))
+
+    async def get_bus(self, bus_id: str) -> Optional[dict]:
+        def fetch(connection):
+            row = connection.execute(_SELECT_BUS, (bus_id,)).fetchone()
+            return _row_to_bus(row) if row else None
+        return await self.pool.run(fetch)
+
+    async def list_buses(self) -> List[dict]:
+        return await self.pool.run(lambda connection: [
+            _row_to_bus(row) for row in connection.execute(f"SELECT {_COLUMNS} FROM buses ORDER BY rowid")])
+
+    async def added_buses(self, after: int) -> Tuple[str, int, List[dict]]:
+        # Buses are never deleted, so rowids only grow and order the inserts of every worker
+        def fetch(connection):
+            epoch = connection.execute("SELECT epoch FROM data_version").fetchone()[0]
+            rows = connection.execute(_ADDED_BUSES, (after,)).fetchall()
+            return epoch, rows[-1]["position"] if rows else after, [_row_to_bus(row) for row in rows]
+        return await self.pool.run(fetch)
+
+    async def search(self, source, destination, depart_after, depart_before) -> List[dict]:
+        params = (city_key(source), city_key(destination),
+                  0 if depart_after is None else depart_after,
+                  24 * 60 if depart_before is None else depart_before)
+        return await self.pool.run(lambda connection: [
+            _row_to_bus(row) for row in connection.execute(_SEARCH, params)])
+
+    async def set_available_seats(self, bus_id: str, seats: int) -> Optional[dict]:
+        def update(connection):
+            connection.execute("UPDATE buses SET available_seats = ? WHERE bus_id = ?", (seats, bus_id))
+            row = connection.execute(_SELECT_BUS, (bus_id,)).fetchone()
+            return _row_to_bus(row) if row else None
+        return await self.pool.run(update)
+
+    async def update_seat(self, bus, journey_date, seat_number, booked) -> Optional[int]:
+        params = (bus["bus_id"], journey_date.isoformat(), seat_number)
+
+        def update(connection):
+            changed = connection.execute(_BOOK_SEAT if booked else _RELEASE_SEAT, params).rowcount
+            if not changed:
+                return None
+            return bus["total_seats"] - connection.execute(_COUNT_BOOKED, params[:2]).fetchone()[0]
+        return await self.pool.run(update)
+
+    async def booked_seats(self, bus_id: str, journey_date: date) -> List[int]:
+        return await self.pool.run(lambda connection: [
+            row[0] for row in connection.execute(_BOOKED_SEATS, (bus_id, journey_date.isoformat()))])
+
+    async def availability(self, buses, dates) -> Dict[str, Dict[str, int]]:
+        first, last = dates[0].isoformat(), dates[-1].isoformat()
+
+        def fetch(connection):
+            result = {}
+            for bus in buses:
+                booked = dict(connection.execute(_BOOKED_BY_DATE, (bus["bus_id"], first, last)).fetchall())
+                result[bus["bus_id"]] = {
+                    day.isoformat(): bus["total_seats"] - booked.get(day.isoformat(), 0) for day in dates
+                }
+            return result
+        return await self.pool.run(fetch)
+
+    async def apply_booking_events(self, source, head, events, now) -> Dict[str, int]:
+        def apply(connection):
+            # Seat changes and the new high-water mark commit together, so a redelivered batch is a no-op
+            with write_transaction(connection):
+                row = connection.execute(_SELECT_SOURCE, (source,)).fetchone()
+                state = dict(row) if row else new_source(source, now)
+                fresh, missed = unseen(events, state["sequence"])
+                groups, invalid = coalesce(fresh)
+                counts = _event_counts(events, fresh, missed, invalid)
+                for (bus_id, journey_date), seats in groups.items():
+                    bus = connection.execute("SELECT total_seats FROM buses WHERE bus_id = ?", (bus_id,)).fetchone()
+                    changes = {True: [], False: []}
+                    for seat_number, delta in seats.items():
+                        if bus is None or not 1 <= seat_number <= bus[0]:
+                            counts["unknown"] += 1
+                        elif delta:
+                            changes[delta > 0].append((bus_id, journey_date.isoformat(), seat_number))
+                        else:
+                            counts["unchanged"] += 1
+                    for booked, params in changes.items():
+                        if params:
+                            changed = connection.executemany(_BOOK_SEAT if booked else _RELEASE_SEAT, params).rowcount
+                            counts["booked" if booked else "released"] += changed
+                            counts["unchanged"] += len(params) - changed
+                advance(state, head, fresh, missed, now)
+                connection.execute(_SAVE_SOURCE, [state[field] for field in _SOURCE_FIELDS])
+            return counts
+        return await self.pool.run(apply)
+
+    async def event_sources(self) -> List[dict]:
+        return await self.pool.run(lambda connection: [
+            dict(row) for row in connection.execute(
+                f"SELECT {', '.join(_SOURCE_FIELDS)} FROM event_sources ORDER BY source")])
+
+
+def open_store(url: str) -> BusStore:
+    """Build the backend named by a storage URL: ``memory://`` or ``sqlite:///path/to.db``"""
+    if url.startswith("sqlite://"):
+        return SQLiteBusStore(url[len("sqlite://"):], int(os.getenv("SQLITE_POOL_SIZE", "4")))
+    if url.startswith("memory://"):
+        return MemoryBusStore()
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+
+@pytest.fixture(scope="module")
+def planner_module(service_module):
+    return service_module("bus-service", "journey_planner")
+
+
+def bus(bus_id, source, destination, departure, arrival, price):
+    return {"bus_id": bus_id, "bus_number": bus_id.upper(), "source": source, "destination": destination,
+            "departure_time": departure, "arrival_time": arrival, "price": price}
+
+
+@pytest.fixture
+def planner(planner_module):
+    planner = planner_module.JourneyPlanner()
+    for b in [
+        bus("direct", "Pune", "Goa", "08:00", "20:00", 900),
+        bus("leg1", "Pune", "Mumbai", "06:00", "09:00", 200),
+        bus("leg2", "Mumbai", "Goa", "10:00", "18:00", 300),
+        bus("tight", "Mumbai", "Goa", "09:15", "17:00", 100),
+        bus("night", "Goa", "Hampi", "22:00", "04:00", 400),
+    ]:
+        planner.add(b)
+    return planner
+
+
+def test_earliest_arrival_first(planner):
+    itineraries = planner.plan("Pune", "Goa")
+    assert [[leg["bus_id"] for leg in it["legs"]] for it in itineraries] == [
+        ["leg1", "leg2"], ["direct"], ["leg1", "tight"],
+    ]
+    first = itineraries[0]
+    assert first["transfers"] == 1
+    assert first["total_price"] == 500
+    assert first["duration_minutes"] == 12 * 60
+
+
+def test_missed_connection_waits_for_the_next_day(planner):
+    tight = planner.plan("Pune", "Goa", sort_by="price")[0]
+    assert [leg["bus_id"] for leg in tight["legs"]] == ["leg1", "tight"]
+    assert tight["legs"][1]["departure_day"] == 1
+    assert tight["legs"][1]["arrival_day"] == 1
+    # 15 minutes to change buses is enough once the minimum connection allows it
+    same_day = planner.plan("Pune", "Goa", sort_by="price", min_connection=15)[0]
+    assert same_day["legs"][1]["departure_day"] == 0
+
+
+def test_sort_by_transfers_and_leg_limit(planner):
+    assert planner.plan("Pune", "Goa", sort_by="transfers")[0]["legs"][0]["bus_id"] == "direct"
+    assert [it["transfers"] for it in planner.plan("Pune", "Goa", max_legs=1)] == [0]
+    assert planner.plan("Pune", "Hampi", max_legs=2)[0]["transfers"] == 1
+    # Both same-day routes catch the same night bus, so the cheaper of the two comes first
+    assert [it["total_price"] for it in planner.plan("Pune", "Hampi", k=5)] == [900, 1300, 700]
+
+
+def test_overnight_leg_arrives_the_next_day(planner):
+    leg = planner.plan("Goa", "Hampi")[0]["legs"][0]
+    assert (leg["departure_day"], leg["arrival_day"]) == (0, 1)
+
+
+def test_depart_after_and_city_names_are_case_insensitive(planner):
+    late = planner.plan(" pune", "GOA", depart_after=9 * 60, k=1)[0]
+    assert late["legs"][0]["bus_id"] == "leg1"
+    assert late["legs"][0]["departure_day"] == 1
+    assert planner.plan("Pune", "pune") == []
+    assert planner.plan("Pune", "Nowhere") == []
+
+
+def test_unknown_sort_key_is_rejected(planner):
+    with pytest.raises(ValueError):
+        planner.plan("Pune", "Goa", sort_by="comfort")
+
+
+def stored_bus(bus_id, source, destination):
+    return dict(bus(bus_id, source, destination, "08:00", "12:00", 100), total_seats=40, available_seats=40)
+
+
+@pytest.mark.parametrize("url", ["memory://", "sqlite"])
+def test_added_buses_come_after_the_last_position(service_module, tmp_path, url):
+    storage = service_module("bus-service", "storage")
+
+    async def scenario():
+        store = storage.open_store(f"sqlite:///{tmp_path}/buses.db" if url == "sqlite" else url)
+        await store.open()
+        await store.create_bus(stored_bus("a", "Pune", "Goa"))
+        epoch, position, added = await store.added_buses(0)
+        await store.create_bus(stored_bus("b", "Goa", "Hampi"))
+        await store.set_available_seats("a", 10)
+        later = await store.added_buses(position)
+        await store.close()
+        return [b["bus_id"] for b in added], epoch, later
+
+    added, epoch, (later_epoch, position, later) = asyncio.run(scenario())
+    assert added == ["a"]
+    assert later_epoch == epoch
+    assert [b["bus_id"] for b in later] == ["b"]
+    assert position == 2
+
+
+def test_planner_takes_in_new_buses_without_a_rebuild(service_module):
+    main = service_module("bus-service", "main")
+
+    async def scenario():
+        await main.store.create_bus(stored_bus("a", "Pune", "Goa"))
+        first = await main.current_planner()
+        await main.store.set_available_seats("a", 10)
+        assert await main.current_planner() is first
+        await main.store.create_bus(stored_bus("b", "Goa", "Hampi"))
+        second = await main.current_planner()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert second is first
+    assert [leg["bus_id"] for leg in second.plan("Pune", "Hampi")[0]["legs"]] == ["a", "b"]
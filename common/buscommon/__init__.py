@@ -0,0 +1 @@
+#code shared by the bus booking services, installed into every service image
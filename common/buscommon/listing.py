@@ -0,0 +1,69 @@
+#cursor pagination and streaming helpers for booking listings
+import base64
+import binascii
+from bisect import bisect_left, bisect_right
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterator, List
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MAX_PAGE_SIZE = 1000
+# Records fetched and encoded per chunk of a streaming response
+STREAM_CHUNK_SIZE = 256
+
+
+def encode_cursor(position: int) -> str:
+    """Opaque cursor pointing just past the record at ``position``"""
+    return base64.urlsafe_b64encode(str(position).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+class PositionIndex:
+    """Secondary indexes from field values to record positions.
+
+    Records live in an append-only sequence, so every posting list stays
+    sorted and a cursor can be resumed with a bisect.
+    """
+
+    def __init__(self, *fields: str):
+        self._indexes: Dict[str, Dict[Any, List[int]]] = {field: {} for field in fields}
+
+    def add(self, position: int, **values):
+        for field, value in values.items():
+            self._indexes[field].setdefault(value, []).append(position)
+
+    def scan(self, filters: Dict[str, Any], after: int, end: int) -> Iterator[int]:
+        """Yield candidate positions in (after, end) for the given filters.
+
+        Only the most selective filter is applied here; callers still have
+        to check the remaining ones against each record.
+        """
+        active = [(field, value) for field, value in filters.items() if value is not None]
+        if not active:
+            return iter(range(after + 1, end))
+        postings = min((self._indexes[field].get(value, []) for field, value in active), key=len)
+        start, stop = bisect_right(postings, after), bisect_left(postings, end)
+        return (postings[i] for i in range(start, stop))
+
+
+async def ndjson_stream(chunks: AsyncIterable[List[str]]) -> AsyncIterator[str]:
+    """Stream chunks of pre-encoded JSON documents, one document per line"""
+    async for chunk in chunks:
+        if chunk:
+            yield "\n".join(chunk) + "\n"
+
+
+async def json_array_stream(chunks: AsyncIterable[List[str]]) -> AsyncIterator[str]:
+    """Stream chunks of pre-encoded JSON documents as a single JSON array"""
+    yield "["
+    first = True
+    async for chunk in chunks:
+        if chunk:
+            yield ("" if first else ",") + ",".join(chunk)
+            first = False
+    yield "]"
@@ -0,0 +1,145 @@
+#request metrics and Prometheus exposition shared by every service
+from bisect import bisect_left
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Route label of requests that matched no route, e.g. 404s and CORS preflights
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class Histogram:
+    """Bucketed latency counts; buckets are made cumulative only when rendered"""
+
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+
+def _labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+
+
+def _render_histograms(name: str, help_text: str, label_names: Tuple[str, ...],
+                       histograms: Dict[tuple, Histogram]) -> List[str]:
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    bounds = [repr(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+    for key in sorted(histograms):
+        histogram = histograms[key]
+        labels = _labels(label_names, key)
+        total = 0
+        for bound, count in zip(bounds, histogram.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum!r}")
+        lines.append(f"{name}_count{{{labels}}} {total}")
+    return lines
+
+
+class Metrics:
+    """Per-route request latencies, in-flight requests and upstream call latencies.
+
+    Recording is a dict lookup and a bisect into a fixed bucket list, so it
+    costs a few microseconds per request; all formatting happens in
+    ``render`` when /metrics is scraped.
+    """
+
+    def __init__(self):
+        # (method, route, status) -> latency histogram
+        self.requests: Dict[Tuple[str, str, int], Histogram] = {}
+        # (upstream, status) -> latency histogram
+        self.upstreams: Dict[Tuple[str, str], Histogram] = {}
+        self.in_flight = 0
+        # endpoint function -> route path, filled in as routes are first hit
+        self._routes: Dict[Callable, str] = {}
+
+    def route(self, scope: dict) -> str:
+        """Path template of the route that handled the request, e.g. /buses/{bus_id}"""
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return UNMATCHED_ROUTE
+        route = self._routes.get(endpoint)
+        if route is None:
+            route = next(
+                (candidate.path for candidate in scope["app"].routes if getattr(candidate, "endpoint", None) is endpoint),
+                UNMATCHED_ROUTE,
+            )
+            self._routes[endpoint] = route
+        return route
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float):
+        key = (method, route, status)
+        histogram = self.requests.get(key)
+        if histogram is None:
+            histogram = self.requests[key] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_upstream(self, upstream: str, status: str, seconds: float):
+        key = (upstream, status)
+        histogram = self.upstreams.get(key)
+        if histogram is None:
+            histogram = self.upstreams[key] = Histogram()
+        histogram.observe(seconds)
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = [
+            "# HELP http_requests_in_flight Requests currently being served",
+            "# TYPE http_requests_in_flight gauge",
+            f"http_requests_in_flight {self.in_flight}",
+        ]
+        lines += _render_histograms(
+            "http_request_duration_seconds", "Time to serve a request, by route and status",
+            ("method", "route", "status"), self.requests,
+        )
+        if self.upstreams:
+            lines += _render_histograms(
+                "upstream_request_duration_seconds", "Time to an upstream's response headers, by status",
+                ("upstream", "status"), self.upstreams,
+            )
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Plain ASGI middleware timing every HTTP request into a Metrics.
+
+    It wraps ``send`` only to read the response status, so streamed
+    responses pass through untouched and are timed until their last
+    chunk. The route label is the matched path template, which the router
+    leaves in the scope as the endpoint.
+    """
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # Reported if the app fails before starting a response
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        metrics = self.metrics
+        metrics.in_flight += 1
+        started = perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.in_flight -= 1
+            metrics.observe_request(scope["method"], metrics.route(scope), status, perf_counter() - started)
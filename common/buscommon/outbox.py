@@ -0,0 +1,229 @@
+#outbox of booking events, delivered to bus-service in batches off the request path
+import asyncio
+import fcntl
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from itertools import count, islice
+from typing import IO, Deque, Optional
+
+import httpx
+
+from .wal import WriteAheadLog
+
+logger = logging.getLogger(__name__)
+
+
+class EventOutbox:
+    """Booking events queued in process memory and posted to a consumer in batches.
+
+    ``publish`` only appends to a queue, so a booking never waits on the
+    consumer. One background task posts the oldest events, up to
+    ``batch_size`` at a time, and retries a batch with backoff until it is
+    acknowledged, so batches arrive in order. Every event carries this
+    outbox's ``source`` and a sequence number one higher than the last.
+    The consumer uses them to drop redelivered events and to report how far
+    behind it is.
+
+    Without a ``directory`` delivery is at-least-once while the process
+    runs, events still queued when it stops are lost, and every process is
+    a new source. With one, the outbox takes the first ``outbox-<n>`` slot
+    in it that no running process holds, keeps its source id there, and
+    logs every event and acknowledgement to a write-ahead log in it; a
+    restart picks up the queue and the sequence where they stopped.
+    ``persisted`` waits for the events published so far to reach the log.
+    Past ``max_pending`` queued events the oldest are dropped, which the
+    consumer sees as a gap in the sequence.
+    """
+
+    def __init__(self, url: str, name: str, batch_size: int = 500, flush_interval: float = 0.05,
+                 max_pending: int = 100_000, timeout: float = 5.0, max_backoff: float = 10.0,
+                 directory: Optional[str] = None, commit_window: float = 0.002, snapshot_every: int = 100_000):
+        self.url = url
+        self.name = name
+        self.source = f"{name}-{uuid.uuid4().hex[:12]}"
+        self.directory = directory
+        self.commit_window = commit_window
+        self.snapshot_every = snapshot_every
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        # Transport for the consumer client; None means real HTTP
+        self.transport: Optional[httpx.AsyncBaseTransport] = None
+        self.sequence = 0
+        self.pending: Deque[dict] = deque()
+        self.delivered = 0
+        self.dropped = 0
+        self.failures = 0
+        self.client: Optional[httpx.AsyncClient] = None
+        self.wal: Optional[WriteAheadLog] = None
+        self._task: Optional[asyncio.Task] = None
+        self._lock: Optional[IO] = None
+        self._last_logged: Optional[asyncio.Future] = None
+
+    def publish(self, event_type: str, booking: dict):
+        """Queue an event for a seat taken or freed by ``booking``"""
+        if not self.url:
+            return
+        self.sequence += 1
+        event = {
+            "event_id": f"{self.source}:{self.sequence}",
+            "sequence": self.sequence,
+            "type": event_type,
+            "booking_id": booking.get("booking_id"),
+            "bus_id": booking["bus_id"],
+            "journey_date": str(booking["journey_date"]),
+            "seat_number": booking["seat_number"],
+            "occurred_at": time.time(),
+        }
+        self._queue(event)
+        if self.wal is not None:
+            self._last_logged = self._log({"event": event})
+
+    def _queue(self, event: dict):
+        self.pending.append(event)
+        if len(self.pending) > self.max_pending:
+            self.pending.popleft()
+            self.dropped += 1
+
+    def _acknowledge(self, sequence: int):
+        # The head of the queue may have been dropped meanwhile, so remove by sequence
+        while self.pending and self.pending[0]["sequence"] <= sequence:
+            self.pending.popleft()
+
+    def _log(self, record: dict) -> asyncio.Future:
+        future = self.wal.append(record)
+        future.add_done_callback(self._log_failed)
+        return future
+
+    def _log_failed(self, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            # Still queued in memory, so only a restart before delivery loses it
+            logger.error(f"Logging booking events failed: {future.exception()}")
+
+    async def persisted(self):
+        """Wait until every event published so far is in the log (no-op without a directory)"""
+        last = self._last_logged
+        if last is not None and not last.done():
+            await asyncio.wait([last])
+
+    async def start(self):
+        if not self.url:
+            return
+        if self.directory:
+            await self._recover()
+        self.client = httpx.AsyncClient(timeout=self.timeout, transport=self.transport)
+        self._task = asyncio.ensure_future(self._run())
+
+    def _claim(self) -> str:
+        """Lock the first outbox slot in ``directory`` that no running process holds"""
+        for slot in count():
+            path = os.path.join(self.directory, f"outbox-{slot}")
+            os.makedirs(path, exist_ok=True)
+            lock = open(os.path.join(path, "lock"), "w")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            self._lock = lock
+            return path
+
+    async def _recover(self):
+        path = self._claim()
+        source_path = os.path.join(path, "source")
+        if os.path.exists(source_path):
+            with open(source_path) as f:
+                self.source = f.read().strip()
+        else:
+            with open(source_path + ".tmp", "w") as f:
+                f.write(self.source)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(source_path + ".tmp", source_path)
+        self.wal = WriteAheadLog(path, commit_window=self.commit_window, snapshot_every=self.snapshot_every)
+        state = self.wal.load_snapshot()
+        if state is not None:
+            self.sequence = state["sequence"]
+            for event in state["pending"]:
+                self._queue(event)
+        for record in self.wal.records():
+            if "event" in record:
+                self.sequence = record["event"]["sequence"]
+                self._queue(record["event"])
+            else:
+                self._acknowledge(record["delivered"])
+        if self.pending:
+            logger.info(f"Outbox {self.source} resumes with {len(self.pending)} undelivered booking events")
+        await self.wal.start(lambda: {"sequence": self.sequence, "pending": list(self.pending)})
+
+    async def close(self):
+        """Stop delivering, after one last attempt to send what is queued"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        try:
+            while self.pending:
+                await self._send()
+        except (httpx.HTTPError, OSError) as e:
+            kept = "kept for the next start" if self.wal is not None else "lost"
+            logger.warning(f"{len(self.pending)} booking events not delivered to {self.url}, {kept}: {e}")
+        await self.client.aclose()
+        if self.wal is not None:
+            await self.wal.close()
+            self._lock.close()
+
+    async def _run(self):
+        failures = 0
+        while True:
+            if len(self.pending) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+            if not self.pending:
+                continue
+            try:
+                await self._send()
+            except (httpx.HTTPError, OSError) as e:
+                failures += 1
+                self.failures += 1
+                if failures == 1:
+                    logger.warning(f"Delivering booking events to {self.url} failed, retrying: {e}")
+                await asyncio.sleep(min(self.max_backoff, self.flush_interval * 2 ** failures))
+                continue
+            if failures:
+                logger.info(f"Delivering booking events to {self.url} recovered after {failures} attempts")
+            failures = 0
+
+    async def _send(self):
+        batch = list(islice(self.pending, self.batch_size))
+        response = await self.client.post(
+            self.url, json={"source": self.source, "head": self.sequence, "events": batch})
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            # Sending it again would be rejected again; skip it so later events still flow
+            logger.error(f"Consumer rejected {len(batch)} booking events: {response.status_code} {response.text[:200]}")
+            self.dropped += len(batch)
+        else:
+            response.raise_for_status()
+            self.delivered += len(batch)
+        self._acknowledge(batch[-1]["sequence"])
+        if self.wal is not None:
+            self._log({"delivered": batch[-1]["sequence"]})
+
+    def stats(self) -> dict:
+        return {
+            "source": self.source,
+            "url": self.url,
+            "sequence": self.sequence,
+            "pending": len(self.pending),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "oldest_pending_seconds": time.time() - self.pending[0]["occurred_at"] if self.pending else 0.0,
+        }
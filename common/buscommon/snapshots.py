@@ -0,0 +1,105 @@
+#versioned, pre-encoded JSON responses with ETags and gzip
+import asyncio
+import gzip
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Optional
+
+from fastapi import Request, Response
+
+# Bodies smaller than this are sent uncompressed; gzip would barely shrink them
+GZIP_MIN_SIZE = 1024
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """Whether an If-None-Match header value covers ``etag``"""
+    if not if_none_match or not etag:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """Whether an Accept-Encoding header allows gzip (explicitly or through *), honouring q=0"""
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        if coding.strip().lower() not in ("gzip", "*"):
+            continue
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def version_etag(version: str, *variant: str) -> str:
+    """Strong ETag of the data at ``version``; ``variant`` (query string, Accept, ...) tells apart its views"""
+    if not variant:
+        return f'"{version}"'
+    return f'"{version}-{hashlib.sha1(chr(0).join(variant).encode()).hexdigest()[:16]}"'
+
+
+def not_modified(etag: str, vary: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Vary": vary})
+
+
+class EncodedBody:
+    """One version of a JSON body, as sent and gzip-compressed"""
+
+    __slots__ = ("version", "identity", "gzip")
+
+    def __init__(self, version: str, data: Any):
+        self.version = version
+        self.identity = json.dumps(data).encode()
+        self.gzip = gzip.compress(self.identity) if len(self.identity) >= GZIP_MIN_SIZE else None
+
+
+class Snapshot:
+    """A list endpoint's JSON body, encoded once per version of the data behind it.
+
+    ``build`` is only called on the first read after the version has moved,
+    so a burst of writes costs one rebuild, and reads in between reuse the
+    same bytes and their gzip form. Encoding and compression run in the
+    default executor, so a rebuild does not stall the event loop; ``build``
+    must return data that is not modified afterwards. A client that sends
+    back the ETag gets a 304 without the body being touched at all. The
+    gzip and identity forms have different ETags, as strong ETags must.
+    """
+
+    def __init__(self, build: Callable[[], Awaitable[Any]]):
+        self.build = build
+        self.builds = 0
+        self._body: Optional[EncodedBody] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def body(self, version: str) -> EncodedBody:
+        body = self._body
+        if body is not None and body.version == version:
+            return body
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # Requests that arrive while the body is rebuilt wait for it instead of building their own
+        async with self._lock:
+            if self._body is None or self._body.version != version:
+                data = await self.build()
+                self._body = await asyncio.get_running_loop().run_in_executor(None, EncodedBody, version, data)
+                self.builds += 1
+            return self._body
+
+    async def respond(self, request: Request, version: str) -> Response:
+        # Known before the body is built, so a 304 never needs it; a client that
+        # accepts gzip always gets the same bytes for a version, compressed or not
+        gzip_ok = accepts_gzip(request.headers.get("accept-encoding"))
+        etag = version_etag(version, "gzip") if gzip_ok else version_etag(version)
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return not_modified(etag, "Accept-Encoding")
+        body = await self.body(version)
+        headers = {"ETag": etag, "Vary": "Accept-Encoding"}
+        if body.gzip is not None and gzip_ok:
+            headers["Content-Encoding"] = "gzip"
+            return Response(content=body.gzip, media_type="application/json", headers=headers)
+        return Response(content=body.identity, media_type="application/json", headers=headers)
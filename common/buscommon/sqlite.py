@@ -0,0 +1,63 @@
+#sqlite connection pool and write transactions used by the services' SQLite stores
+import asyncio
+import os
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
+
+class SQLitePool:
+    """A fixed set of SQLite connections used from a dedicated thread pool.
+
+    Connections run in WAL mode so readers never wait on the writer, and
+    every statement executes on a pool thread so the event loop never
+    blocks on disk I/O. sqlite3 keeps a per-connection cache of prepared
+    statements, so the constant SQL used by the stores is only compiled
+    once per connection.
+    """
+
+    def __init__(self, path: str, size: int = 4, schema: str = ""):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="sqlite")
+        self._connections: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                         cached_statements=256)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA busy_timeout = 5000")
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            self._connections.put(connection)
+        if schema:
+            self._call(lambda connection: connection.executescript(schema), ())
+
+    async def run(self, fn: Callable, *args):
+        """Run ``fn(connection, *args)`` on a pool thread"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+
+    def _call(self, fn: Callable, args: tuple):
+        connection = self._connections.get()
+        try:
+            return fn(connection, *args)
+        finally:
+            self._connections.put(connection)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while not self._connections.empty():
+            self._connections.get().close()
+
+
+@contextmanager
+def write_transaction(connection: sqlite3.Connection):
+    """IMMEDIATE takes the write lock up front, so no other worker can change what was read"""
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
@@ -0,0 +1,125 @@
+#signed session tokens shared by the user, agent and gateway services
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "3600"))
+# Claims every verified token has, besides its expiry
+REQUIRED_CLAIMS = ("sub", "role", "jti")
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def token_secret(secret: Optional[str] = None) -> str:
+    """``secret``, or else AUTH_TOKEN_SECRET, which every service that issues or checks tokens must share.
+
+    There is no fallback: a default secret would be public, and anyone
+    could sign a token for any subject and role with it.
+    """
+    secret = os.getenv("AUTH_TOKEN_SECRET", "") if secret is None else secret
+    if not secret:
+        raise RuntimeError("AUTH_TOKEN_SECRET is not set; refusing to issue or verify tokens")
+    return secret
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _sign(payload: str, secret: str) -> str:
+    return _b64encode(hmac.new(secret.encode(), payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(subject: str, role: str, ttl: Optional[int] = None, secret: Optional[str] = None) -> dict:
+    """A signed token for ``subject`` plus its claims.
+
+    The token is ``<payload>.<signature>``: base64url JSON claims and
+    their HMAC-SHA256, so anyone holding the secret can check it locally.
+    """
+    claims = {
+        "sub": subject,
+        "role": role,
+        "exp": int(time.time()) + (AUTH_TOKEN_TTL if ttl is None else ttl),
+        "jti": uuid.uuid4().hex,
+    }
+    payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+    return {"token": f"{payload}.{_sign(payload, token_secret(secret))}", "claims": claims}
+
+
+def verify_token(token: str, secret: Optional[str] = None, now: Optional[float] = None) -> dict:
+    """The claims of a valid, unexpired token; raises InvalidToken otherwise"""
+    payload, _, signature = token.partition(".")
+    if not signature or not hmac.compare_digest(signature, _sign(payload, token_secret(secret))):
+        raise InvalidToken("Invalid token signature")
+    try:
+        claims = json.loads(_b64decode(payload))
+    except ValueError:
+        raise InvalidToken("Malformed token")
+    # Signed is not the same as issued by issue_token: the secret may have signed other payloads
+    if not isinstance(claims, dict) or any(claims.get(name) is None for name in REQUIRED_CLAIMS):
+        raise InvalidToken("Malformed token")
+    expires = claims.get("exp")
+    if isinstance(expires, bool) or not isinstance(expires, (int, float)):
+        raise InvalidToken("Token has no expiry")
+    if expires <= (time.time() if now is None else now):
+        raise InvalidToken("Token expired")
+    return claims
+
+
+class TokenVerifier:
+    """Local token verification with an LRU of verified tokens and a revocation list.
+
+    A cache hit skips the HMAC and JSON work; expiry and revocation are
+    still checked on every call. Revoked token ids are kept only until
+    the token would have expired anyway, so the list stays small.
+    """
+
+    def __init__(self, secret: Optional[str] = None, cache_size: int = 10000,
+                 clock: Callable[[], float] = time.time):
+        self.secret = token_secret(secret)
+        self.cache_size = cache_size
+        self.clock = clock
+        self._verified: "OrderedDict[str, dict]" = OrderedDict()
+        self._revoked: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, token: str) -> dict:
+        now = self.clock()
+        claims = self._verified.get(token)
+        if claims is None:
+            self.misses += 1
+            claims = verify_token(token, self.secret, now)
+            self._verified[token] = claims
+            if len(self._verified) > self.cache_size:
+                self._verified.popitem(last=False)
+        else:
+            self.hits += 1
+            self._verified.move_to_end(token)
+            if claims["exp"] <= now:
+                del self._verified[token]
+                raise InvalidToken("Token expired")
+        if claims["jti"] in self._revoked:
+            raise InvalidToken("Token revoked")
+        return claims
+
+    def revoke(self, claims: dict):
+        self._revoked[claims["jti"]] = claims["exp"]
+        now = self.clock()
+        for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[jti]
+
+    def stats(self) -> Dict[str, int]:
+        return {"cached": len(self._verified), "revoked": len(self._revoked), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,243 @@
+#write-ahead log with group commit and compacting snapshots
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LOG_FILE = "wal.log"
+SNAPSHOT_FILE = "snapshot.json"
+# Every line starts with this, as json.dumps writes the lsn key first
+RECORD_START = b'{"lsn": '
+
+
+def _encode(value):
+    """json default hook for pydantic models, dates and the like"""
+    if hasattr(value, "dict"):
+        return value.dict()
+    return str(value)
+
+
+def _decode(line: bytes) -> Optional[dict]:
+    """The record on a log line, or None if the line is torn"""
+    if not line.endswith(b"\n"):
+        return None
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+class WriteAheadLog:
+    """Append-only JSON-lines log plus a periodic snapshot of the full state.
+
+    ``append`` assigns the record a log sequence number (lsn) immediately and
+    returns a future that resolves once the record is on disk. Records that
+    arrive within ``commit_window`` seconds of each other are written with a
+    single fsync, so durability costs one fsync per batch, not per write.
+    Once ``snapshot_every`` records are on disk, the state is snapshotted
+    at the next commit that leaves nothing queued, and the log truncated;
+    replay is the snapshot followed by the records after it.
+    """
+
+    def __init__(self, directory: str, commit_window: float = 0.002,
+                 max_batch: int = 1000, snapshot_every: int = 100_000):
+        self.directory = directory
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.snapshot_every = snapshot_every
+        self.lsn = 0
+        self.commits = 0
+        self._log_path = os.path.join(directory, LOG_FILE)
+        self._snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self._valid_size = 0
+        # Log size after the last successful commit; a failed write is cut back to it
+        self._good_size = 0
+        self._failed: Optional[Exception] = None
+        self._since_snapshot = 0
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._snapshot: Optional[Callable[[], Any]] = None
+        self._file = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        os.makedirs(directory, exist_ok=True)
+
+    def load_snapshot(self) -> Any:
+        """State saved by the last snapshot, or None if there is none"""
+        if not os.path.exists(self._snapshot_path):
+            return None
+        with open(self._snapshot_path) as f:
+            data = json.load(f)
+        self.lsn = data["lsn"]
+        return data["state"]
+
+    def records(self) -> Iterator[dict]:
+        """Log records written after the snapshot, oldest first.
+
+        A torn last line (a crash mid-write) ends the replay; ``start``
+        truncates it away before new records are appended. A torn line
+        with records after it is a write that failed without being cut
+        back, so the replay skips it and carries on; the record that
+        followed on the same line, if any, is kept, on the last line too.
+        """
+        self._valid_size = 0
+        if not os.path.exists(self._log_path):
+            return
+        torn = None
+        with open(self._log_path, "rb") as f:
+            for line in f:
+                if torn is not None:
+                    record = self._salvage(torn)
+                    if record is not None:
+                        yield from self._replayed(record)
+                    self._valid_size += len(torn)
+                    torn = None
+                record = _decode(line)
+                if record is None:
+                    torn = line
+                    continue
+                yield from self._replayed(record)
+                self._valid_size += len(line)
+        if torn is not None and torn.endswith(b"\n"):
+            # Complete but unreadable: a fragment with the last record glued to it
+            record = self._salvage(torn)
+            if record is not None:
+                yield from self._replayed(record)
+                self._valid_size += len(torn)
+
+    def _replayed(self, record: dict) -> Iterator[dict]:
+        self._since_snapshot += 1
+        if record["lsn"] > self.lsn:
+            self.lsn = record["lsn"]
+            yield record
+
+    def _salvage(self, line: bytes) -> Optional[dict]:
+        start = line.rfind(RECORD_START, 1)
+        record = _decode(line[start:]) if start > 0 else None
+        logger.error(f"Skipped a torn record in the middle of {self._log_path}"
+                     + (f", kept lsn {record['lsn']} written after it" if record is not None else ""))
+        return record
+
+    async def start(self, snapshot: Callable[[], Any]):
+        """Open the log for appending and start the commit task.
+
+        ``snapshot`` is called on the event loop and must return a
+        point-in-time copy of the state that is safe to serialise from
+        another thread.
+        """
+        self._snapshot = snapshot
+        # Unbuffered, so a failed write leaves nothing behind to be flushed later
+        self._file = open(self._log_path, "ab", buffering=0)
+        self._file.truncate(self._valid_size)
+        self._good_size = self._valid_size
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._commit_loop())
+
+    def append(self, record: dict) -> asyncio.Future:
+        """Queue a record for the next group commit"""
+        self.lsn += 1
+        line = json.dumps({"lsn": self.lsn, **record}, default=_encode) + "\n"
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((line, future))
+        self._wakeup.set()
+        return future
+
+    async def close(self):
+        """Commit whatever is still queued and close the log"""
+        if self._task is None:
+            return
+        self._closing = True
+        self._wakeup.set()
+        await self._task
+        self._file.close()
+        self._task = None
+
+    async def _commit_loop(self):
+        while True:
+            await self._wakeup.wait()
+            if not self._closing and len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.commit_window)
+            self._wakeup.clear()
+            committed = await self._commit()
+            if self._closing:
+                while self._pending:
+                    await self._commit()
+                return
+            # The state includes the changes of queued records, and those of
+            # a failed batch until its writers have undone them; snapshot it
+            # only when every change in it is on disk
+            if committed and not self._pending and self._since_snapshot >= self.snapshot_every:
+                try:
+                    await self._write_snapshot()
+                except Exception as e:
+                    # The log still holds every record, so nothing is lost;
+                    # the snapshot is tried again after the next commit
+                    logger.error(f"WAL snapshot failed: {str(e)}")
+
+    async def _commit(self) -> bool:
+        """Write the queued records; False if the write failed"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return True
+        data = "".join(line for line, _ in batch).encode()
+        try:
+            if self._failed is not None:
+                raise self._failed
+            await asyncio.get_running_loop().run_in_executor(None, self._write, data)
+        except Exception as e:
+            logger.error(f"WAL commit failed: {str(e)}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return False
+        self.commits += 1
+        self._since_snapshot += len(batch)
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        return True
+
+    def _write(self, data: bytes):
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[self._file.write(view):]
+            os.fsync(self._file.fileno())
+        except Exception as e:
+            # Cut the partial batch off so the next commit does not land after it
+            try:
+                os.ftruncate(self._file.fileno(), self._good_size)
+                os.fsync(self._file.fileno())
+            except Exception:
+                # The log may now end in a torn line that later records would
+                # follow; refuse every further commit rather than risk that
+                self._failed = e
+                raise
+            raise
+        self._good_size += len(data)
+
+    async def _write_snapshot(self):
+        # Every record written so far was assigned an lsn before this
+        # capture, so the snapshot covers them and the log can be truncated
+        lsn, state = self.lsn, self._snapshot()
+        await asyncio.get_running_loop().run_in_executor(None, self._write_snapshot_file, lsn, state)
+        self._since_snapshot = 0
+
+    def _write_snapshot_file(self, lsn: int, state: Any):
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"lsn": lsn, "state": state}, f, default=_encode)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._snapshot_path)
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self._file.truncate(0)
+        self._good_size = 0
+        logger.info(f"WAL snapshot written at lsn {lsn}")
@@ -0,0 +1,9 @@
+#shared modules of the bus booking services; each service pins its own fastapi and httpx
+from setuptools import setup
+
+setup(
+    name="buscommon",
+    version="0.1.0",
+    packages=["buscommon"],
+    python_requires=">=3.9",
+)
@@ -0,0 +1,87 @@
+import asyncio
+import json
+
+import httpx
+
+from buscommon.outbox import EventOutbox
+
+
+def booking(seat: int) -> dict:
+    return {"booking_id": f"b{seat}", "bus_id": "bus-1", "journey_date": "2024-06-01", "seat_number": seat}
+
+
+def consumer(received: list):
+    def handler(request: httpx.Request) -> httpx.Response:
+        received.extend(json.loads(request.content)["events"])
+        return httpx.Response(200, json={})
+    return httpx.MockTransport(handler)
+
+
+def unreachable(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection refused")
+
+
+def outbox(directory, transport) -> EventOutbox:
+    box = EventOutbox("http://consumer/events", "test", flush_interval=0.01, directory=directory)
+    box.transport = transport
+    return box
+
+
+def test_events_are_delivered_in_order():
+    async def scenario():
+        received = []
+        box = outbox(None, consumer(received))
+        await box.start()
+        for seat in range(1, 4):
+            box.publish("booking.created", booking(seat))
+        await asyncio.sleep(0.1)
+        await box.close()
+        return box, received
+
+    box, received = asyncio.run(scenario())
+    assert [event["sequence"] for event in received] == [1, 2, 3]
+    assert {event["event_id"].rsplit(":", 1)[0] for event in received} == {box.source}
+    assert box.delivered == 3 and not box.pending
+
+
+def test_undelivered_events_survive_a_restart(tmp_path):
+    async def scenario():
+        box = outbox(str(tmp_path), httpx.MockTransport(unreachable))
+        await box.start()
+        for seat in range(1, 4):
+            box.publish("booking.created", booking(seat))
+        await box.persisted()
+        await box.close()
+
+        received = []
+        restarted = outbox(str(tmp_path), consumer(received))
+        await restarted.start()
+        assert restarted.source == box.source
+        assert len(restarted.pending) == 3
+        restarted.publish("booking.cancelled", booking(1))
+        await asyncio.sleep(0.1)
+        await restarted.close()
+
+        again = outbox(str(tmp_path), consumer([]))
+        await again.start()
+        state = (again.source == box.source, again.sequence, len(again.pending))
+        await again.close()
+        return received, state
+
+    received, state = asyncio.run(scenario())
+    assert [event["sequence"] for event in received] == [1, 2, 3, 4]
+    assert state == (True, 4, 0)
+
+
+def test_running_processes_take_separate_slots(tmp_path):
+    async def scenario():
+        first, second = outbox(str(tmp_path), consumer([])), outbox(str(tmp_path), consumer([]))
+        await first.start()
+        await second.start()
+        sources = first.source, second.source
+        await second.close()
+        await first.close()
+        return sources
+
+    first, second = asyncio.run(scenario())
+    assert first != second
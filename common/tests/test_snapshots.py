@@ -0,0 +1,90 @@
+import asyncio
+import gzip
+import json
+
+import httpx
+from fastapi import FastAPI, Request
+
+from buscommon.snapshots import GZIP_MIN_SIZE, Snapshot, accepts_gzip, etag_matches, version_etag
+
+
+def app_with_snapshot():
+    state = {"version": "v1", "items": [{"id": i, "name": "x" * 20} for i in range(100)]}
+
+    async def build():
+        return list(state["items"])
+
+    snapshot = Snapshot(build)
+    app = FastAPI()
+
+    @app.get("/items")
+    async def items(request: Request):
+        return await snapshot.respond(request, state["version"])
+
+    return app, snapshot, state
+
+
+def get(app, headers: dict):
+    async def call():
+        async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+            return await client.get("/items", headers=headers)
+    return asyncio.run(call())
+
+
+def test_etag_matching():
+    assert etag_matches('"a", "b"', '"b"')
+    assert etag_matches('W/"b"', '"b"')
+    assert etag_matches("*", '"b"')
+    assert not etag_matches('"a"', '"b"')
+    assert not etag_matches(None, '"b"')
+
+
+def test_accepts_gzip():
+    assert accepts_gzip("gzip, deflate")
+    assert accepts_gzip("*")
+    assert not accepts_gzip("gzip;q=0")
+    assert not accepts_gzip("identity")
+    assert not accepts_gzip(None)
+
+
+def test_body_is_built_once_per_version_and_revalidates_with_304():
+    app, snapshot, state = app_with_snapshot()
+    first = get(app, {"accept-encoding": "identity"})
+    assert first.status_code == 200
+    assert first.headers["etag"] == version_etag("v1")
+    assert len(first.json()) == 100
+    cached = get(app, {"accept-encoding": "identity", "if-none-match": first.headers["etag"]})
+    assert cached.status_code == 304 and cached.content == b""
+    assert snapshot.builds == 1
+
+    state["version"] = "v2"
+    stale = get(app, {"accept-encoding": "identity", "if-none-match": first.headers["etag"]})
+    assert stale.status_code == 200 and stale.headers["etag"] == version_etag("v2")
+    assert snapshot.builds == 2
+
+
+def test_gzip_body_has_its_own_etag():
+    app, snapshot, _ = app_with_snapshot()
+    plain = get(app, {"accept-encoding": "identity"})
+    compressed = get(app, {"accept-encoding": "gzip"})
+    assert len(plain.content) >= GZIP_MIN_SIZE
+    assert compressed.headers["content-encoding"] == "gzip"
+    assert compressed.headers["vary"] == "Accept-Encoding"
+    assert compressed.headers["etag"] != plain.headers["etag"]
+    assert compressed.json() == plain.json()
+    # The identity ETag does not validate the gzip body, and vice versa
+    assert get(app, {"accept-encoding": "gzip", "if-none-match": plain.headers["etag"]}).status_code == 200
+    assert get(app, {"accept-encoding": "gzip", "if-none-match": compressed.headers["etag"]}).status_code == 304
+    assert snapshot.builds == 1
+
+
+def test_small_bodies_are_not_compressed():
+    body = asyncio.run(Snapshot(lambda: asyncio.sleep(0, [1, 2])).body("v"))
+    assert json.loads(body.identity) == [1, 2]
+    assert body.gzip is None
+
+
+def test_gzip_body_decompresses_to_the_identity_body():
+    app, snapshot, _ = app_with_snapshot()
+    body = asyncio.run(snapshot.body("v1"))
+    assert gzip.decompress(body.gzip) == body.identity
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from buscommon.tokens import InvalidToken, TokenVerifier, _b64encode, _sign, issue_token, verify_token
+
+SECRET = "test-secret"
+
+
+def signed(claims) -> str:
+    payload = _b64encode(json.dumps(claims).encode())
+    return f"{payload}.{_sign(payload, SECRET)}"
+
+
+def test_issued_token_verifies_until_it_expires():
+    issued = issue_token("u1", "user", ttl=60, secret=SECRET)
+    assert verify_token(issued["token"], SECRET) == issued["claims"]
+    with pytest.raises(InvalidToken, match="expired"):
+        verify_token(issued["token"], SECRET, now=issued["claims"]["exp"])
+    with pytest.raises(InvalidToken, match="signature"):
+        verify_token(issued["token"], "another-secret")
+
+
+@pytest.mark.parametrize("claims", [
+    {"sub": "u1", "role": "user", "jti": "j1"},
+    {"sub": "u1", "role": "user", "jti": "j1", "exp": None},
+    {"sub": "u1", "role": "user", "jti": "j1", "exp": "never"},
+])
+def test_signed_token_without_an_expiry_is_rejected(claims):
+    with pytest.raises(InvalidToken, match="no expiry"):
+        verify_token(signed(claims), SECRET)
+
+
+@pytest.mark.parametrize("claims", [["u1"], {"role": "user", "jti": "j1", "exp": 2 ** 40}])
+def test_signed_token_missing_claims_is_rejected(claims):
+    with pytest.raises(InvalidToken, match="Malformed"):
+        verify_token(signed(claims), SECRET)
+
+
+def test_revoked_token_is_rejected():
+    verifier = TokenVerifier(SECRET)
+    issued = issue_token("u1", "user", ttl=60, secret=SECRET)
+    assert verifier.verify(issued["token"]) == issued["claims"]
+    verifier.revoke(issued["claims"])
+    with pytest.raises(InvalidToken, match="revoked"):
+        verifier.verify(issued["token"])
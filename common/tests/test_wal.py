@@ -0,0 +1,119 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+from buscommon.wal import LOG_FILE, WriteAheadLog
+
+
+def lines(*records: dict) -> str:
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def write_log(directory, text: str):
+    with open(os.path.join(directory, LOG_FILE), "w") as f:
+        f.write(text)
+
+
+def test_appended_records_replay_in_order(tmp_path):
+    async def write():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.001)
+        await wal.start(lambda: None)
+        await asyncio.gather(*(wal.append({"n": n}) for n in range(5)))
+        await wal.close()
+        return wal.commits
+
+    assert asyncio.run(write()) == 1
+    wal = WriteAheadLog(str(tmp_path))
+    assert [record["n"] for record in wal.records()] == [0, 1, 2, 3, 4]
+    assert wal.lsn == 5
+
+
+def test_snapshot_truncates_the_log(tmp_path):
+    async def write():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.001, snapshot_every=3)
+        state = []
+        await wal.start(lambda: list(state))
+        for n in range(4):
+            state.append(n)
+            await wal.append({"n": n})
+        await wal.append({"n": 4})
+        await wal.close()
+
+    asyncio.run(write())
+    wal = WriteAheadLog(str(tmp_path))
+    snapshot = wal.load_snapshot()
+    assert snapshot[:3] == [0, 1, 2]
+    assert [record["n"] for record in wal.records()] == list(range(len(snapshot), 5))
+
+
+def test_torn_last_line_ends_the_replay_and_is_cut_off(tmp_path):
+    write_log(tmp_path, lines({"lsn": 1, "n": 1}, {"lsn": 2, "n": 2}) + '{"lsn": 3, "n"')
+
+    async def reopen():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.001)
+        replayed = [record["n"] for record in wal.records()]
+        await wal.start(lambda: None)
+        await wal.append({"n": 3})
+        await wal.close()
+        return replayed
+
+    assert asyncio.run(reopen()) == [1, 2]
+    assert [record["n"] for record in WriteAheadLog(str(tmp_path)).records()] == [1, 2, 3]
+
+
+def test_torn_middle_line_is_skipped(tmp_path):
+    # A fragment that got a newline later, then one glued to the next record
+    first, second, third, fourth = (json.dumps({"lsn": n, "n": n}) + "\n" for n in range(1, 5))
+    write_log(tmp_path, first + second[:9] + "garbage\n" + third[:12] + fourth)
+    wal = WriteAheadLog(str(tmp_path))
+    assert [record["n"] for record in wal.records()] == [1, 4]
+    assert wal.lsn == 4
+
+
+def test_records_at_or_before_the_snapshot_are_skipped(tmp_path):
+    with open(os.path.join(tmp_path, "snapshot.json"), "w") as f:
+        json.dump({"lsn": 2, "state": "s"}, f)
+    write_log(tmp_path, lines({"lsn": 1}, {"lsn": 2}, {"lsn": 3}))
+    wal = WriteAheadLog(str(tmp_path))
+    assert wal.load_snapshot() == "s"
+    assert [record["lsn"] for record in wal.records()] == [3]
+
+
+def test_failed_write_is_cut_back_and_reported(tmp_path, failing_writes):
+    async def write():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.001)
+        await wal.start(lambda: None)
+        await wal.append({"n": 1})
+        with failing_writes(wal), pytest.raises(OSError):
+            await wal.append({"n": 2})
+        await wal.append({"n": 3})
+        await wal.close()
+
+    asyncio.run(write())
+    with open(os.path.join(tmp_path, LOG_FILE)) as f:
+        assert [json.loads(line)["n"] for line in f] == [1, 3]
+
+
+def test_failed_snapshot_is_retried_and_commits_go_on(tmp_path):
+    async def write():
+        wal = WriteAheadLog(str(tmp_path), commit_window=0.001, snapshot_every=2)
+        attempts = []
+
+        def snapshot():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise OSError("No space left on device")
+            return "state"
+
+        await wal.start(snapshot)
+        for n in range(4):
+            await asyncio.wait_for(wal.append({"n": n}), 1)
+        await wal.close()
+        return attempts
+
+    assert asyncio.run(write()) == [0, 1]
+    wal = WriteAheadLog(str(tmp_path))
+    assert wal.load_snapshot() == "state"
+    assert [record["n"] for record in wal.records()] == [3]
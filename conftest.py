@@ -0,0 +1,69 @@
+#fixtures shared by the unit tests of every service
+import importlib
+import os
+import secrets
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Services refuse to issue or verify session tokens without a secret; tests use a throwaway one
+os.environ.setdefault("AUTH_TOKEN_SECRET", secrets.token_hex(32))
+
+
+def load_module(directory: str, name: str):
+    """Import module ``name`` from a service folder, as the service itself would.
+
+    Service folders are not packages, so the folder goes on ``sys.path``
+    for the import. Modules loaded from it are dropped from ``sys.modules``
+    afterwards, since two services can ship a module with the same file
+    name (both booking-service and bus-service have a ``storage.py``).
+    """
+    service_dir = os.path.join(ROOT, directory)
+    before = set(sys.modules)
+    sys.path.insert(0, service_dir)
+    try:
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(service_dir)
+        for loaded in set(sys.modules) - before:
+            path = getattr(sys.modules[loaded], "__file__", None) or ""
+            if os.path.dirname(os.path.abspath(path)) == service_dir:
+                del sys.modules[loaded]
+
+
+@pytest.fixture(scope="session")
+def service_module():
+    """``load_module`` for tests of the helper modules in a service folder"""
+    return load_module
+
+
+class FailingFile:
+    """Log file whose writes stop partway, like a full disk"""
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        self.file.write(bytes(data[:10]))
+        raise OSError("No space left on device")
+
+    def fileno(self):
+        return self.file.fileno()
+
+
+@contextmanager
+def _failing_writes(wal):
+    real, wal._file = wal._file, FailingFile(wal._file)
+    try:
+        yield
+    finally:
+        wal._file = real
+
+
+@pytest.fixture(scope="session")
+def failing_writes():
+    """Context manager under which every write of a WriteAheadLog fails"""
+    return _failing_writes
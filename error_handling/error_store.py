@@ -0,0 +1,138 @@
+#bounded error history for the error handling service
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Fields of a stored error record, in tuple order
+RECORD_FIELDS = (
+    "error_id", "timestamp", "service_name", "endpoint", "status_code",
+    "error_message", "user_message", "request_details", "is_resolved",
+)
+
+
+class _Postings:
+    """Error ids of one service, oldest first; evicted ids are dropped from the front"""
+
+    __slots__ = ("ids", "start")
+
+    def __init__(self):
+        self.ids: List[int] = []
+        self.start = 0
+
+    def __len__(self):
+        return len(self.ids) - self.start
+
+    def drop_before(self, error_id: int):
+        while self.start < len(self.ids) and self.ids[self.start] < error_id:
+            self.start += 1
+        # Compact once the dead prefix is half the list
+        if self.start > 64 and self.start * 2 > len(self.ids):
+            del self.ids[:self.start]
+            self.start = 0
+
+
+class ErrorStore:
+    """Fixed-capacity ring buffer of error records plus a per-service index.
+
+    Records are plain tuples (see ``RECORD_FIELDS``) with increasing ids
+    and timestamps, so a time range is found by bisecting and a query only
+    touches the records it returns (plus those skipped by a status filter).
+    Per-minute counts by service and status are kept as records arrive,
+    for ``retention_minutes``.
+    """
+
+    def __init__(self, capacity: int = 10000, retention_minutes: int = 1440):
+        self.capacity = capacity
+        self.retention_minutes = retention_minutes
+        self._ring: List[Optional[tuple]] = [None] * capacity
+        self._next_id = 0
+        self._by_service: Dict[str, _Postings] = {}
+        # minute -> (service, status_code) -> count
+        self._counts: Dict[int, Dict[Tuple[str, int], int]] = {}
+
+    def __len__(self):
+        return min(self._next_id, self.capacity)
+
+    @property
+    def oldest_id(self) -> int:
+        return max(0, self._next_id - self.capacity)
+
+    def append(self, timestamp: float, service_name: str, endpoint: str, status_code: int,
+               error_message: str, user_message: str, request_details: Optional[dict] = None) -> int:
+        error_id = self._next_id
+        self._next_id += 1
+        evicted = self._ring[error_id % self.capacity]
+        self._ring[error_id % self.capacity] = (
+            error_id, timestamp, service_name, endpoint, status_code,
+            error_message, user_message, request_details, False,
+        )
+        if evicted is not None:
+            self._by_service[evicted[2]].drop_before(self.oldest_id)
+        self._by_service.setdefault(service_name, _Postings()).ids.append(error_id)
+        self._count(timestamp, service_name, status_code)
+        return error_id
+
+    def _count(self, timestamp: float, service_name: str, status_code: int):
+        minute = int(timestamp // 60)
+        if minute not in self._counts:
+            for old in [m for m in self._counts if m <= minute - self.retention_minutes]:
+                del self._counts[old]
+            self._counts[minute] = {}
+        key = (service_name, status_code)
+        self._counts[minute][key] = self._counts[minute].get(key, 0) + 1
+
+    def get(self, error_id: int) -> Optional[tuple]:
+        if not self.oldest_id <= error_id < self._next_id:
+            return None
+        return self._ring[error_id % self.capacity]
+
+    def _timestamp(self, error_id: int) -> float:
+        return self._ring[error_id % self.capacity][1]
+
+    def _bisect(self, ids, lo: int, hi: int, timestamp: float) -> int:
+        """First position in ids[lo:hi] whose record is at or after ``timestamp``"""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._timestamp(ids[mid]) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def query(self, service_name: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, status_code: Optional[int] = None,
+              limit: int = 50) -> List[tuple]:
+        """The newest ``limit`` records matching every given filter, oldest first.
+
+        ``since`` is inclusive and ``until`` exclusive, both epoch seconds.
+        """
+        if service_name is not None:
+            postings = self._by_service.get(service_name)
+            if postings is None:
+                return []
+            ids, lo, hi = postings.ids, postings.start, len(postings.ids)
+        else:
+            ids, lo, hi = range(self.oldest_id, self._next_id), 0, len(self)
+        if since is not None:
+            lo = self._bisect(ids, lo, hi, since)
+        if until is not None:
+            hi = self._bisect(ids, lo, hi, until)
+        matches = []
+        for position in range(hi - 1, lo - 1, -1):
+            if len(matches) >= limit:
+                break
+            record = self._ring[ids[position] % self.capacity]
+            if status_code is None or record[4] == status_code:
+                matches.append(record)
+        matches.reverse()
+        return matches
+
+    def counts(self, service_name: Optional[str] = None, since: Optional[float] = None,
+               until: Optional[float] = None) -> Iterator[Tuple[int, str, int, int]]:
+        """(minute, service, status_code, count) per minute bucket, oldest first"""
+        for minute in sorted(self._counts):
+            if since is not None and (minute + 1) * 60 <= since:
+                continue
+            if until is not None and minute * 60 >= until:
+                continue
+            for (service, status), count in sorted(self._counts[minute].items()):
+                if service_name is None or service == service_name:
+                    yield minute, service, status, count
@@ -0,0 +1,129 @@
+#background health check scheduling for the error handling service
+import asyncio
+import heapq
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyHistory:
+    """Rolling window of probe latencies for one service"""
+
+    def __init__(self, size: int = 100):
+        self._samples: deque = deque(maxlen=size)
+
+    def add(self, latency_ms: float):
+        self._samples.append(latency_ms)
+
+    def percentiles(self) -> Dict[str, Optional[float]]:
+        if not self._samples:
+            return {"p50": None, "p95": None, "p99": None}
+        ordered = sorted(self._samples)
+
+        def rank(pct: float) -> float:
+            return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct))], 2)
+        return {"p50": rank(0.50), "p95": rank(0.95), "p99": rank(0.99)}
+
+
+class HealthScheduler:
+    """Runs each service's health check on its own jittered schedule.
+
+    ``check(name)`` probes one service and returns True if it is reachable.
+    Healthy services are probed every ``interval_for(name)`` seconds, give
+    or take ``jitter``; a service that keeps failing backs off
+    exponentially up to ``max_backoff`` so a dead service is not hammered.
+    The next due check of every service sits in one heap served by a
+    single task. ``refresh`` runs a check on demand, sharing it with any
+    check of the same service already in flight.
+    """
+
+    def __init__(self, check: Callable[[str], Awaitable[bool]], interval_for: Callable[[str], float],
+                 max_backoff: float = 300.0, jitter: float = 0.1):
+        self.check = check
+        self.interval_for = interval_for
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.last_checked: Dict[str, float] = {}
+        self.failures: Dict[str, int] = {}
+        self._due: List[Tuple[float, str]] = []
+        self._scheduled: Dict[str, float] = {}
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, names):
+        """Schedule every service at a random point of its first interval, so probes are spread out"""
+        for name in names:
+            self.schedule(name, random.uniform(0, self.interval_for(name)))
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def schedule(self, name: str, delay: float):
+        due = time.monotonic() + delay
+        self._scheduled[name] = due
+        heapq.heappush(self._due, (due, name))
+        self._wakeup.set()
+
+    def forget(self, name: str):
+        self._scheduled.pop(name, None)
+        self.last_checked.pop(name, None)
+        self.failures.pop(name, None)
+
+    def next_delay(self, name: str) -> float:
+        interval = self.interval_for(name)
+        failures = self.failures.get(name, 0)
+        if failures:
+            interval = min(self.max_backoff, interval * 2 ** (failures - 1))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def refresh(self, name: str) -> bool:
+        task = self._in_flight.get(name)
+        if task is None:
+            task = asyncio.ensure_future(self._check(name))
+            self._in_flight[name] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(name, None))
+        return await asyncio.shield(task)
+
+    async def _check(self, name: str) -> bool:
+        healthy = await self.check(name)
+        self.last_checked[name] = time.monotonic()
+        self.failures[name] = 0 if healthy else self.failures.get(name, 0) + 1
+        # Whatever triggered this check, the next periodic one counts from now
+        if name in self._scheduled:
+            self.schedule(name, self.next_delay(name))
+        return healthy
+
+    async def _run(self):
+        while True:
+            if not self._due:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, name = self._due[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._due)
+            # Entries superseded by a later schedule() or a forget() are skipped
+            if self._scheduled.get(name) != due:
+                continue
+            asyncio.ensure_future(self._refresh_logged(name))
+
+    async def _refresh_logged(self, name: str):
+        try:
+            await self.refresh(name)
+        except Exception as e:
+            logger.error(f"Health check of {name} failed: {str(e)}")
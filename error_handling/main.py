@@ -1,6 +1,6 @@
 from fastapi import FastAPI, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Dict, List, Optional, Union
 import httpx
@@ -9,6 +9,14 @@ import time
 import logging
 from datetime import datetime
 import os
+import random
+from starlette.background import BackgroundTask
+
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+
+from error_store import RECORD_FIELDS, ErrorStore
+from health_monitor import HealthScheduler, LatencyHistory
+from service_proxy import ServiceProxy
 
 # Configure logging
 logging.basicConfig(
@@ -29,11 +37,48 @@ service_registry = {
     "booking-service": "http://booking-service:8007",
 }
 
-# Health status tracking
+# Health status tracking, kept current by background probes
+HEALTH_CHECK_INTERVAL = float(os.getenv("HEALTH_CHECK_INTERVAL", "30"))
+# Per-service overrides, e.g. "bus-service=10,user-service=60"
+HEALTH_CHECK_INTERVALS = {
+    name.strip(): float(seconds)
+    for name, _, seconds in (item.partition("=") for item in os.getenv("HEALTH_CHECK_INTERVALS", "").split(","))
+    if seconds
+}
+HEALTH_MAX_BACKOFF = float(os.getenv("HEALTH_MAX_BACKOFF", "300"))
+# GET /health probes a service itself if its last check is older than this
+HEALTH_MAX_STALENESS = float(os.getenv("HEALTH_MAX_STALENESS", "60"))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "3"))
 health_status = {}
+latency_history: Dict[str, LatencyHistory] = {}
+http_client: Optional[httpx.AsyncClient] = None
+scheduler: Optional[HealthScheduler] = None
 
-# Error history
-error_history = []
+# Error history, bounded to the most recent ERROR_HISTORY_SIZE errors
+ERROR_HISTORY_SIZE = int(os.getenv("ERROR_HISTORY_SIZE", "10000"))
+ERROR_COUNT_RETENTION_MINUTES = int(os.getenv("ERROR_COUNT_RETENTION_MINUTES", "1440"))
+error_history = ErrorStore(ERROR_HISTORY_SIZE, ERROR_COUNT_RETENTION_MINUTES)
+
+# Service proxy: one connection pool per target service
+PROXY_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE")
+PROXY_MAX_CONNECTIONS = int(os.getenv("PROXY_MAX_CONNECTIONS", "100"))
+PROXY_MAX_KEEPALIVE = int(os.getenv("PROXY_MAX_KEEPALIVE", "20"))
+PROXY_TIMEOUT = float(os.getenv("PROXY_TIMEOUT", "10"))
+# Idempotent requests only; retries and hedges together are capped at this fraction of traffic
+PROXY_MAX_RETRIES = int(os.getenv("PROXY_MAX_RETRIES", "2"))
+PROXY_RETRY_BACKOFF = float(os.getenv("PROXY_RETRY_BACKOFF", "0.05"))
+PROXY_RETRY_BUDGET = float(os.getenv("PROXY_RETRY_BUDGET", "0.1"))
+# Seconds before a slow GET is hedged with a second request; 0 disables hedging
+PROXY_HEDGE_DELAY = float(os.getenv("PROXY_HEDGE_DELAY", "0"))
+# Fraction of failed proxy requests whose payload and headers are kept in the error history
+PROXY_PAYLOAD_SAMPLE_RATE = float(os.getenv("PROXY_PAYLOAD_SAMPLE_RATE", "0.01"))
+PROXY_ERROR_BODY_LIMIT = int(os.getenv("PROXY_ERROR_BODY_LIMIT", "1000"))
+REDACTED_HEADERS = {"authorization", "cookie", "proxy-authorization"}
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade",
+}
+service_proxy: Optional[ServiceProxy] = None
 
 # User-friendly error messages
 USER_ERROR_MESSAGES = {
@@ -54,6 +99,11 @@ class ServiceStatus(BaseModel):
     response_time: float  # in milliseconds
     endpoint: str
     user_message: Optional[str] = None
+    # Rolling latency percentiles of successful probes, in milliseconds
+    p50: Optional[float] = None
+    p95: Optional[float] = None
+    p99: Optional[float] = None
+    consecutive_failures: int = 0
 
 class ErrorLog(BaseModel):
     timestamp: str
@@ -65,12 +115,19 @@ class ErrorLog(BaseModel):
     request_details: Optional[Dict] = None
     is_resolved: bool = False
 
+class ErrorCount(BaseModel):
+    minute: str
+    service_name: str
+    status_code: int
+    count: int
+
 class ProxyRequest(BaseModel):
     target_service: str
     endpoint: str
     method: str
     data: Optional[Dict] = None
     headers: Optional[Dict] = None
+    stream: bool = False
 
 # Middleware to log all requests and handle errors
 @app.middleware("http")
@@ -99,8 +156,8 @@ async def log_requests(request: Request, call_next):
 @app.get("/health", response_model=Dict[str, ServiceStatus])
 async def get_all_services_health():
     """Get health status of all registered services"""
-    await check_all_services_health()
-    return health_status
+    await refresh_stale(list(service_registry))
+    return {name: health_status[name] for name in service_registry if name in health_status}
 
 @app.get("/health/{service_name}", response_model=ServiceStatus)
 async def get_service_health(service_name: str):
@@ -111,20 +168,37 @@ async def get_service_health(service_name: str):
             content={"detail": f"Service '{service_name}' not found in registry"}
         )
         
-    await check_service_health(service_name, service_registry[service_name])
+    await refresh_stale([service_name])
     return health_status.get(service_name)
 
-async def check_service_health(service_name: str, service_url: str):
-    """Check health of a specific service"""
+def health_check_interval(service_name: str) -> float:
+    return HEALTH_CHECK_INTERVALS.get(service_name, HEALTH_CHECK_INTERVAL)
+
+async def refresh_stale(service_names: List[str]):
+    """Probe the services whose last check is missing or older than HEALTH_MAX_STALENESS"""
+    now = time.monotonic()
+    stale = [
+        name for name in service_names
+        if now - scheduler.last_checked.get(name, float("-inf")) > HEALTH_MAX_STALENESS
+    ]
+    await asyncio.gather(*(scheduler.refresh(name) for name in stale))
+
+async def check_service_health(service_name: str) -> bool:
+    """Check health of a specific service; True if it answered"""
+    service_url = service_registry.get(service_name)
+    if service_url is None:
+        return False
     health_endpoint = f"{service_url}/"
+    history = latency_history.setdefault(service_name, LatencyHistory())
+    failures = scheduler.failures.get(service_name, 0)
     start_time = time.time()
     
     try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            response = await client.get(health_endpoint)
+        response = await http_client.get(health_endpoint)
             
         end_time = time.time()
         response_time = (end_time - start_time) * 1000  # Convert to ms
+        history.add(response_time)
         
         status = "up" if response.status_code < 300 else "degraded"
         user_message = None if status == "up" else USER_ERROR_MESSAGES.get(service_name, USER_ERROR_MESSAGES["default"])
@@ -135,8 +209,10 @@ async def check_service_health(service_name: str, service_url: str):
             last_checked=datetime.now().isoformat(),
             response_time=response_time,
             endpoint=health_endpoint,
-            user_message=user_message
+            user_message=user_message,
+            **history.percentiles()
         )
+        return True
     except Exception as e:
         user_message = USER_ERROR_MESSAGES.get(service_name, USER_ERROR_MESSAGES["default"])
         health_status[service_name] = ServiceStatus(
@@ -145,7 +221,9 @@ async def check_service_health(service_name: str, service_url: str):
             last_checked=datetime.now().isoformat(),
             response_time=0,
             endpoint=health_endpoint,
-            user_message=user_message
+            user_message=user_message,
+            consecutive_failures=failures + 1,
+            **history.percentiles()
         )
         
         # Log the error
@@ -156,23 +234,54 @@ async def check_service_health(service_name: str, service_url: str):
             error_message=str(e),
             user_message=user_message
         )
-
-async def check_all_services_health():
-    """Check health of all registered services"""
-    tasks = []
-    for service_name, service_url in service_registry.items():
-        tasks.append(check_service_health(service_name, service_url))
-    
-    await asyncio.gather(*tasks)
+        return False
 
 # Error logging and reporting
+def to_error_log(record: tuple) -> ErrorLog:
+    fields = dict(zip(RECORD_FIELDS, record))
+    fields.pop("error_id")
+    fields["timestamp"] = datetime.fromtimestamp(fields["timestamp"]).isoformat()
+    return ErrorLog(**fields)
+
 @app.get("/errors", response_model=List[ErrorLog])
-async def get_error_history(limit: int = 50):
-    """Get recent error history with limit"""
-    return error_history[-limit:] if len(error_history) > limit else error_history
+async def get_error_history(
+    limit: int = 50,
+    service: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    status: Optional[int] = None,
+):
+    """Get the most recent errors, optionally filtered by service, time range [since, until) and status code"""
+    records = error_history.query(
+        service_name=service,
+        since=since.timestamp() if since else None,
+        until=until.timestamp() if until else None,
+        status_code=status,
+        limit=limit,
+    )
+    return [to_error_log(record) for record in records]
+
+@app.get("/errors/counts", response_model=List[ErrorCount])
+async def get_error_counts(
+    service: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    """Error counts per minute, service and status code"""
+    return [
+        ErrorCount(
+            minute=datetime.fromtimestamp(minute * 60).isoformat(),
+            service_name=service_name,
+            status_code=status_code,
+            count=count,
+        )
+        for minute, service_name, status_code, count in error_history.counts(
+            service, since.timestamp() if since else None, until.timestamp() if until else None
+        )
+    ]
 
 @app.get("/errors/{service_name}", response_model=List[ErrorLog])
-async def get_service_errors(service_name: str):
+async def get_service_errors(service_name: str, limit: Optional[int] = None):
     """Get errors for a specific service"""
     if service_name not in service_registry:
         return JSONResponse(
@@ -180,149 +289,139 @@ async def get_service_errors(service_name: str):
             content={"detail": f"Service '{service_name}' not found in registry"}
         )
         
-    service_errors = [error for error in error_history if error.service_name == service_name]
-    return service_errors
+    records = error_history.query(service_name=service_name, limit=len(error_history) if limit is None else limit)
+    return [to_error_log(record) for record in records]
 
-def log_error(service_name: str, endpoint: str, status_code: int, error_message: str, user_message: str, request_details: Dict = None):
-    """Log an error to the error history"""
-    error = ErrorLog(
-        timestamp=datetime.now().isoformat(),
+def log_error(service_name: str, endpoint: str, status_code: int, error_message: str, user_message: str, request_details: Dict = None) -> int:
+    """Log an error to the error history and return its id"""
+    error_id = error_history.append(
+        timestamp=time.time(),
         service_name=service_name,
         endpoint=endpoint,
         status_code=status_code,
         error_message=error_message,
         user_message=user_message,
-        request_details=request_details,
-        is_resolved=False
+        request_details=request_details
     )
-    error_history.append(error)
     logger.error(f"Service Error: {service_name} - {endpoint} - {status_code} - {error_message}")
     
     # Here you could add notification logic (email, SMS, etc.)
     # For example:
     # await send_notification(service_name, error_message, user_message)
     
-    return error
+    return error_id
 
 # Service proxy - allows making requests through this service for monitoring
+def proxy_payload_details(request: ProxyRequest) -> Dict:
+    """The request to keep with a logged error; payloads only for a sample of failures"""
+    service_url = service_registry.get(request.target_service, "")
+    details = {"method": request.method, "url": f"{service_url}/{request.endpoint.lstrip('/')}"}
+    if random.random() < PROXY_PAYLOAD_SAMPLE_RATE:
+        details["data"] = request.data
+        details["headers"] = {
+            name: value for name, value in (request.headers or {}).items()
+            if name.lower() not in REDACTED_HEADERS
+        }
+    return details
+
+def log_proxy_error(request: ProxyRequest, status_code: int, error_message: str) -> int:
+    return log_error(
+        service_name=request.target_service,
+        endpoint=request.endpoint.lstrip("/"),
+        status_code=status_code,
+        error_message=error_message,
+        user_message=USER_ERROR_MESSAGES.get(request.target_service, USER_ERROR_MESSAGES["default"]),
+        request_details=proxy_payload_details(request)
+    )
+
+def proxy_error(request: ProxyRequest, status_code: int, detail: str, error_message: str) -> JSONResponse:
+    user_message = USER_ERROR_MESSAGES.get(request.target_service, USER_ERROR_MESSAGES["default"])
+    error_id = log_proxy_error(request, status_code, error_message)
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "detail": detail,
+            "message": error_message,
+            "user_message": user_message,
+            "error_id": error_id  # Reference to the error in the history
+        }
+    )
+
 @app.post("/proxy")
 async def proxy_request(request: ProxyRequest):
-    """Proxy a request to another service with error handling"""
+    """Proxy a request to another service with error handling.
+
+    By default the upstream response is read and wrapped in a JSON
+    envelope; with ``stream`` set the upstream status, headers and body
+    are passed straight through instead.
+    """
     if request.target_service not in service_registry:
         return JSONResponse(
             status_code=404,
             content={"detail": f"Service '{request.target_service}' not found in registry"}
         )
-    
-    service_url = service_registry[request.target_service]
+    method = request.method.upper()
+    if method not in PROXY_METHODS:
+        return JSONResponse(
+            status_code=400,
+            content={"detail": f"Unsupported method: {request.method}"}
+        )
+
     endpoint = request.endpoint.lstrip("/")  # Remove leading slash if present
-    full_url = f"{service_url}/{endpoint}"
-    
-    request_details = {
-        "method": request.method,
-        "url": full_url,
-        "data": request.data,
-        "headers": request.headers
-    }
-    
+    full_url = f"{service_registry[request.target_service]}/{endpoint}"
+    # Methods with a body send data as JSON, the others as query parameters
+    body_method = method in ("POST", "PUT", "PATCH")
+
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            if request.method.lower() == "get":
-                response = await client.get(
-                    full_url, 
-                    params=request.data,
-                    headers=request.headers
-                )
-            elif request.method.lower() == "post":
-                response = await client.post(
-                    full_url, 
-                    json=request.data,
-                    headers=request.headers
-                )
-            elif request.method.lower() == "put":
-                response = await client.put(
-                    full_url, 
-                    json=request.data,
-                    headers=request.headers
-                )
-            elif request.method.lower() == "delete":
-                response = await client.delete(
-                    full_url, 
-                    params=request.data,
-                    headers=request.headers
-                )
-            else:
-                return JSONResponse(
-                    status_code=400,
-                    content={"detail": f"Unsupported method: {request.method}"}
-                )
-                
-        # Return the response data and status code
-        if response.status_code >= 400:
-            # Log error for non-success responses
-            user_message = USER_ERROR_MESSAGES.get(request.target_service, USER_ERROR_MESSAGES["default"])
-            log_error(
-                service_name=request.target_service,
-                endpoint=endpoint,
-                status_code=response.status_code,
-                error_message=str(response.text),
-                user_message=user_message,
-                request_details=request_details
-            )
-        
-        return {
-            "status_code": response.status_code,
-            "headers": dict(response.headers),
-            "data": response.json() if response.headers.get("content-type") == "application/json" else response.text,
-            "service": request.target_service
-        }
-    except httpx.RequestError as e:
-        error_message = f"Request to {request.target_service} failed: {str(e)}"
-        user_message = USER_ERROR_MESSAGES.get(request.target_service, USER_ERROR_MESSAGES["default"])
-        
-        # Log the error
-        error = log_error(
-            service_name=request.target_service,
-            endpoint=endpoint,
-            status_code=503,
-            error_message=error_message,
-            user_message=user_message,
-            request_details=request_details
-        )
-        
-        return JSONResponse(
-            status_code=503,
-            content={
-                "detail": "Service Unavailable",
-                "message": error_message,
-                "user_message": user_message,
-                "error_id": len(error_history) - 1  # Reference to the error in the history
-            }
+        response = await service_proxy.send(
+            request.target_service,
+            method,
+            full_url,
+            params=None if body_method else request.data,
+            json=request.data if body_method else None,
+            headers=request.headers,
         )
+    except httpx.RequestError as e:
+        return proxy_error(request, 503, "Service Unavailable", f"Request to {request.target_service} failed: {str(e)}")
     except Exception as e:
-        error_message = f"Unexpected error: {str(e)}"
-        user_message = USER_ERROR_MESSAGES.get(request.target_service, USER_ERROR_MESSAGES["default"])
-        
-        # Log the error
-        error = log_error(
-            service_name=request.target_service,
-            endpoint=endpoint,
-            status_code=500,
-            error_message=error_message,
-            user_message=user_message,
-            request_details=request_details
-        )
-        
-        return JSONResponse(
-            status_code=500,
-            content={
-                "detail": "Internal Server Error",
-                "message": error_message,
-                "user_message": user_message,
-                "error_id": len(error_history) - 1
-            }
+        return proxy_error(request, 500, "Internal Server Error", f"Unexpected error: {str(e)}")
+
+    if request.stream:
+        if response.status_code >= 400:
+            log_proxy_error(request, response.status_code, f"Upstream returned {response.status_code}")
+        headers = {name: value for name, value in response.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        return StreamingResponse(
+            response.aiter_raw(),
+            status_code=response.status_code,
+            headers=headers,
+            background=BackgroundTask(response.aclose)
         )
 
+    try:
+        await response.aread()
+    except httpx.RequestError as e:
+        return proxy_error(request, 503, "Service Unavailable", f"Request to {request.target_service} failed: {str(e)}")
+    finally:
+        await response.aclose()
+
+    if response.status_code >= 400:
+        # Log error for non-success responses
+        log_proxy_error(request, response.status_code, response.text[:PROXY_ERROR_BODY_LIMIT])
+
+    is_json = response.headers.get("content-type", "").startswith("application/json")
+    # Returned as a JSONResponse directly, skipping FastAPI's generic encoding of the payload
+    return JSONResponse({
+        "status_code": response.status_code,
+        "headers": dict(response.headers),
+        "data": response.json() if is_json and response.content else response.text,
+        "service": request.target_service
+    })
+
+@app.get("/proxy/stats")
+async def get_proxy_stats():
+    """Retry, hedge and retry budget counters of the service proxy"""
+    return service_proxy.stats()
+
 # Service registry management
 @app.get("/registry")
 async def get_service_registry():
@@ -333,6 +432,7 @@ async def get_service_registry():
 async def register_service(service_name: str, url: str):
     """Register a new service or update existing one"""
     service_registry[service_name] = url
+    scheduler.schedule(service_name, 0)
     return {"message": f"Service '{service_name}' registered at {url}"}
 
 @app.delete("/registry/{service_name}")
@@ -340,24 +440,39 @@ async def deregister_service(service_name: str):
     """Remove a service from the registry"""
     if service_name in service_registry:
         del service_registry[service_name]
+        health_status.pop(service_name, None)
+        scheduler.forget(service_name)
+        await service_proxy.close_client(service_name)
         return {"message": f"Service '{service_name}' deregistered"}
     return JSONResponse(
         status_code=404,
         content={"detail": f"Service '{service_name}' not found in registry"}
     )
 
-# Background task to check service health periodically
+# Background probes keep health_status current
 @app.on_event("startup")
 async def startup_event():
     """Initialize services on startup"""
-    # Start periodic health checks
-    asyncio.create_task(periodic_health_check())
+    global http_client, scheduler, service_proxy
+    # One pooled client for every probe instead of a new one per check
+    http_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+    scheduler = HealthScheduler(check_service_health, health_check_interval, max_backoff=HEALTH_MAX_BACKOFF)
+    scheduler.start(service_registry)
+    service_proxy = ServiceProxy(
+        max_connections=PROXY_MAX_CONNECTIONS,
+        max_keepalive=PROXY_MAX_KEEPALIVE,
+        timeout=PROXY_TIMEOUT,
+        max_retries=PROXY_MAX_RETRIES,
+        retry_backoff=PROXY_RETRY_BACKOFF,
+        retry_budget_ratio=PROXY_RETRY_BUDGET,
+        hedge_delay=PROXY_HEDGE_DELAY,
+    )
 
-async def periodic_health_check():
-    """Periodically check health of all services"""
-    while True:
-        await check_all_services_health()
-        await asyncio.sleep(30)  # Check every 30 seconds
+@app.on_event("shutdown")
+async def shutdown_event():
+    await scheduler.stop()
+    await http_client.aclose()
+    await service_proxy.close()
 
 # Add CORS middleware
 app.add_middleware(
@@ -367,3 +482,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
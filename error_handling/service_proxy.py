@@ -0,0 +1,175 @@
+#pooled, retrying proxy client for the error handling service
+import asyncio
+import random
+import time
+from typing import Callable, Dict, Optional
+
+import httpx
+
+# Methods that may be sent more than once without changing the outcome
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# Statuses worth retrying: the upstream (or something in front of it) could not serve the request
+RETRY_STATUSES = frozenset({502, 503, 504})
+
+
+class RetryBudget:
+    """Token bucket that caps retries and hedges to a fraction of traffic.
+
+    Every request deposits ``ratio`` tokens and the balance also refills
+    at ``min_per_second``, so a quiet service can still retry; each retry
+    or hedge withdraws a whole token. When a service goes down the
+    balance drains quickly and further attempts are skipped instead of
+    multiplying the load on it.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_per_second: float = 10.0, max_balance: float = 100.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance
+        self.clock = clock
+        self.balance = max_balance
+        self._refilled = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.balance = min(self.max_balance, self.balance + (now - self._refilled) * self.min_per_second)
+        self._refilled = now
+
+    def deposit(self):
+        self.balance = min(self.max_balance, self.balance + self.ratio)
+
+    def withdraw(self) -> bool:
+        self._refill()
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
+
+
+def _discard(task: asyncio.Future):
+    """Close the response of a losing attempt once it settles"""
+    if task.cancelled():
+        return
+    if task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
+
+
+class ServiceProxy:
+    """One pooled ``httpx.AsyncClient`` per target service, with retries and hedging.
+
+    Responses are always opened in streaming mode; the caller either reads
+    the body or streams it on, and must close the response. Idempotent
+    requests that fail to connect, time out or get a 502/503/504 are
+    retried up to ``max_retries`` times with jittered exponential backoff,
+    as long as the service's RetryBudget allows it. GETs that have not
+    answered after ``hedge_delay`` seconds get a second, identical request
+    and the first response wins; 0 disables hedging.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive: int = 20, timeout: float = 10.0,
+                 max_retries: int = 2, retry_backoff: float = 0.05, retry_budget_ratio: float = 0.1,
+                 hedge_delay: float = 0.0):
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.retry_budget_ratio = retry_budget_ratio
+        self.hedge_delay = hedge_delay
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self.budgets: Dict[str, RetryBudget] = {}
+        self.counters = {"requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "budget_exhausted": 0}
+
+    def client(self, service: str) -> httpx.AsyncClient:
+        client = self._clients.get(service)
+        if client is None:
+            client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+            self._clients[service] = client
+            self.budgets[service] = RetryBudget(self.retry_budget_ratio)
+        return client
+
+    async def close_client(self, service: str):
+        client = self._clients.pop(service, None)
+        self.budgets.pop(service, None)
+        if client is not None:
+            await client.aclose()
+
+    async def close(self):
+        for service in list(self._clients):
+            await self.close_client(service)
+
+    def _may_retry(self, service: str) -> bool:
+        if self.budgets[service].withdraw():
+            return True
+        self.counters["budget_exhausted"] += 1
+        return False
+
+    async def send(self, service: str, method: str, url: str, params: Optional[dict] = None,
+                   json: Optional[dict] = None, headers: Optional[dict] = None) -> httpx.Response:
+        """Send a request to ``service`` and return the open (streaming) response"""
+        client = self.client(service)
+        budget = self.budgets[service]
+        budget.deposit()
+        self.counters["requests"] += 1
+
+        def build() -> httpx.Request:
+            return client.build_request(method, url, params=params, json=json, headers=headers)
+
+        retryable = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            last_try = not retryable or attempt >= self.max_retries
+            try:
+                if method == "GET" and self.hedge_delay > 0:
+                    response = await self._hedged(service, client, build)
+                else:
+                    response = await client.send(build(), stream=True)
+            except httpx.TransportError:
+                if last_try or not self._may_retry(service):
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or last_try or not self._may_retry(service):
+                    return response
+                await response.aclose()
+            attempt += 1
+            self.counters["retries"] += 1
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    async def _hedged(self, service: str, client: httpx.AsyncClient,
+                      build: Callable[[], httpx.Request]) -> httpx.Response:
+        first = asyncio.ensure_future(client.send(build(), stream=True))
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay)
+        except asyncio.CancelledError:
+            first.cancel()
+            first.add_done_callback(_discard)
+            raise
+        if done or not self._may_retry(service):
+            return await first
+        self.counters["hedges"] += 1
+        hedge = asyncio.ensure_future(client.send(build(), stream=True))
+        pending = {first, hedge}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.counters["hedge_wins"] += 1
+                        # Any other attempt that finished in the same round is closed with the losers
+                        for other in done - {task}:
+                            _discard(other)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                task.add_done_callback(_discard)
+
+    def stats(self) -> Dict[str, object]:
+        return {
+            **self.counters,
+            "retry_budget": {service: round(budget.balance, 2) for service, budget in self.budgets.items()},
+        }
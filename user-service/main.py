@@ -1,13 +1,28 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response
 from pydantic import BaseModel
 from typing import List, Dict
+import os
 import uuid
-import hashlib
+
+from buscommon.metrics import CONTENT_TYPE, Metrics, MetricsMiddleware
+from buscommon.tokens import issue_token, token_secret
+
+from passwords import hash_password, verify_dummy, verify_password
+from storage import DuplicateError, open_store
 
 app = FastAPI(title="User Service")
 
-# In-memory storage
-users = {}
+# Request metrics, served as Prometheus text on /metrics
+metrics = Metrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return Response(metrics.render(), media_type=CONTENT_TYPE)
+
+# Storage backend: memory:// (default) or sqlite:///path/to/users.db
+STORAGE_URL = os.getenv("STORAGE_URL", "memory://")
+store = open_store(STORAGE_URL)
 
 class User(BaseModel):
     username: str
@@ -20,8 +35,17 @@ class UserLogin(BaseModel):
     username: str
     password: str
 
-def hash_password(password: str) -> str:
-    return hashlib.sha256(password.encode()).hexdigest()
+@app.on_event("startup")
+async def startup_event():
+    # Refuse to start rather than fail on the first login
+    token_secret()
+    # Makes the dummy hash now, so the first unknown login costs no more than the rest
+    await verify_dummy("")
+    await store.open()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await store.close()
 
 @app.get("/")
 async def root():
@@ -29,32 +53,43 @@ async def root():
 
 @app.post("/users/register")
 async def register_user(user: User):
-    if user.username in users:
-        raise HTTPException(status_code=400, detail="Username already exists")
-    
     user_id = str(uuid.uuid4())
     user_dict = user.dict()
     user_dict["user_id"] = user_id
-    user_dict["password"] = hash_password(user.password)
-    users[user_id] = user_dict
+    # Don't spend a hash on a name that is taken; create still catches a racing duplicate
+    taken = await store.taken(user.username, user.email)
+    if taken is not None:
+        raise HTTPException(status_code=400, detail=f"{taken.capitalize()} already exists")
+    user_dict["password"] = await hash_password(user.password)
+    try:
+        await store.create(user_dict)
+    except DuplicateError as e:
+        raise HTTPException(status_code=400, detail=f"{e.field.capitalize()} already exists")
     return {"message": "User registered successfully", "user_id": user_id}
 
 @app.post("/users/login")
 async def login_user(credentials: UserLogin):
-    for user in users.values():
-        if user["username"] == credentials.username and user["password"] == hash_password(credentials.password):
-            return {
-                "message": "Login successful",
-                "user_id": user["user_id"],
-                "username": user["username"]
-            }
+    user = await store.find_by_username(credentials.username)
+    if user is None:
+        # Same hashing work as a wrong password, so timing does not reveal which usernames exist
+        await verify_dummy(credentials.password)
+    elif await verify_password(credentials.password, user["password"]):
+        issued = issue_token(user["user_id"], "user")
+        return {
+            "message": "Login successful",
+            "user_id": user["user_id"],
+            "username": user["username"],
+            "token": issued["token"],
+            "expires_at": issued["claims"]["exp"]
+        }
     raise HTTPException(status_code=401, detail="Invalid credentials")
 
 @app.get("/users/{user_id}")
 async def get_user(user_id: str):
-    if user_id not in users:
+    user = await store.get(user_id)
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    user = users[user_id].copy()
+    user = user.copy()
     user.pop("password", None)
     return user
 
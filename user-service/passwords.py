@@ -0,0 +1,70 @@
+#password hashing for the user service
+import asyncio
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Scheme for new hashes: pbkdf2 (default), scrypt or sha256 (the old unsalted format)
+PASSWORD_HASH = os.getenv("PASSWORD_HASH", "pbkdf2")
+PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", "200000"))
+SCRYPT_N = int(os.getenv("SCRYPT_N", "16384"))
+SCRYPT_R = 8
+SCRYPT_P = 1
+# Threads doing the hashing; hashlib releases the GIL, so they run in parallel
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 4)))
+
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+# Hash checked when a login names no known user, so that costs as much as a wrong password
+_dummy_hash: Optional[str] = None
+
+
+def _hash(password: str, scheme: str) -> str:
+    if scheme == "sha256":
+        return hashlib.sha256(password.encode()).hexdigest()
+    salt = os.urandom(16)
+    if scheme == "pbkdf2":
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS)
+        return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${salt.hex()}${digest.hex()}"
+    if scheme == "scrypt":
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+    raise ValueError(f"Unsupported PASSWORD_HASH '{scheme}'")
+
+
+def _verify(password: str, encoded: str) -> bool:
+    scheme, _, params = encoded.partition("$")
+    if scheme == "pbkdf2_sha256":
+        iterations, salt, expected = params.split("$")
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+    elif scheme == "scrypt":
+        n, r, p, salt, expected = params.split("$")
+        digest = hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt), n=int(n), r=int(r), p=int(p))
+    else:
+        # Hashes stored before salted schemes existed are a bare sha256 hex digest
+        digest, expected = hashlib.sha256(password.encode()).digest(), encoded
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+async def hash_password(password: str) -> str:
+    """Hash a password with the configured scheme, off the event loop"""
+    if PASSWORD_HASH == "sha256":
+        return _hash(password, PASSWORD_HASH)
+    return await asyncio.get_running_loop().run_in_executor(_executor, _hash, password, PASSWORD_HASH)
+
+
+async def verify_password(password: str, encoded: str) -> bool:
+    """Check a password against a stored hash of any supported scheme"""
+    if "$" not in encoded:
+        return _verify(password, encoded)
+    return await asyncio.get_running_loop().run_in_executor(_executor, _verify, password, encoded)
+
+
+async def verify_dummy(password: str) -> bool:
+    """Spend the time of one verify_password on a login for an unknown user; always False"""
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = await hash_password(os.urandom(16).hex())
+    await verify_password(password, _dummy_hash)
+    return False
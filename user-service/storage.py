@@ -0,0 +1,147 @@
+#storage backends for the user service
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+from buscommon.sqlite import SQLitePool
+
+USER_FIELDS = ("username", "email", "password", "full_name", "phone_number", "user_id")
+
+
+class DuplicateError(Exception):
+    """A unique field (``username`` or ``email``) is already taken"""
+
+    def __init__(self, field: str):
+        super().__init__(f"{field} already exists")
+        self.field = field
+
+
+class UserStore:
+    """Interface of the user storage backends; users are plain dicts keyed by ``USER_FIELDS``"""
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def create(self, user: dict):
+        """Store a new user, raising DuplicateError if its username or email is taken"""
+        raise NotImplementedError
+
+    async def taken(self, username: str, email: str) -> Optional[str]:
+        """Which unique field of a would-be user is already in use, username first, or None"""
+        raise NotImplementedError
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        raise NotImplementedError
+
+
+class MemoryUserStore(UserStore):
+    """Users in process memory, keyed by user_id with username and email indexes"""
+
+    def __init__(self):
+        self.users: Dict[str, dict] = {}
+        self.by_username: Dict[str, dict] = {}
+        self.by_email: Dict[str, dict] = {}
+
+    async def create(self, user: dict):
+        if user["username"] in self.by_username:
+            raise DuplicateError("username")
+        if user["email"] in self.by_email:
+            raise DuplicateError("email")
+        self.users[user["user_id"]] = user
+        self.by_username[user["username"]] = user
+        self.by_email[user["email"]] = user
+
+    async def taken(self, username: str, email: str) -> Optional[str]:
+        if username in self.by_username:
+            return "username"
+        if email in self.by_email:
+            return "email"
+        return None
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return self.users.get(user_id)
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        return self.by_username.get(username)
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT NOT NULL,
+    email TEXT NOT NULL,
+    password TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    phone_number TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username);
+CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email);
+"""
+
+_COLUMNS = ", ".join(USER_FIELDS)
+_INSERT = f"INSERT INTO users ({_COLUMNS}) VALUES ({', '.join('?' for _ in USER_FIELDS)})"
+_SELECT_BY_ID = f"SELECT {_COLUMNS} FROM users WHERE user_id = ?"
+_USERNAME_TAKEN = "SELECT 1 FROM users WHERE username = ?"
+_EMAIL_TAKEN = "SELECT 1 FROM users WHERE email = ?"
+_SELECT_BY_USERNAME = f"SELECT {_COLUMNS} FROM users WHERE username = ?"
+
+
+def _row_to_user(row: Optional[sqlite3.Row]) -> Optional[dict]:
+    return {field: row[field] for field in USER_FIELDS} if row else None
+
+
+class SQLiteUserStore(UserStore):
+    """Users in a SQLite database shared by every worker process"""
+
+    def __init__(self, path: str, pool_size: int = 4):
+        self.path = path
+        self.pool_size = pool_size
+        self.pool: Optional[SQLitePool] = None
+
+    async def open(self):
+        self.pool = SQLitePool(self.path, self.pool_size, SQLITE_SCHEMA)
+
+    async def close(self):
+        self.pool.close()
+
+    async def create(self, user: dict):
+        def insert(connection):
+            try:
+                connection.execute(_INSERT, [user[field] for field in USER_FIELDS])
+            except sqlite3.IntegrityError:
+                # Report username before email, like the in-memory store
+                taken = connection.execute(_USERNAME_TAKEN, (user["username"],)).fetchone()
+                raise DuplicateError("username" if taken else "email")
+        await self.pool.run(insert)
+
+    async def taken(self, username: str, email: str) -> Optional[str]:
+        def check(connection):
+            if connection.execute(_USERNAME_TAKEN, (username,)).fetchone():
+                return "username"
+            if connection.execute(_EMAIL_TAKEN, (email,)).fetchone():
+                return "email"
+            return None
+        return await self.pool.run(check)
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        return await self.pool.run(lambda connection: _row_to_user(
+            connection.execute(_SELECT_BY_ID, (user_id,)).fetchone()))
+
+    async def find_by_username(self, username: str) -> Optional[dict]:
+        return await self.pool.run(lambda connection: _row_to_user(
+            connection.execute(_SELECT_BY_USERNAME, (username,)).fetchone()))
+
+
+def open_store(url: str) -> UserStore:
+    """Build the backend named by a storage URL: ``memory://`` or ``sqlite:///path/to.db``"""
+    if url.startswith("sqlite://"):
+        return SQLiteUserStore(url[len("sqlite://"):], int(os.getenv("SQLITE_POOL_SIZE", "4")))
+    if url.startswith("memory://"):
+        return MemoryUserStore()
+    raise ValueError(f"Unsupported STORAGE_URL '{url}'")